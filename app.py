@@ -1,59 +1,882 @@
-import os
-from flask import Flask, request, abort, jsonify
+import queue
+import base64
+from datetime import date
+from itertools import chain
+from flask import Flask, request, abort, json, Response, stream_with_context, current_app, url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy import Date, func, or_, and_, exc
+from sqlalchemy.orm import selectinload
 import random
 
-from models import setup_db, Movie, Actor
-from auth import AuthError, requires_auth
+from config import Config
+from models import setup_db, db, pool_stats, TableStat, Movie, Actor, Movie_cast, Job, JobFile, bulk_insert, bulk_update, bulk_delete, update_row, add_change_listener, commit_change
+import auth
+from auth import AuthError, requires_auth, jwks_store, token_cache
+from cache import response_cache, object_cache
+from serialization import JSONEncoder, jsonify, encode_rows
+from compression import compress_response
+import transfer
+from transfer import FORMATS, TransferError
+import instrumentation
+import changes
+from changes import change_feed, changes_since, format_event, streams_allowed
+import jobs
+from jobs import job_type, job_runner
+import ratelimit
+from ratelimit import RateLimitError, ConcurrencyLimit, rate_limiter, retry_after_header
+from replicas import wrote_recently
 
-# set up db
-def create_app(test_config=None):
+# the fields of a listed movie or actor, all of them unless ?fields= picks some
+MOVIE_FIELDS = ('id', 'title', 'release_date')
+ACTOR_FIELDS = ('id', 'name', 'age', 'gender')
+# the fields a list may be sorted by, see ordered
+MOVIE_SORT_FIELDS = MOVIE_FIELDS
+ACTOR_SORT_FIELDS = ('id', 'name', 'age')
+# exports also carry the version, so reloading one keeps it
+MOVIE_EXPORT_FIELDS = MOVIE_FIELDS + ('version',)
+ACTOR_EXPORT_FIELDS = ACTOR_FIELDS + ('version',)
+
+
+def int_arg(name, default=None):
+  value = request.args.get(name)
+  if value is None:
+    return default
+  try:
+    return int(value)
+  except ValueError:
+    abort(400)
+
+
+def date_arg(name):
+  value = request.args.get(name)
+  if value is None:
+    return None
+  try:
+    return date.fromisoformat(value)
+  except ValueError:
+    abort(400)
+
+
+def limit_arg():
+  config = current_app.config
+  limit = min(int_arg('limit', config['PAGE_SIZE']), config['MAX_PAGE_SIZE'])
+  if limit < 1:
+    abort(400)
+  return limit
+
+
+'''
+fields_arg(fields)
+    the fields named in ?fields= (comma separated), in the order of
+    fields, or all of fields when the parameter is not given
+'''
+def fields_arg(fields):
+  value = request.args.get('fields')
+  if value is None:
+    return fields
+  names = value.split(',')
+  if any(name not in fields for name in names):
+    abort(400)
+  return tuple(name for name in fields if name in names)
+
+
+'''
+projected(query, model, fields)
+    selects just the columns of fields from the ordered query, so rows come
+    back as plain tuples instead of ORM objects. id and the sort column are
+    selected after them when missing, as the next cursor needs them
+'''
+def projected(query, model, fields):
+  names = list(fields)
+  for name in ('id', request.args.get('sort', 'id').lstrip('-')):
+    if name not in names:
+      names.append(name)
+  return query.with_entities(*[getattr(model, name) for name in names])
+
+
+# a LIKE pattern matching value anywhere, with its wildcards escaped
+def contains_pattern(value):
+  value = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+  return '%' + value + '%'
+
+
+def filter_movies(query):
+  title = request.args.get('title')
+  if title:
+    query = query.filter(Movie.title.ilike(contains_pattern(title), escape='\\'))
+  release_date_from = date_arg('release_date_from')
+  if release_date_from is not None:
+    query = query.filter(Movie.release_date >= release_date_from)
+  release_date_to = date_arg('release_date_to')
+  if release_date_to is not None:
+    query = query.filter(Movie.release_date <= release_date_to)
+  return query
+
+
+def filter_actors(query):
+  name = request.args.get('name')
+  if name:
+    query = query.filter(Actor.name.ilike(contains_pattern(name), escape='\\'))
+  age_min = int_arg('age_min')
+  if age_min is not None:
+    query = query.filter(Actor.age >= age_min)
+  age_max = int_arg('age_max')
+  if age_max is not None:
+    query = query.filter(Actor.age <= age_max)
+  gender = request.args.get('gender')
+  if gender:
+    query = query.filter(func.lower(Actor.gender) == gender.lower())
+  return query
+
+
+def encode_cursor(value, id):
+  if isinstance(value, date):
+    value = value.isoformat()
+  return base64.urlsafe_b64encode(json.dumps([value, id]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, column):
+  try:
+    value, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    if value is not None and isinstance(column.type, Date):
+      value = date.fromisoformat(value)
+    if not isinstance(id, int):
+      raise ValueError(cursor)
+  except (ValueError, TypeError):
+    abort(400)
+  return value, id
+
+
+'''
+ordered(query, model, sortable)
+    applies ?sort= and ?cursor= to the query. sort names one of the
+    sortable columns, prefixed with - for descending order; rows are
+    ordered by it (nulls last) then by id, and start after the row the
+    cursor names. keyset pagination needs no OFFSET, so every page costs
+    the same. returns the query and a function giving a row's cursor, the
+    row id when sorting by id and an opaque token otherwise
+'''
+def ordered(query, model, sortable):
+  sort = request.args.get('sort', 'id')
+  descending = sort.startswith('-')
+  name = sort[1:] if descending else sort
+  if name not in sortable:
+    abort(400)
+  column = getattr(model, name)
+  cursor = request.args.get('cursor')
+
+  if name == 'id':
+    if cursor is not None:
+      last_id = int_arg('cursor')
+      query = query.filter(model.id < last_id if descending else model.id > last_id)
+    query = query.order_by(model.id.desc() if descending else model.id)
+    return query, lambda row: row.id
+
+  if cursor is not None:
+    value, last_id = decode_cursor(cursor, column)
+    if value is None:
+      query = query.filter(column.is_(None), model.id > last_id)
+    else:
+      query = query.filter(or_(
+        column < value if descending else column > value,
+        and_(column == value, model.id > last_id),
+        column.is_(None)))
+  order = column.desc() if descending else column.asc()
+  query = query.order_by(order.nullslast(), model.id)
+  return query, lambda row: encode_cursor(getattr(row, name), row.id)
+
+
+'''
+paginate(query, limit, cursor_of)
+    returns the first limit rows of the ordered query and the cursor of
+    the next page (None on the last page)
+'''
+def paginate(query, limit, cursor_of):
+  rows = query.limit(limit + 1).all()
+
+  next_cursor = None
+  if len(rows) > limit:
+    rows = rows[:limit]
+    next_cursor = cursor_of(rows[-1])
+  return rows, next_cursor
+
+
+def wants_stream():
+  return request.args.get('stream', '').lower() in ('1', 'true')
+
+
+'''
+wants_include(name)
+    whether the list should embed the related rows called name, as asked
+    with ?include=name. aborts with 400 for anything else, or when streaming
+'''
+def wants_include(name):
+  include = request.args.get('include')
+  if include is None:
+    return False
+  if include != name or wants_stream():
+    abort(400)
+  return True
+
+
+'''
+stream_list(key, query, fields)
+    streams {"success": true, <key>: [...]} one row at a time, reading the
+    projected query through a server-side cursor so memory stays flat
+    whatever the table size. rows are encoded straight from the tuples
+'''
+def stream_list(key, query, fields):
+  batch_size = current_app.config['STREAM_BATCH_SIZE']
+  rows = iter(query.yield_per(batch_size))
+
+  first = next(rows, None)
+  if first is None:
+    abort(404)
+
+  def generate():
+    objects = encode_rows(fields, chain([first], rows))
+    chunk = [b'{"success":true,"%s":[' % key.encode('ascii'), next(objects)]
+    for row in objects:
+      chunk.append(b',' + row)
+      if len(chunk) >= batch_size:
+        yield b''.join(chunk)
+        chunk = []
+    chunk.append(b']}')
+    yield b''.join(chunk)
+
+  return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+'''
+validate_movie(item, partial=False) / validate_actor(item, partial=False)
+    check one item of a bulk request and return the column values to write.
+    partial items (for updates) may leave fields out but must set one.
+    raise ValueError with a message for the caller otherwise
+'''
+# an explicit null, which the nullable columns take; a missing field is not one
+def nulled(item, name):
+  return name in item and item[name] is None
+
+
+def validate_movie(item, partial=False):
+  values = {}
+  if 'title' in item or not partial:
+    if not isinstance(item.get('title'), str) or not item['title']:
+      raise ValueError('title is required')
+    values['title'] = item['title']
+  if 'release_date' in item or not partial:
+    try:
+      # null where given as such, the column being nullable
+      values['release_date'] = None if nulled(item, 'release_date') else date.fromisoformat(item.get('release_date'))
+    except (TypeError, ValueError):
+      raise ValueError('release_date must be a YYYY-MM-DD date')
+  if not values:
+    raise ValueError('nothing to update')
+  return values
+
+
+def validate_actor(item, partial=False):
+  values = {}
+  if 'name' in item or not partial:
+    if not isinstance(item.get('name'), str) or not item['name']:
+      raise ValueError('name is required')
+    values['name'] = item['name']
+  if 'age' in item or not partial:
+    age = item.get('age')
+    if not nulled(item, 'age') and (not isinstance(age, int) or isinstance(age, bool) or age < 0):
+      raise ValueError('age must be a non-negative integer')
+    values['age'] = age
+  if 'gender' in item or not partial:
+    if not nulled(item, 'gender') and not isinstance(item.get('gender'), str):
+      raise ValueError('gender is required')
+    values['gender'] = item['gender']
+  if not values:
+    raise ValueError('nothing to update')
+  return values
+
+
+'''
+bulk_rows(key, validate, partial=False)
+    reads the list of items under key in the request body and validates
+    every one of them, aborting with 422 and the per-item errors if any is
+    invalid so that nothing of the batch is written. for partial (update)
+    batches each item must also carry an integer id
+'''
+def bulk_rows(key, validate, partial=False):
+  body = request.get_json(silent=True) or {}
+  items = body.get(key)
+  if not isinstance(items, list) or not items or len(items) > current_app.config['MAX_BULK_SIZE']:
+    abort(422)
+
+  rows = []
+  errors = []
+  for index, item in enumerate(items):
+    try:
+      if not isinstance(item, dict):
+        raise ValueError('item must be an object')
+      row = validate(item, partial)
+      if partial:
+        if not isinstance(item.get('id'), int):
+          raise ValueError('id is required')
+        row['id'] = item['id']
+      rows.append(row)
+    except ValueError as e:
+      errors.append({'index': index, 'success': False, 'message': str(e)})
+
+  if errors:
+    response = jsonify({
+      'success': False,
+      'error': 422,
+      'message': 'unprocessable',
+      'results': errors
+    })
+    response.status_code = 422
+    abort(response)
+  return rows
+
+
+def bulk_ids():
+  body = request.get_json(silent=True) or {}
+  ids = body.get('ids')
+  if (not isinstance(ids, list) or not ids or len(ids) > current_app.config['MAX_BULK_SIZE']
+      or not all(isinstance(id, int) for id in ids)):
+    abort(422)
+  return ids
+
+
+'''
+bulk_results(ids, found)
+    one result per requested id, in request order
+'''
+def bulk_results(ids, found):
+  results = []
+  for id in ids:
+    if id in found:
+      results.append({'id': id, 'success': True})
+    else:
+      results.append({'id': id, 'success': False, 'error': 404})
+  return results
+
+
+'''
+record_response(key, model, id)
+    the row id of model as {key: record}, from the object cache when it is
+    there (so without touching the database) and read as plain columns
+    otherwise. its version is the ETag, and a matching If-None-Match gets a
+    304 without the body being encoded. the cache only keeps records read
+    from the primary, and a client that just wrote skips it (a worker's
+    copy may predate the write)
+'''
+def record_response(key, model, id):
+  table = model.__table__
+  def load():
+    # a lagging replica's copy would be served until OBJECT_CACHE_TTL
+    db.session().use_primary()
+    row = db.session.execute(table.select().where(table.c.id == id)).first()
+    return dict(row) if row is not None else None
+
+  record = load() if wrote_recently() else object_cache.get(table.name, id, load)
+  if record is None:
+    abort(404)
+  etag = str(record['version'])
+  if request.if_none_match.contains_weak(etag):
+    response = Response(status=304)
+  else:
+    response = jsonify({
+      'success': True,
+      key: record
+    })
+  response.set_etag(etag)
+  return response
+
+
+'''
+expected_versions(body)
+    the versions a PATCH may apply to, and the status to answer when the
+    row is at none of them: the strong ETags of If-Match (412), else the
+    version in the body (409). None when the update is unconditional
+'''
+def expected_versions(body):
+  if request.if_match:
+    if request.if_match.star_tag:
+      return None, None
+    return [int(tag) for tag in request.if_match.as_set() if tag.isdigit()], 412
+  if 'version' in body:
+    if not isinstance(body['version'], int) or isinstance(body['version'], bool):
+      abort(400)
+    return [body['version']], 409
+  return None, None
+
+
+'''
+patch_row(key, model, id, values, body)
+    updates row id with values in one conditional statement (see
+    update_row). a row that exists but is at another version than expected
+    is a conflict, answered with its current version and ETag
+'''
+def patch_row(key, model, id, values, body):
+  versions, status = expected_versions(body)
+  try:
+    row = update_row(model, id, values, versions)
+  except exc.DBAPIError:
+    db.session.rollback()
+    abort(422)
+  if row is None:
+    # only a failed update reads the row, to tell a conflict from a 404
+    version = db.session.query(model.version).filter(model.id == id).scalar()
+    if version is None:
+      abort(404)
+    response = jsonify({
+      'success': False,
+      'error': status,
+      'message': 'precondition failed' if status == 412 else 'version conflict',
+      'version': version
+    })
+    response.status_code = status
+    response.set_etag(str(version))
+    abort(response)
+
+  response = jsonify({
+    'success': True,
+    key: row
+  })
+  response.set_etag(str(row['version']))
+  return response
+
+
+'''
+format_arg()
+    the file format of an import or export: ?format= (csv or ndjson), else
+    csv for a text/csv body, else ndjson
+'''
+def format_arg():
+  fmt = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'ndjson')
+  if fmt not in FORMATS:
+    abort(400)
+  return fmt
+
+
+def export_response(name, model, fields):
+  fmt = format_arg()
+  response = Response(stream_with_context(transfer.export_rows(model, fields, fmt)), mimetype=FORMATS[fmt])
+  response.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (name, fmt)
+  return response
+
+
+'''
+import_response(model, validate)
+    imports the request body, read as a stream rather than loaded, with
+    the rows checked by validate. a bad row fails the whole import with 422
+    and the line it is on. with Prefer: respond-async the body is stored
+    with a job importing it instead (see import_job)
+'''
+def import_response(model, validate):
+  fmt = format_arg()
+  if wants_async():
+    job = job_runner.submit('import_' + model.__tablename__, {'fmt': fmt}, file=request.stream)
+    return job_response(job)
+  try:
+    count, elapsed = transfer.import_rows(model, request.stream, fmt, validate)
+  except TransferError as e:
+    response = jsonify({
+      'success': False,
+      'error': 422,
+      'message': str(e),
+      'line': e.line
+    })
+    response.status_code = 422
+    abort(response)
+  return jsonify({
+    'success': True,
+    'imported': count,
+    'rows_per_second': round(transfer.rows_per_second(count, elapsed))
+  })
+
+
+def wants_async():
+  preferences = [preference.split(';')[0].strip().lower() for preference in request.headers.get('Prefer', '').split(',')]
+  return 'respond-async' in preferences
+
+
+# 202 Accepted, pointing at GET /jobs/<id>
+def job_response(job):
+  response = jsonify({
+    'success': True,
+    'job': job.format()
+  })
+  response.status_code = 202
+  response.headers['Location'] = url_for('get_job', job_id=job.id)
+  response.headers['Preference-Applied'] = 'respond-async'
+  return response
+
+
+'''
+import_job(model, validate)
+    the job function importing the body import_response stored with the
+    job, with its progress in bytes read
+'''
+def import_job(model, validate):
+  def run(job, fmt):
+    size = JobFile.size(job.id)
+    job.progress(0, size)
+    file = JobFile.open(job.id)
+    count, elapsed = transfer.import_rows(model, file, fmt, validate, progress=lambda rows: job.progress(file.tell()))
+    job.progress(size)
+    return {
+      'imported': count,
+      'rows_per_second': round(transfer.rows_per_second(count, elapsed))
+    }
+  return run
+
+
+job_type('import_movies', 'post:movies')(import_job(Movie, validate_movie))
+job_type('import_actors', 'post:actors')(import_job(Actor, validate_actor))
+
+
+'''
+recount_tables(job, tables)
+    the recount job: the row counts of table_stats read again from count(*)
+'''
+@job_type('recount')
+def recount_tables(job, tables):
+  for done, table_name in enumerate(tables):
+    job.progress(done, len(tables))
+    TableStat.recount(table_name)
+  job.progress(len(tables))
+  return {table_name: TableStat.count(table_name) for table_name in tables}
+
+
+# the permission needed to see the changes to each table
+CHANGE_PERMISSIONS = {
+  'movies': 'get:movies',
+  'movie_cast': 'get:movies',
+  'actors': 'get:actors'
+}
+
+
+def readable_tables(payload):
+  permissions = payload.get('permissions', ())
+  return {table for table, permission in CHANGE_PERMISSIONS.items() if permission in permissions}
+
+
+'''
+stream_changes(tables)
+    the changes to tables as server-sent events, one per change log entry
+    with its seq as the event id. with ?since= (or the Last-Event-ID an
+    EventSource sends when it reconnects) the entries after it are read
+    from the log first; then the stream follows change_feed, holding no
+    database connection while it waits
+'''
+def stream_changes(tables):
+  since = int_arg('since')
+  if since is None and request.headers.get('Last-Event-ID'):
+    try:
+      since = int(request.headers['Last-Event-ID'])
+    except ValueError:
+      abort(400)
+  batch_size = current_app.config['STREAM_BATCH_SIZE']
+  keepalive = current_app.config['CHANGE_KEEPALIVE']
+  # the feed itself, as the response is closed outside the app context
+  feed = change_feed._get_current_object()
+  subscriber = feed.subscribe()
+
+  def generate():
+    yield b'retry: 3000\n\n'
+    last_seq = since
+    while last_seq is not None:
+      entries = changes_since(last_seq, batch_size, until=subscriber.start)
+      if not entries:
+        break
+      yield b''.join(format_event(entry) for entry in entries if entry['table'] in tables)
+      last_seq = entries[-1]['seq']
+    db.session.remove()
+
+    while True:
+      try:
+        entry = subscriber.get(keepalive)
+      except queue.Empty:
+        yield b': keepalive\n\n'
+        continue
+      # too far behind: the client reconnects and reads the log from its last event
+      if entry is None:
+        return
+      if entry['table'] in tables:
+        yield format_event(entry)
+
+  response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+  response.headers['Cache-Control'] = 'no-cache'
+  # nginx would otherwise buffer the events
+  response.headers['X-Accel-Buffering'] = 'no'
+  response.call_on_close(lambda: feed.unsubscribe(subscriber))
+  return response
+
+
+'''
+create_app(config=None)
+    builds the app from config, a config.Config read from the environment
+    when not given
+'''
+def create_app(config=None):
   app = Flask(__name__)
+  app.config.from_object((config or Config()).validate())
+  instrumentation.init_app(app)
+  app.json_encoder = JSONEncoder
+  auth.init_app(app)
+  ratelimit.init_app(app)
+  changes.init_app(app)
+  jobs.init_app(app)
+  # at most this many list (or bulk) requests at once per worker
+  list_slots = ConcurrencyLimit('list', app.config['LIST_CONCURRENCY'])
+  bulk_slots = ConcurrencyLimit('bulk', app.config['BULK_CONCURRENCY'])
+  change_slots = ConcurrencyLimit('change stream', app.config['CHANGE_MAX_SUBSCRIBERS'])
+  # set up db
   setup_db(app)
   CORS(app)
+  add_change_listener(response_cache.on_change)
+  add_change_listener(object_cache.on_change)
+  response_cache.versions = TableStat.versions
+  app.after_request(compress_response)
 
   # All route functions
 
   @app.route('/')
   def get_greeting():
-    excited = os.environ['EXCITED']
+    excited = app.config['EXCITED']
     greeting = "Hello"
-    if excited == 'true': greeting = greeting + "!!!!!"
+    if excited: greeting = greeting + "!!!!!"
     return greeting
 
+  # in-process cache counters, to check the hot path stays off the network
+  @app.route('/stats')
+  def get_stats():
+    return jsonify({
+      'success': True,
+      'jwks': jwks_store.stats,
+      'tokens': token_cache.stats,
+      'responses': getattr(response_cache.backend, 'stats', None),
+      'objects': object_cache.stats,
+      'pool': pool_stats(db.engine.pool),
+      'replicas': app.extensions['replicas'].state() if 'replicas' in app.extensions else None,
+      'rate_limits': rate_limiter.stats,
+      'concurrency': {
+        'list': list_slots.stats,
+        'bulk': bulk_slots.stats,
+        'changes': change_slots.stats
+      },
+      'changes': dict(change_feed.stats, subscribers=len(change_feed.subscribers)),
+      'jobs': job_runner.state()
+    })
+
+  # per-route timings and query counts, in the Prometheus text format
+  @app.route('/metrics')
+  def get_metrics():
+    return Response(instrumentation.metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
   # get functions
   # get movies
   @app.route('/movies', methods=['GET'])
   @requires_auth('get:movies')
+  @response_cache.cached('movies', includes=('movie_cast', 'actors'))
+  @list_slots
   def get_movies(jwt):
-    try:
-      movies = list(map(Movie.format, Movie.query.all()))
-
-      if not movies:
-        abort(404)
-      result = {
-        "success": True,
-        "movies": movies
-      }
+    fields = fields_arg(MOVIE_FIELDS)
+    query, cursor_of = ordered(filter_movies(Movie.query), Movie, MOVIE_SORT_FIELDS)
+    # the cast of the whole page is loaded in one extra query
+    include_cast = wants_include('cast')
+    if include_cast:
+      query = query.options(selectinload(Movie.movie_cast).joinedload(Movie_cast.actor))
+    else:
+      query = projected(query, Movie, fields)
 
-      return jsonify(result)
+    if wants_stream():
+      return stream_list('movies', query, fields)
+    limit = limit_arg()
+    try:
+      movies, next_cursor = paginate(query, limit, cursor_of)
     except:
       abort(422)
 
+    if not movies:
+      abort(404)
+    if include_cast:
+      movies = [movie.format_with_cast() for movie in movies]
+      movies = [{name: movie[name] for name in fields + ('cast',)} for movie in movies]
+    else:
+      movies = [dict(zip(fields, row)) for row in movies]
+    result = {
+      "success": True,
+      "movies": movies,
+      "next_cursor": next_cursor
+    }
+
+    return jsonify(result)
+
   # get actors
   @app.route('/actors', methods=['GET'])
   @requires_auth('get:actors')
+  @response_cache.cached('actors', includes=('movie_cast', 'movies'))
+  @list_slots
   def get_actors(jwt):
+    fields = fields_arg(ACTOR_FIELDS)
+    query, cursor_of = ordered(filter_actors(Actor.query), Actor, ACTOR_SORT_FIELDS)
+    include_movies = wants_include('movies')
+    if include_movies:
+      query = query.options(selectinload(Actor.movie_cast).joinedload(Movie_cast.movie))
+    else:
+      query = projected(query, Actor, fields)
+
+    if wants_stream():
+      return stream_list('actors', query, fields)
+    limit = limit_arg()
     try:
-      actors = list(map(Actor.format, Actor.query.all()))
-      if not actors:
-        abort(404)
+      actors, next_cursor = paginate(query, limit, cursor_of)
     except Exception as e:
       print(e)
       abort(500)
-    return jsonify({"success": True, "actors": actors})
+
+    if not actors:
+      abort(404)
+    if include_movies:
+      actors = [actor.format_with_movies() for actor in actors]
+      actors = [{name: actor[name] for name in fields + ('movies',)} for actor in actors]
+    else:
+      actors = [dict(zip(fields, row)) for row in actors]
+    return jsonify({
+      "success": True,
+      "actors": actors,
+      "next_cursor": next_cursor
+    })
+
+  # get one movie or actor
+  @app.route('/movies/<int:movie_id>', methods=['GET'])
+  @requires_auth('get:movies')
+  def get_movie(jwt, movie_id):
+    return record_response('movie', Movie, movie_id)
+
+  @app.route('/actors/<int:actor_id>', methods=['GET'])
+  @requires_auth('get:actors')
+  def get_actor(jwt, actor_id):
+    return record_response('actor', Actor, actor_id)
+
+  # changes to movies, actors and casts: a page of the change log after
+  # ?since=, or a server-sent event stream for clients accepting one
+  @app.route('/changes', methods=['GET'])
+  @requires_auth('get:movies')
+  @change_slots
+  def get_changes(jwt):
+    tables = readable_tables(jwt)
+    # no entry may be missed to replication lag
+    db.session().use_primary()
+    if request.accept_mimetypes.best == 'text/event-stream':
+      if not streams_allowed(current_app.config['CHANGE_STREAMS']):
+        response = jsonify({
+          'success': False,
+          'error': 503,
+          'message': 'change streams need gevent workers, read pages of /changes instead'
+        })
+        response.status_code = 503
+        abort(response)
+      return stream_changes(tables)
+
+    since = int_arg('since', 0)
+    entries = changes_since(since, limit_arg())
+    return jsonify({
+      'success': True,
+      'changes': [entry for entry in entries if entry['table'] in tables],
+      'next': entries[-1]['seq'] if entries else since
+    })
+
+  # any token may ask, the job itself tells which permission reading it takes
+  @app.route('/jobs/<int:job_id>', methods=['GET'])
+  @requires_auth(None)
+  def get_job(jwt, job_id):
+    # a replica may not have the job yet
+    db.session().use_primary()
+    job = Job.query.get(job_id)
+    if job is None:
+      abort(404)
+    if job.permission is not None and job.permission not in jwt.get('permissions', ()):
+      abort(401)
+    return jsonify({
+      'success': True,
+      'job': job.format()
+    })
+
+  # cast functions
+  @app.route('/movies/<int:movie_id>/cast', methods=['GET'])
+  @requires_auth('get:movies')
+  def get_movie_cast(jwt, movie_id):
+    movie = Movie.query.options(
+      selectinload(Movie.movie_cast).joinedload(Movie_cast.actor)
+    ).filter(Movie.id == movie_id).one_or_none()
+    if movie is None:
+      abort(404)
+
+    return jsonify({
+      'success': True,
+      'movie': movie.format(),
+      'cast': [cast.format_actor() for cast in movie.movie_cast]
+    })
+
+  @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+  @requires_auth('get:actors')
+  def get_actor_movies(jwt, actor_id):
+    actor = Actor.query.options(
+      selectinload(Actor.movie_cast).joinedload(Movie_cast.movie)
+    ).filter(Actor.id == actor_id).one_or_none()
+    if actor is None:
+      abort(404)
+
+    return jsonify({
+      'success': True,
+      'actor': actor.format(),
+      'movies': [cast.format_movie() for cast in actor.movie_cast]
+    })
+
+  # cast an actor in a movie
+  @app.route('/movies/<int:movie_id>/cast', methods=['POST'])
+  @requires_auth('patch:movies')
+  def create_movie_cast(jwt, movie_id):
+    body = request.get_json(silent=True) or {}
+    actor_id = body.get('actor_id')
+    if not isinstance(actor_id, int):
+      abort(422)
+
+    if Movie.query.get(movie_id) is None or Actor.query.get(actor_id) is None:
+      abort(404)
+
+    cast = Movie_cast(movie_id=movie_id, actor_id=actor_id, role=body.get('role'))
+    try:
+      cast.insert()
+    except exc.IntegrityError:
+      # the actor is in the cast already
+      db.session.rollback()
+      abort(409)
+    except exc.DBAPIError:
+      db.session.rollback()
+      abort(422)
+
+    return jsonify({
+      'success': True,
+      'created': cast.id
+    })
+
+  # remove an actor from a movie's cast
+  @app.route('/movies/<int:movie_id>/cast/<int:actor_id>', methods=['DELETE'])
+  @requires_auth('patch:movies')
+  def delete_movie_cast(jwt, movie_id, actor_id):
+    casts = Movie_cast.query.filter_by(movie_id=movie_id, actor_id=actor_id)
+    ids = [row.id for row in casts.with_entities(Movie_cast.id)]
+    if not ids:
+      abort(404)
+
+    casts.delete(synchronize_session=False)
+    commit_change(Movie_cast.__tablename__, 'delete', ids)
+    return jsonify({
+      'success': True,
+      'deleted': actor_id
+    })
 
   # delete movies
   @app.route('/movies/<int:movie_id>', methods=['DELETE'])
@@ -69,7 +892,7 @@ def create_app(test_config=None):
       return jsonify({
         'success': True,
         'deleted': movie_id,
-        'total_questions': len(Movie.query.all())
+        'total_questions': Movie.count()
       })
     except:
       abort(422)
@@ -89,7 +912,7 @@ def create_app(test_config=None):
       return jsonify({
         'success': True,
         'deleted': actor_id,
-        'total_questions': len(Actor.query.all())})
+        'total_questions': Actor.count()})
     except:
       abort(422)
 
@@ -105,7 +928,7 @@ def create_app(test_config=None):
     new_title = body.get('title', None)
     new_release_date = body.get('release_date', None)
     try:
-      movie = Movie(title=new_title, release_date=new_release_date)
+      movie = Movie(title=new_title, release_date=date.fromisoformat(new_release_date))
       movie.insert()
 
       return jsonify({
@@ -136,7 +959,7 @@ def create_app(test_config=None):
       return jsonify({
         'success': True,
         'create': actor.id,
-        'total_actors': len(Actor.query.all())
+        'total_actors': Actor.count()
       })
 
     except:
@@ -146,73 +969,147 @@ def create_app(test_config=None):
   @app.route('/movies/<int:id>', methods=['PATCH'])
   @requires_auth('patch:movies')
   def update_movie(jwt, id):
-    title = request.get_json().get('title')
-    release_date = request.get_json().get('release_date')
+    body = request.get_json(silent=True) or {}
+    title = body.get('title')
+    release_date = body.get('release_date')
 
     # make sure some data was passed
-    try:
-        data = title or release_date
-        if not data:
-            abort(400)
-    except (TypeError, KeyError):
-        abort(400)
-
-    # make sure movie exists
-    movie = Movie.query.filter_by(id=id).first()
-    if not movie:
-        abort(404)
+    if not (title or release_date):
+      abort(400)
 
-    # update
-    try:
-        if title:
-            movie.title = title
-        if release_date:
-            movie.release_date = release_date
-        movie.update()
-        return jsonify({
-            'success': True,
-            'movie': movie.format()
-        }), 200
-    except Exception:
+    values = {}
+    if title:
+      values['title'] = title
+    if release_date:
+      try:
+        values['release_date'] = date.fromisoformat(release_date)
+      except (TypeError, ValueError):
+        # a movie that does not exist is still a 404
+        if db.session.query(Movie.id).filter(Movie.id == id).scalar() is None:
+          abort(404)
         abort(422)
+    return patch_row('movie', Movie, id, values, body)
 
 
   # patch a actor
   @app.route('/actors/<int:id>', methods=['PATCH'])
   @requires_auth('patch:actors')
   def update_actor(jwt, id):
-    name = request.get_json().get('name')
-    age = request.get_json().get('age')
-    gender = request.get_json().get('gender')
+    body = request.get_json(silent=True) or {}
+    name = body.get('name')
+    age = body.get('age')
+    gender = body.get('gender')
 
     # make sure some data was passed
-    try:
-        data = name or age or gender
-        if not data:
-            abort(400)
-    except (TypeError, KeyError):
-        abort(400)
-
-    # make sure movie exists
-    actor = Actor.query.filter_by(id=id).first()
-    if not actor:
-        abort(404)
+    if not (name or age or gender):
+      abort(400)
 
-    # update
-    try:
-        if name:
-            actor.name = name
-        if age:
-            actor.age = age
-        if gender:
-            actor.gender = gender
-        actor.update()
-        return jsonify({
-            'success': True,
-            'actor': actor.format()
-        }), 200
-    except Exception:
-        abort(422)
+    values = {}
+    if name:
+      values['name'] = name
+    if age:
+      values['age'] = age
+    if gender:
+      values['gender'] = gender
+    return patch_row('actor', Actor, id, values, body)
+
+  # bulk functions
+  # each batch is validated up front and written in a single transaction
+  @app.route('/movies/bulk', methods=['POST'])
+  @requires_auth('post:movies')
+  @bulk_slots
+  def create_movies_bulk(jwt):
+    rows = bulk_rows('movies', validate_movie)
+    ids = bulk_insert(Movie, rows)
+    return jsonify({
+      'success': True,
+      'results': [{'index': index, 'id': id, 'success': True} for index, id in enumerate(ids)],
+      'total_movies': Movie.count()
+    })
+
+  @app.route('/movies/bulk', methods=['PATCH'])
+  @requires_auth('patch:movies')
+  @bulk_slots
+  def update_movies_bulk(jwt):
+    rows = bulk_rows('movies', validate_movie, partial=True)
+    found = bulk_update(Movie, rows)
+    return jsonify({
+      'success': True,
+      'results': bulk_results([row['id'] for row in rows], found)
+    })
+
+  @app.route('/movies/bulk', methods=['DELETE'])
+  @requires_auth('delete:movies')
+  @bulk_slots
+  def delete_movies_bulk(jwt):
+    ids = bulk_ids()
+    found = bulk_delete(Movie, ids)
+    return jsonify({
+      'success': True,
+      'results': bulk_results(ids, found),
+      'total_movies': Movie.count()
+    })
+
+  @app.route('/actors/bulk', methods=['POST'])
+  @requires_auth('post:actors')
+  @bulk_slots
+  def create_actors_bulk(jwt):
+    rows = bulk_rows('actors', validate_actor)
+    ids = bulk_insert(Actor, rows)
+    return jsonify({
+      'success': True,
+      'results': [{'index': index, 'id': id, 'success': True} for index, id in enumerate(ids)],
+      'total_actors': Actor.count()
+    })
+
+  @app.route('/actors/bulk', methods=['PATCH'])
+  @requires_auth('patch:actors')
+  @bulk_slots
+  def update_actors_bulk(jwt):
+    rows = bulk_rows('actors', validate_actor, partial=True)
+    found = bulk_update(Actor, rows)
+    return jsonify({
+      'success': True,
+      'results': bulk_results([row['id'] for row in rows], found)
+    })
+
+  @app.route('/actors/bulk', methods=['DELETE'])
+  @requires_auth('delete:actors')
+  @bulk_slots
+  def delete_actors_bulk(jwt):
+    ids = bulk_ids()
+    found = bulk_delete(Actor, ids)
+    return jsonify({
+      'success': True,
+      'results': bulk_results(ids, found),
+      'total_actors': Actor.count()
+    })
+
+  # import and export functions
+  # whole tables as CSV or NDJSON, streamed both ways
+  @app.route('/movies/export', methods=['GET'])
+  @requires_auth('get:movies')
+  @list_slots
+  def export_movies(jwt):
+    return export_response('movies', Movie, MOVIE_EXPORT_FIELDS)
+
+  @app.route('/actors/export', methods=['GET'])
+  @requires_auth('get:actors')
+  @list_slots
+  def export_actors(jwt):
+    return export_response('actors', Actor, ACTOR_EXPORT_FIELDS)
+
+  @app.route('/movies/import', methods=['POST'])
+  @requires_auth('post:movies')
+  @bulk_slots
+  def import_movies(jwt):
+    return import_response(Movie, validate_movie)
+
+  @app.route('/actors/import', methods=['POST'])
+  @requires_auth('post:actors')
+  @bulk_slots
+  def import_actors(jwt):
+    return import_response(Actor, validate_actor)
 
   # errors
   @app.errorhandler(404)
@@ -223,6 +1120,14 @@ def create_app(test_config=None):
       'message': "resource not found"
     }), 404
 
+  @app.errorhandler(409)
+  def conflict(error):
+    return jsonify({
+      'success': False,
+      'error': 409,
+      'message': 'conflict'
+    }), 409
+
   @app.errorhandler(422)
   def unprocessable(error):
     return jsonify({
@@ -251,10 +1156,31 @@ def create_app(test_config=None):
   def auth_error(e):
     return jsonify(e.error), e.status_code
 
+  # 429 over the rate limit, 503 over a concurrency cap
+  @app.errorhandler(RateLimitError)
+  def rate_limited(e):
+    return jsonify({
+      'success': False,
+      'error': e.status_code,
+      'message': e.message
+    }), e.status_code, {'Retry-After': retry_after_header(e.retry_after)}
+
   return app
 
 
-APP = create_app()
+'''
+APP
+    the app served by gunicorn (app:APP) and manage.py, created on first
+    access so that importing this module builds nothing
+'''
+def __getattr__(name):
+  if name == 'APP':
+    global APP
+    APP = create_app()
+    return APP
+  raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
 # run the app
 if __name__ == '__main__':
-  APP.run(host='0.0.0.0', port=8080, debug=True)
+  create_app().run(host='0.0.0.0', port=8080, debug=True)
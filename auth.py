@@ -1,22 +1,19 @@
 import os
-from boto.s3.connection import S3Connection
 import json
-from flask import request, _request_ctx_stack, abort
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from flask import request, _request_ctx_stack, abort, current_app
+from werkzeug.local import LocalProxy
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
+from instrumentation import span
+from ratelimit import rate_limiter
 
-
-'''
-#AUTH0_DOMAIN = S3Connection(os.environ['AUTH0_DOMAIN'])
-#ALGORITHMS = S3Connection(os.environ['ALGORITHMS'])
-#API_AUDIENCE = S3Connection(os.environ['API_AUDIENCE'])
-#print(AUTH0_DOMAIN)
-'''
-
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = os.environ['ALGORITHMS']
-API_AUDIENCE = os.environ['API_AUDIENCE']
+# number of verified tokens remembered, 0 turns the cache off
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
 
 
 ## AuthError Exception
@@ -30,6 +27,194 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## JWKS key store
+
+'''
+JWKSKeyStore
+    an in-process cache of the signing keys published at source
+    (an http(s) URL or a local file, handy for testing offline)
+
+    the key set is refetched once it is older than ttl seconds, or when a
+    token names a kid we have never seen (the issuer may have rotated keys).
+    fetches are rate limited to one per min_refresh_interval seconds, and a
+    failed fetch keeps serving the keys we already have. with background
+    set, an expired key set is refetched by a separate thread (a greenlet
+    under gevent workers) so no request waits on the issuer
+'''
+class JWKSKeyStore:
+    def __init__(self, source, ttl=3600, min_refresh_interval=30, timeout=5, background=False):
+        self.source = source
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.background = background
+        self.keys = {}
+        self.fetched_at = None
+        self.last_attempt = None
+        self.refreshing = None
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'refresh_failures': 0
+        }
+
+    def load(self):
+        if self.source.startswith(('http://', 'https://')):
+            with urlopen(self.source, timeout=self.timeout) as response:
+                jwks = json.loads(response.read())
+        else:
+            path = self.source
+            if path.startswith('file://'):
+                path = path[len('file://'):]
+            with open(path) as f:
+                jwks = json.load(f)
+
+        keys = {}
+        for key in jwks['keys']:
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+        return keys
+
+    def expired(self):
+        return self.fetched_at is None or time.monotonic() - self.fetched_at >= self.ttl
+
+    # a fetch was tried less than min_refresh_interval ago
+    def throttled(self, now):
+        return self.last_attempt is not None and now - self.last_attempt < self.min_refresh_interval
+
+    def refresh(self):
+        # with keys in hand a concurrent caller keeps using them instead of
+        # waiting on the fetch; without any it has to wait
+        if not self.lock.acquire(blocking=not self.keys):
+            return False
+        try:
+            now = time.monotonic()
+            if self.throttled(now):
+                return False
+            self.last_attempt = now
+            try:
+                self.keys = self.load()
+            except Exception:
+                self.stats['refresh_failures'] += 1
+                return False
+            self.fetched_at = now
+            self.stats['refreshes'] += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def refresh_in_background(self):
+        # after a failed fetch the keys stay expired: no thread per request
+        # until the next attempt is due
+        if self.throttled(time.monotonic()):
+            return
+        if self.refreshing is not None and self.refreshing.is_alive():
+            return
+        self.refreshing = threading.Thread(target=self.refresh, daemon=True)
+        self.refreshing.start()
+
+    def get_key(self, kid):
+        fetched = False
+        if self.expired():
+            if self.background and self.keys:
+                self.refresh_in_background()
+            else:
+                fetched = self.refresh()
+        key = self.keys.get(kid)
+        if key is None and not fetched:
+            fetched = self.refresh()
+            key = self.keys.get(kid)
+
+        if key is None or fetched:
+            self.stats['misses'] += 1
+        else:
+            self.stats['hits'] += 1
+        return key
+
+
+# the key store of the current app, see init_app
+jwks_store = LocalProxy(lambda: current_app.extensions['jwks'])
+
+
+'''
+init_app(app)
+    gives app a key store of its own (app.extensions['jwks']), from the
+    JWKS_* settings of app.config, so apps never share keys
+'''
+def init_app(app):
+    app.extensions['jwks'] = JWKSKeyStore(app.config['JWKS_SOURCE'],
+                                          ttl=app.config['JWKS_TTL'],
+                                          min_refresh_interval=app.config['JWKS_MIN_REFRESH_INTERVAL'],
+                                          background=app.config['JWKS_BACKGROUND_REFRESH'])
+
+
+## Verified token cache
+
+'''
+TokenCache
+    a bounded LRU of sha256(token) -> decoded payload, so a bearer token
+    that has been verified once skips signature and claim validation until
+    its exp. each entry also keeps the token's permissions as a frozenset
+    so check_permissions is a set lookup
+'''
+class TokenCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0
+        }
+
+    def digest(self, token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        key = self.digest(token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] <= time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0], entry[1]
+
+    def put(self, token, payload):
+        permissions = frozenset(payload.get('permissions', ()))
+        # without an exp we could not tell when to drop the entry
+        if self.maxsize <= 0 or 'exp' not in payload:
+            return permissions
+
+        key = self.digest(token)
+        with self.lock:
+            self.entries[key] = (payload, permissions, payload['exp'])
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        return permissions
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
+
+
 ## Auth Header
 
 '''
@@ -78,16 +263,18 @@ def get_token_auth_header():
     @INPUTS
         permission: string permission (i.e. 'post:drink')
         payload: decoded jwt payload
+        permissions: optional precomputed set of the payload permissions
 
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
     it should raise an AuthError if the requested permission string is not in the payload permissions array
     return true otherwise
 '''
-def check_permissions(permission, payload):
-    if "permissions" in payload:
-        if permission in payload['permissions']:
-            return True
+def check_permissions(permission, payload, permissions=None):
+    if permissions is None:
+        permissions = frozenset(payload.get('permissions', ()))
+    if permission in permissions:
+        return True
     raise AuthError({
         'success': False,
         'message': 'Permission not found in JWT',
@@ -110,34 +297,25 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen("https://fsnd-coffee-project.auth0.com/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    with span('jwks'):
+        rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
+            with span('jwt_verify'):
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=current_app.config['ALGORITHMS'],
+                    audience=current_app.config['API_AUDIENCE'],
+                    issuer='https://' + current_app.config['AUTH0_DOMAIN'] + '/'
+                )
 
             return payload
 
@@ -169,10 +347,18 @@ def requires_auth(permission=''):
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
             try:
-                payload = verify_decode_jwt(token)
-                check_permissions(permission, payload)
+                cached = token_cache.get(token)
+                if cached is None:
+                    payload = verify_decode_jwt(token)
+                    permissions = token_cache.put(token, payload)
+                else:
+                    payload, permissions = cached
+                # None lets the view check the permissions itself
+                if permission is not None:
+                    check_permissions(permission, payload, permissions)
             except:
                 abort(401)
+            rate_limiter.check(payload, permission)
 
             return f(payload, *args, **kwargs)
 
@@ -0,0 +1,75 @@
+'''
+Microbenchmark for requires_auth with a repeated bearer token.
+
+Runs offline: tokens come from a LocalIssuer whose JWKS is written to a
+temporary file, so only signature verification and claim checks are
+measured. Compares requests/sec with the verified token cache off and on.
+
+    python benchmarks/bench_auth.py --requests 2000
+'''
+import argparse
+import time
+
+from support import configure_env, configure_auth
+
+configure_env()
+issuer = configure_auth()
+
+from flask import Flask, jsonify
+from config import Config
+import auth
+import ratelimit
+
+
+# a bare app with only what requires_auth reads: the auth settings of
+# Config, the key store auth.init_app gives it and a rate limiter that
+# lets every request through
+def build_app():
+    app = Flask(__name__)
+    app.config.from_object(Config(RATE_LIMIT_DEFAULT='0'))
+    auth.init_app(app)
+    ratelimit.init_app(app)
+
+    @app.route('/movies')
+    @auth.requires_auth('get:movies')
+    def get_movies(jwt):
+        return jsonify({'success': True})
+
+    return app
+
+
+def run(client, headers, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        res = client.get('/movies', headers=headers)
+        assert res.status_code == 200, res.status_code
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    app = build_app()
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + issuer.issue_role('casting_assistant')}
+    run(client, headers, 10)
+
+    cache_size = auth.token_cache.maxsize
+    auth.token_cache.maxsize = 0
+    auth.token_cache.clear()
+    before = run(client, headers, args.requests)
+
+    auth.token_cache.maxsize = cache_size
+    after = run(client, headers, args.requests)
+
+    print('requests:            %d' % args.requests)
+    print('without token cache: %.0f req/s' % before)
+    print('with token cache:    %.0f req/s' % after)
+    print('speedup:             %.1fx' % (after / before))
+    print('jwks stats:          %s' % app.extensions['jwks'].stats)
+
+
+if __name__ == '__main__':
+    main()
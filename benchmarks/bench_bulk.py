@@ -0,0 +1,48 @@
+'''
+Throughput of loading actors through single-row POST /actors requests
+versus one POST /actors/bulk request, through the Flask test client.
+
+    python benchmarks/bench_bulk.py --rows 10000
+'''
+import argparse
+import time
+
+from support import configure_env, configure_auth
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    configure_env(args.database_url)
+    issuer = configure_auth()
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + issuer.issue_role('executive_producer')}
+    actors = [{'name': 'Actor %d' % i, 'age': 30, 'gender': 'female'} for i in range(args.rows)]
+
+    start = time.perf_counter()
+    for actor in actors:
+        res = client.post('/actors', headers=headers, json=actor)
+        assert res.status_code == 200, res.status_code
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    res = client.post('/actors/bulk', headers=headers, json={'actors': actors})
+    assert res.status_code == 200, res.status_code
+    bulk = time.perf_counter() - start
+
+    print('rows:        %d' % args.rows)
+    print('single-row:  %.2f s, %.0f rows/s' % (single, args.rows / single))
+    print('bulk:        %.2f s, %.0f rows/s' % (bulk, args.rows / bulk))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+'''
+Benchmark of write latency (insert an actor and report the total) as the
+actors table grows, comparing the old len(Actor.query.all()) total with the
+maintained count in table_stats.
+
+    python benchmarks/bench_counts.py --sizes 1000,10000,100000,1000000
+'''
+import argparse
+import time
+
+from support import configure_env
+
+
+def seed(db, Actor, TableStat, total):
+    have = db.session.query(Actor).count()
+    rows = [{'name': 'Actor %d' % i, 'age': 30, 'gender': 'female'} for i in range(have, total)]
+    for start in range(0, len(rows), 50000):
+        db.session.execute(Actor.__table__.insert(), rows[start:start + 50000])
+    if rows:
+        TableStat.adjust('actors', len(rows))
+    db.session.commit()
+
+
+def timed(write, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        write()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    configure_env(args.database_url)
+    from app import create_app
+    from models import db, Actor, TableStat
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+
+        def old_write():
+            Actor(name='new', age=30, gender='female').insert()
+            return len(Actor.query.all())
+
+        def new_write():
+            Actor(name='new', age=30, gender='female').insert()
+            return Actor.count()
+
+        print('%10s %14s %14s' % ('rows', 'len(all) ms', 'count ms'))
+        for size in [int(size) for size in args.sizes.split(',')]:
+            seed(db, Actor, TableStat, size)
+            # the full scan gets slow quickly, a few rounds are enough
+            old = timed(old_write, max(1, min(args.repeat, 100000 // size)))
+            new = timed(new_write, args.repeat)
+            print('%10d %14.2f %14.2f' % (size, old, new))
+
+
+if __name__ == '__main__':
+    main()
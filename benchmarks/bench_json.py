@@ -0,0 +1,71 @@
+'''
+Benchmark of serializing the movies list, comparing flask.jsonify on
+Movie.format dicts with the serialization backends, and ORM objects with
+result tuples read straight from the query.
+
+    python benchmarks/bench_json.py --rows 100000
+'''
+import argparse
+import datetime
+import time
+
+from support import configure_env
+
+
+def timed(encode, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        size = len(encode())
+    return (time.perf_counter() - start) / repeat * 1000, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    configure_env(args.database_url)
+    import flask
+    import serialization
+    from app import create_app
+    from models import db, Movie, bulk_insert
+
+    app = create_app()
+    with app.app_context(), app.test_request_context():
+        db.create_all()
+        have = Movie.count()
+        if have < args.rows:
+            bulk_insert(Movie, [{'title': 'Movie %d' % i, 'release_date': datetime.date(2020, 1, i % 28 + 1)}
+                                for i in range(have, args.rows)])
+        columns = (Movie.id, Movie.title, Movie.release_date)
+        keys = [column.key for column in columns]
+
+        def encode_orm(dumps):
+            movies = Movie.query.order_by(Movie.id).limit(args.rows).all()
+            return dumps({'success': True, 'movies': [movie.format() for movie in movies]})
+
+        def encode_tuples(dumps):
+            rows = db.session.query(*columns).order_by(Movie.id).limit(args.rows).all()
+            return dumps({'success': True, 'movies': [dict(zip(keys, row)) for row in rows]})
+
+        cases = [
+            ('ORM + flask.jsonify', lambda: encode_orm(lambda data: flask.jsonify(data).get_data())),
+            ('ORM + json', lambda: encode_orm(serialization.json_dumps)),
+            ('tuples + json', lambda: encode_tuples(serialization.json_dumps)),
+        ]
+        if serialization.orjson is not None:
+            cases += [
+                ('ORM + orjson', lambda: encode_orm(serialization.orjson_dumps)),
+                ('tuples + orjson', lambda: encode_tuples(serialization.orjson_dumps)),
+            ]
+
+        print('%-22s %10s %12s' % ('encoding', 'ms', 'bytes'))
+        for name, encode in cases:
+            ms, size = timed(encode, args.repeat)
+            print('%-22s %10.1f %12d' % (name, ms, size))
+
+
+if __name__ == '__main__':
+    main()
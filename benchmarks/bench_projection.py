@@ -0,0 +1,76 @@
+'''
+Benchmark of reading and formatting a page of movies, comparing ORM
+instances (Movie.query ... format()) with the column-projected tuples the
+list endpoints now select: latency, and memory allocated per row as
+measured by tracemalloc.
+
+    python benchmarks/bench_projection.py --rows 100000
+'''
+import argparse
+import datetime
+import gc
+import time
+import tracemalloc
+
+from support import configure_env
+
+
+def measure(read, repeat):
+    gc.collect()
+    tracemalloc.start()
+    read()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        read()
+    return (time.perf_counter() - start) / repeat * 1000, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    configure_env(args.database_url)
+    from app import create_app, MOVIE_FIELDS
+    from models import db, Movie, bulk_insert
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        have = Movie.count()
+        if have < args.rows:
+            bulk_insert(Movie, [{'title': 'Movie %d' % i, 'release_date': datetime.date(2020, 1, i % 28 + 1)}
+                                for i in range(have, args.rows)])
+        columns = [getattr(Movie, name) for name in MOVIE_FIELDS]
+
+        def read_orm():
+            movies = [movie.format() for movie in Movie.query.order_by(Movie.id).limit(args.rows)]
+            db.session.remove()
+            return movies
+
+        def read_columns():
+            rows = Movie.query.with_entities(*columns).order_by(Movie.id).limit(args.rows)
+            movies = [dict(zip(MOVIE_FIELDS, row)) for row in rows]
+            db.session.remove()
+            return movies
+
+        def read_title():
+            rows = Movie.query.with_entities(Movie.title, Movie.id).order_by(Movie.id).limit(args.rows)
+            movies = [dict(zip(('title',), row)) for row in rows]
+            db.session.remove()
+            return movies
+
+        print('%-24s %10s %14s %12s' % ('read', 'ms', 'peak bytes', 'bytes/row'))
+        for name, read in (('ORM objects', read_orm), ('projected columns', read_columns),
+                           ('projected, fields=title', read_title)):
+            ms, peak = measure(read, args.repeat)
+            print('%-24s %10.1f %14d %12d' % (name, ms, peak, peak // args.rows))
+
+
+if __name__ == '__main__':
+    main()
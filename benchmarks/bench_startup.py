@@ -0,0 +1,105 @@
+'''
+Benchmark of worker startup: the time a fresh interpreter takes to import
+app, build the app and answer its first request (what every gunicorn
+worker boot or recycle pays), plus the slowest imports as reported by
+python -X importtime.
+
+    python benchmarks/bench_startup.py --repeat 5 --budget-ms 1500
+'''
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from support import ROOT, configure_auth, configure_env
+
+# runs in the fresh interpreter; prints the time of each step in ms
+STARTUP = '''
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.APP
+created = time.perf_counter()
+response = application.test_client().get('/')
+assert response.status_code == 200, response.status_code
+answered = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_response_ms': (answered - created) * 1000
+}))
+'''
+
+
+def run_startup():
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, '-c', STARTUP], cwd=ROOT)
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    result['total_ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+
+'''
+slowest_imports(count)
+    the modules app imports directly that took longest, including what they
+    imported in turn, in ms. importtime lists a module after its imports,
+    one more level of indentation (two spaces) per level of nesting
+'''
+def slowest_imports(count):
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            cwd=ROOT, stderr=subprocess.PIPE, check=True).stderr.decode()
+    children = []
+    for line in output.splitlines()[1:]:
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if depth == 1:
+            children.append((int(cumulative_us) / 1000, name))
+        elif depth == 0:
+            if name == 'app':
+                return sorted(children, reverse=True)[:count] + [(int(cumulative_us) / 1000, 'app (total)')]
+            children = []
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to list')
+    parser.add_argument('--budget-ms', type=float, help='exit non-zero when the median total exceeds it')
+    parser.add_argument('--database-url')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    configure_env(args.database_url)
+    configure_auth()
+    # the first run also creates the tables
+    subprocess.check_call([sys.executable, '-c', 'import app; from models import db\n'
+                           'with app.APP.app_context(): db.create_all()'], cwd=ROOT)
+
+    runs = [run_startup() for _ in range(args.repeat)]
+    medians = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+    print('%-20s %10s' % ('step (median)', 'ms'))
+    for name in ('import_ms', 'create_app_ms', 'first_response_ms', 'total_ms'):
+        print('%-20s %10.1f' % (name[:-3], medians[name]))
+
+    imports = slowest_imports(args.top)
+    print('\n%-30s %10s' % ('slowest imports', 'ms'))
+    for ms, name in imports:
+        print('%-30s %10.1f' % (name, ms))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'median': medians, 'runs': runs,
+                       'imports': [{'module': name, 'ms': ms} for ms, name in imports]}, f, indent=2)
+
+    if args.budget_ms is not None and medians['total_ms'] > args.budget_ms:
+        print('\nstartup %.1f ms is over the %.1f ms budget' % (medians['total_ms'], args.budget_ms))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''
+Compares throughput of the sync and gevent gunicorn worker classes as the
+number of concurrent clients grows. Starts gunicorn with gunicorn.conf.py
+once per worker class, on the same seeded database, and loads it with the
+harness scenarios over HTTP.
+
+The difference shows when requests wait on I/O, so point --database-url at
+a Postgres server (ideally not on localhost); against the default SQLite
+file queries block the worker and both classes behave alike.
+
+    python benchmarks/bench_workers.py --database-url postgresql://localhost/bench --concurrency 1,10,50
+'''
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from urllib.error import URLError
+from urllib.request import urlopen
+
+from support import ROOT, configure_auth, configure_env
+import harness
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(worker_class, workers, port):
+    env = dict(os.environ,
+               PORT=str(port),
+               WEB_CONCURRENCY=str(workers),
+               GUNICORN_WORKER_CLASS=worker_class,
+               # measure the handlers, not the response cache
+               RESPONSE_CACHE_SIZE='0')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn.app.wsgiapp', '-c', 'gunicorn.conf.py', 'app:APP'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urlopen('http://127.0.0.1:%d/' % port, timeout=1).read()
+            return server
+        except (URLError, ConnectionError):
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn (%s) did not start' % worker_class)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sync vs gevent worker throughput')
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', default='1,10,50', help='comma separated client counts')
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario and client count')
+    parser.add_argument('--only', default='GET /movies/<id>/cast,GET /actors?sort&filter',
+                        help='comma separated harness scenario names')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    configure_env(args.database_url)
+    issuer = configure_auth()
+    from app import create_app
+    import models
+
+    app = create_app()
+    with app.app_context():
+        models.db.create_all()
+        database = models.db.engine.dialect.name
+        seed = harness.seed(models, argparse.Namespace(movies=args.movies, actors=args.actors, cast_size=3), 0)
+        models.db.session.remove()
+        models.dispose_engines()
+
+    names = args.only.split(',')
+    scenarios = [scenario for scenario in harness.SCENARIOS if scenario[0] in names]
+    headers = {'Authorization': 'Bearer ' + issuer.issue_role('executive_producer')}
+
+    results = []
+    print('%-8s %-32s %11s %8s %8s %9s %6s' % ('workers', 'route', 'concurrency', 'p50 ms', 'p99 ms', 'req/s', 'errors'))
+    for worker_class in ('sync', 'gevent'):
+        port = free_port()
+        server = start_server(worker_class, args.workers, port)
+        make_client = lambda: harness.http_client('http://127.0.0.1:%d' % port)
+        try:
+            for name, endpoint, request in scenarios:
+                for concurrency in [int(n) for n in args.concurrency.split(',')]:
+                    run = argparse.Namespace(requests=args.requests, concurrency=concurrency)
+                    result = harness.run_scenario(make_client, request, seed, headers, run)
+                    result.update(worker_class=worker_class, route=name, concurrency=concurrency)
+                    results.append(result)
+                    print('%-8s %-32s %11d %8.2f %8.2f %9.1f %6d' % (
+                        worker_class, name, concurrency, result['p50_ms'], result['p99_ms'],
+                        result['rps'], result['errors']))
+        finally:
+            server.terminate()
+            server.wait()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'database': database, 'workers': args.workers,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
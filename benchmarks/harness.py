@@ -0,0 +1,374 @@
+'''
+Load-test and benchmark harness for every route of create_app.
+
+Seeds a database (a throwaway SQLite file unless --database-url points at
+a local Postgres) with --movies/--actors rows, signs tokens with a local
+stub issuer, then times --requests calls of each scenario and reports
+p50/p95/p99 latency and requests/sec. Requests go through the Flask test
+client, or over HTTP to a running server with --base-url (the server must
+use the same database and JWKS_SOURCE, see --jwks-file).
+
+    python benchmarks/harness.py --movies 10000 --actors 10000 --output results.json
+    python benchmarks/harness.py --compare before.json after.json
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from support import ROOT, configure_auth, configure_env
+
+
+'''
+Seed
+    the ids a run can use: live movies and actors to read and update,
+    spare rows set aside for the delete scenarios (each used once), actors
+    not cast yet for the cast inserts (each used once, as an actor is cast
+    in a movie once), and a job to poll
+'''
+class Seed:
+    def __init__(self, movie_ids, actor_ids, spare_movie_ids, spare_actor_ids, spare_casts, uncast_actor_ids, job_id):
+        self.movie_ids = movie_ids
+        self.actor_ids = actor_ids
+        self.spare_movie_ids = spare_movie_ids
+        self.spare_actor_ids = spare_actor_ids
+        self.spare_casts = spare_casts
+        self.uncast_actor_ids = uncast_actor_ids
+        self.job_id = job_id
+        self.lock = threading.Lock()
+
+    def movie(self):
+        return random.choice(self.movie_ids)
+
+    def actor(self):
+        return random.choice(self.actor_ids)
+
+    def take(self, ids, count=1):
+        with self.lock:
+            taken = ids[-count:]
+            del ids[-count:]
+        return taken
+
+
+def new_movie(i):
+    return {'title': 'Bench movie %d' % i, 'release_date': '2020-01-%02d' % (i % 28 + 1)}
+
+
+def new_actor(i):
+    return {'name': 'Bench actor %d' % i, 'age': 20 + i % 50, 'gender': random.choice(['female', 'male'])}
+
+
+def ndjson(items):
+    return b''.join(json.dumps(item).encode('utf-8') + b'\n' for item in items)
+
+
+# (name, endpoint, request(seed, i) -> (method, path, body)), where body is
+# a JSON value, or bytes sent as they are (the NDJSON of the imports)
+SCENARIOS = [
+    ('GET /', 'get_greeting', lambda s, i: ('GET', '/', None)),
+    ('GET /stats', 'get_stats', lambda s, i: ('GET', '/stats', None)),
+    ('GET /movies', 'get_movies', lambda s, i: ('GET', '/movies', None)),
+    ('GET /movies?sort&filter', 'get_movies',
+     lambda s, i: ('GET', '/movies?title=movie&release_date_from=2020-01-10&sort=-release_date', None)),
+    ('GET /movies?include=cast', 'get_movies', lambda s, i: ('GET', '/movies?include=cast', None)),
+    ('GET /movies?stream=true', 'get_movies', lambda s, i: ('GET', '/movies?stream=true', None)),
+    ('GET /actors', 'get_actors', lambda s, i: ('GET', '/actors', None)),
+    ('GET /actors?sort&filter', 'get_actors',
+     lambda s, i: ('GET', '/actors?age_min=30&age_max=40&sort=age', None)),
+    ('GET /movies/<id>', 'get_movie', lambda s, i: ('GET', '/movies/%d' % s.movie(), None)),
+    ('GET /actors/<id>', 'get_actor', lambda s, i: ('GET', '/actors/%d' % s.actor(), None)),
+    ('GET /metrics', 'get_metrics', lambda s, i: ('GET', '/metrics', None)),
+    ('GET /changes', 'get_changes', lambda s, i: ('GET', '/changes?since=0&limit=100', None)),
+    ('GET /jobs/<id>', 'get_job', lambda s, i: ('GET', '/jobs/%d' % s.job_id, None)),
+    ('GET /movies/<id>/cast', 'get_movie_cast', lambda s, i: ('GET', '/movies/%d/cast' % s.movie(), None)),
+    ('GET /actors/<id>/movies', 'get_actor_movies', lambda s, i: ('GET', '/actors/%d/movies' % s.actor(), None)),
+    ('POST /movies', 'create_movie', lambda s, i: ('POST', '/movies', new_movie(i))),
+    ('POST /actors', 'create_actor', lambda s, i: ('POST', '/actors', new_actor(i))),
+    ('PATCH /movies/<id>', 'update_movie',
+     lambda s, i: ('PATCH', '/movies/%d' % s.movie(), {'title': 'Patched %d' % i})),
+    ('PATCH /actors/<id>', 'update_actor',
+     lambda s, i: ('PATCH', '/actors/%d' % s.actor(), {'age': 20 + i % 50})),
+    ('DELETE /movies/<id>', 'delete_question',
+     lambda s, i: ('DELETE', '/movies/%d' % s.take(s.spare_movie_ids)[0], None)),
+    ('DELETE /actors/<id>', 'delete_actor',
+     lambda s, i: ('DELETE', '/actors/%d' % s.take(s.spare_actor_ids)[0], None)),
+    ('POST /movies/<id>/cast', 'create_movie_cast',
+     lambda s, i: ('POST', '/movies/%d/cast' % s.movie(), {'actor_id': s.take(s.uncast_actor_ids)[0], 'role': 'Extra'})),
+    ('DELETE /movies/<id>/cast/<actor_id>', 'delete_movie_cast',
+     lambda s, i: ('DELETE', '/movies/%d/cast/%d' % s.take(s.spare_casts)[0], None)),
+    ('POST /movies/bulk', 'create_movies_bulk',
+     lambda s, i: ('POST', '/movies/bulk', {'movies': [new_movie(i * 100 + n) for n in range(100)]})),
+    ('POST /actors/bulk', 'create_actors_bulk',
+     lambda s, i: ('POST', '/actors/bulk', {'actors': [new_actor(i * 100 + n) for n in range(100)]})),
+    ('PATCH /movies/bulk', 'update_movies_bulk',
+     lambda s, i: ('PATCH', '/movies/bulk', {'movies': [{'id': s.movie(), 'title': 'Bulk %d' % i} for n in range(100)]})),
+    ('PATCH /actors/bulk', 'update_actors_bulk',
+     lambda s, i: ('PATCH', '/actors/bulk', {'actors': [{'id': s.actor(), 'age': 30} for n in range(100)]})),
+    ('DELETE /movies/bulk', 'delete_movies_bulk',
+     lambda s, i: ('DELETE', '/movies/bulk', {'ids': s.take(s.spare_movie_ids, 10)})),
+    ('DELETE /actors/bulk', 'delete_actors_bulk',
+     lambda s, i: ('DELETE', '/actors/bulk', {'ids': s.take(s.spare_actor_ids, 10)})),
+    ('GET /movies/export', 'export_movies', lambda s, i: ('GET', '/movies/export?format=csv', None)),
+    ('GET /actors/export', 'export_actors', lambda s, i: ('GET', '/actors/export?format=ndjson', None)),
+    ('POST /movies/import', 'import_movies',
+     lambda s, i: ('POST', '/movies/import', ndjson(new_movie(i * 100 + n) for n in range(100)))),
+    ('POST /actors/import', 'import_actors',
+     lambda s, i: ('POST', '/actors/import', ndjson(new_actor(i * 100 + n) for n in range(100)))),
+]
+
+
+'''
+seed(models, args, spares)
+    fills the tables with the requested volumes plus spares rows of each
+    kind for the delete scenarios, casts every movie and queues a job. the
+    spare casts, and the cast inserts, each get actors of their own
+'''
+def seed(models, args, spares):
+    movie_ids = models.bulk_insert(models.Movie, [
+        {'title': 'Movie %d' % i, 'release_date': datetime.date(2020, 1, i % 28 + 1)}
+        for i in range(args.movies + spares)])
+    actor_ids = models.bulk_insert(models.Actor, [new_actor(i) for i in range(args.actors + 3 * spares)])
+    spare_movie_ids, movie_ids = movie_ids[args.movies:], movie_ids[:args.movies]
+    actor_ids, spare_actor_ids, spare_cast_actor_ids, uncast_actor_ids = (
+        actor_ids[:args.actors], actor_ids[args.actors:][:spares],
+        actor_ids[args.actors:][spares:2 * spares], actor_ids[args.actors:][2 * spares:])
+
+    casts = [{'movie_id': movie_id, 'actor_id': actor_id, 'role': 'Lead'}
+             for movie_id in movie_ids for actor_id in random.sample(actor_ids, min(args.cast_size, len(actor_ids)))]
+    spare_casts = [(random.choice(movie_ids), actor_id) for actor_id in spare_cast_actor_ids]
+    casts += [{'movie_id': movie_id, 'actor_id': actor_id, 'role': 'Spare'} for movie_id, actor_id in spare_casts]
+    models.bulk_insert(models.Movie_cast, casts)
+    # queued only, it is never run
+    job = models.Job.submit('recount', {'tables': ['movies']}, None)
+    return Seed(movie_ids, actor_ids, spare_movie_ids, spare_actor_ids, spare_casts, uncast_actor_ids, job.id)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+'''
+http_client(base_url)
+    a callable(method, path, headers, body) -> status sending requests to
+    a running server, matching the test client wrapper below
+'''
+def http_client(base_url):
+    def send(method, path, headers, body):
+        if isinstance(body, bytes):
+            data, content_type = body, 'application/x-ndjson'
+        else:
+            data = json.dumps(body).encode('utf-8') if body is not None else None
+            content_type = 'application/json'
+        request = Request(base_url.rstrip('/') + path, data=data, method=method, headers=dict(headers))
+        if data is not None:
+            request.add_header('Content-Type', content_type)
+        try:
+            with urlopen(request) as response:
+                response.read()
+                return response.status
+        except HTTPError as e:
+            return e.code
+    return send
+
+
+def test_client(app):
+    client = app.test_client()
+
+    def send(method, path, headers, body):
+        if isinstance(body, bytes):
+            response = client.open(path, method=method, headers=headers, data=body,
+                                   content_type='application/x-ndjson')
+        else:
+            response = client.open(path, method=method, headers=headers, json=body)
+        response.get_data()
+        return response.status_code
+    return send
+
+
+'''
+run_scenario(make_client, request, seed, headers, args)
+    sends args.requests requests from args.concurrency threads, each with
+    its own client, and returns latency percentiles (ms) and throughput
+'''
+def run_scenario(make_client, request, seed, headers, args):
+    latencies = []
+    errors = []
+    counter = iter(range(args.requests))
+    counter_lock = threading.Lock()
+
+    def worker():
+        send = make_client()
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            method, path, body = request(seed, i)
+            start = time.perf_counter()
+            status = send(method, path, headers, body)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if status >= 400:
+                errors.append(status)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(args.concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'rps': round(len(latencies) / elapsed, 1)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+'''
+compare(before, after, threshold)
+    prints the change of every route common to two result files and
+    returns the routes whose p95 or rps regressed by more than threshold
+'''
+def compare(before, after, threshold):
+    regressions = []
+    print('%-40s %10s %10s %8s %10s %10s %8s' % ('route', 'p95 before', 'p95 after', 'change',
+                                              'rps before', 'rps after', 'change'))
+    for name, old in before['routes'].items():
+        new = after['routes'].get(name)
+        if new is None:
+            continue
+        p95_change = (new['p95_ms'] - old['p95_ms']) / old['p95_ms'] if old['p95_ms'] else 0
+        rps_change = (new['rps'] - old['rps']) / old['rps'] if old['rps'] else 0
+        flag = ''
+        if p95_change > threshold or rps_change < -threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-40s %10.2f %10.2f %+7.0f%% %10.1f %10.1f %+7.0f%%%s' % (
+            name, old['p95_ms'], new['p95_ms'], p95_change * 100,
+            old['rps'], new['rps'], rps_change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--base-url', help='benchmark a running server instead of the test client')
+    parser.add_argument('--jwks-file', help='where to write the stub issuer key set (for --base-url)')
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--cast-size', type=int, default=3, help='actors cast in each movie')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--only', help='comma separated substrings of scenario names to run')
+    parser.add_argument('--no-response-cache', action='store_true', help='time list reads without the response cache')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files and exit')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        sys.exit(1 if compare(before, after, args.threshold) else 0)
+
+    configure_env(args.database_url)
+    issuer = configure_auth()
+    if args.jwks_file:
+        issuer.write_jwks(args.jwks_file)
+        os.environ['JWKS_SOURCE'] = args.jwks_file
+
+    from app import create_app
+    import models
+    import cache
+
+    app = create_app()
+    if args.no_response_cache:
+        cache.response_cache.backend = cache.LRUBackend(0)
+
+    scenarios = SCENARIOS
+    if args.only:
+        names = args.only.split(',')
+        scenarios = [scenario for scenario in SCENARIOS if any(name in scenario[0] for name in names)]
+    covered = set(endpoint for _, endpoint, _ in SCENARIOS)
+    missing = sorted(rule.endpoint for rule in app.url_map.iter_rules()
+                     if rule.endpoint != 'static' and rule.endpoint not in covered)
+    if missing:
+        print('no scenario for: %s' % ', '.join(missing))
+
+    # every delete scenario consumes one spare row (ten for bulk) per request
+    spares = (args.requests + args.warmup) * 11
+    with app.app_context():
+        models.db.create_all()
+        started = time.perf_counter()
+        seed_ids = seed(models, args, spares)
+        print('seeded %d movies, %d actors in %.1f s' % (
+            args.movies, args.actors, time.perf_counter() - started))
+
+    if args.base_url:
+        make_client = lambda: http_client(args.base_url)
+    else:
+        make_client = lambda: test_client(app)
+    headers = {'Authorization': 'Bearer ' + issuer.issue_role('executive_producer')}
+
+    results = {}
+    print('%-40s %8s %8s %8s %8s %9s %6s' % ('route', 'p50 ms', 'p95 ms', 'p99 ms', 'mean ms', 'req/s', 'errors'))
+    for name, endpoint, request in scenarios:
+        send = make_client()
+        for i in range(args.warmup):
+            method, path, body = request(seed_ids, -i - 1)
+            send(method, path, headers, body)
+        result = run_scenario(make_client, request, seed_ids, headers, args)
+        result['endpoint'] = endpoint
+        results[name] = result
+        print('%-40s %8.2f %8.2f %8.2f %8.2f %9.1f %6d' % (
+            name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['mean_ms'], result['rps'], result['errors']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'commit': git_commit(),
+                    'date': datetime.datetime.utcnow().isoformat() + 'Z',
+                    'python': platform.python_version(),
+                    'database': models.db.engine.dialect.name,
+                    'target': args.base_url or 'test client',
+                    'movies': args.movies,
+                    'actors': args.actors,
+                    'cast_size': args.cast_size,
+                    'requests': args.requests,
+                    'concurrency': args.concurrency,
+                    'response_cache': not args.no_response_cache,
+                    'uncovered_endpoints': missing
+                },
+                'routes': results
+            }, f, indent=2)
+        print('results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+'''
+Shared setup for the benchmark scripts: puts the repository on sys.path
+and fills in the environment the app modules read at import time, pointing
+the database at database_url (a throwaway SQLite file by default).
+'''
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def configure_env(database_url=None):
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('database_name', 'movie_actor')
+    os.environ.setdefault('database_path', database_url)
+    os.environ.setdefault('AUTH0_DOMAIN', 'bench.local')
+    os.environ.setdefault('API_AUDIENCE', 'movie_project')
+    os.environ.setdefault('ALGORITHMS', 'RS256')
+    os.environ.setdefault('EXCITED', 'false')
+    # a benchmark is one client hammering the app, which the limits would refuse
+    os.environ.setdefault('RATE_LIMIT_DEFAULT', '0')
+    os.environ.setdefault('LIST_CONCURRENCY', '0')
+    os.environ.setdefault('BULK_CONCURRENCY', '0')
+    return database_url
+
+
+'''
+configure_auth()
+    generates a local signing key, points JWKS_SOURCE at its key set and
+    returns the LocalIssuer to sign tokens with. call before importing app
+'''
+def configure_auth():
+    from local_issuer import LocalIssuer
+
+    issuer = LocalIssuer()
+    os.environ['JWKS_SOURCE'] = issuer.write_jwks(os.path.join(tempfile.mkdtemp(), 'jwks.json'))
+    return issuer
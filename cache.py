@@ -0,0 +1,321 @@
+import os
+import hashlib
+import importlib
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from urllib.parse import urlencode
+from flask import request, make_response, Response
+
+# entries kept by the in-process backend
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+# seconds an entry is served; bounds how stale a worker can get when
+# another worker (with its own in-process cache) writes
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 30))
+# optional 'module.Class' of a shared CacheBackend to use instead
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND')
+
+# records kept by the single-row object cache, the seconds each is served
+# (bounding how stale a worker can get when another one writes) and an
+# optional shared backend
+OBJECT_CACHE_SIZE = int(os.environ.get('OBJECT_CACHE_SIZE', 10000))
+OBJECT_CACHE_TTL = int(os.environ.get('OBJECT_CACHE_TTL', 300))
+OBJECT_CACHE_BACKEND = os.environ.get('OBJECT_CACHE_BACKEND')
+
+
+'''
+CacheBackend
+    the store behind ResponseCache. keys are strings, values are opaque.
+    implement these methods to plug in a cache shared between workers
+'''
+class CacheBackend(ABC):
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def set(self, key, value, ttl=None):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+
+'''
+LRUBackend
+    the default in-process backend, a bounded LRU with per-entry expiry
+'''
+class LRUBackend(CacheBackend):
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0
+        }
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def load_backend(path):
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+'''
+ResponseCache
+    caches the body of successful list responses per table, keyed by
+    endpoint and query string. every key embeds the table's generation, a
+    random token replaced on each write to the table, which invalidates
+    exactly that table's entries on any backend. a generation that was
+    evicted simply starts a new one
+'''
+class ResponseCache:
+    def __init__(self, backend, ttl=30, versions=None):
+        self.backend = backend
+        self.ttl = ttl
+        # optional callable(table_names) -> [(version, updated_at), ...],
+        # see validators
+        self.versions = versions
+
+    def generation(self, table_name):
+        generation = self.backend.get('generation:' + table_name)
+        if generation is None:
+            generation = self.invalidate(table_name)
+        return generation
+
+    def key(self, table_names, endpoint, args):
+        generations = ','.join(self.generation(table_name) for table_name in table_names)
+        query = urlencode(sorted(args.items(multi=True)))
+        return '%s:%s:%s?%s' % ('+'.join(table_names), generations, endpoint, query)
+
+    def invalidate(self, table_name):
+        generation = os.urandom(6).hex()
+        self.backend.set('generation:' + table_name, generation)
+        return generation
+
+    # change listener for models.commit_change
+    def on_change(self, table_name, action, row_ids):
+        self.invalidate(table_name)
+
+    '''
+    validators(table_names, endpoint, args)
+        a weak ETag and the Last-Modified time of the response, from the
+        versions of the tables it is built from, so they are known before
+        (and without) building or hashing the body. None when there is no
+        versions source
+    '''
+    def validators(self, table_names, endpoint, args):
+        if self.versions is None:
+            return None
+        versions = self.versions(table_names)
+        query = urlencode(sorted(args.items(multi=True)))
+        tag = '%s?%s|%s' % (endpoint, query, ','.join(str(version) for version, _ in versions))
+        etag = hashlib.md5(tag.encode('utf-8')).hexdigest()
+        updated = [updated_at for _, updated_at in versions]
+        last_modified = settled(max(updated)) if None not in updated else None
+        return etag, last_modified
+
+    '''
+    cached(table_name, includes=())
+        decorator for a GET view listing table_name. answers 304 straight
+        away when the request's If-None-Match (or else If-Modified-Since)
+        matches the current validators, serves the cached body when there is
+        one, and caches 200 responses it did not have. responses to
+        ?include= also depend on the tables in includes
+    '''
+    def cached(self, table_name, includes=()):
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                table_names = (table_name,)
+                if 'include' in request.args:
+                    table_names += tuple(includes)
+                key = self.key(table_names, request.endpoint, request.args)
+                validators = self.validators(table_names, request.endpoint, request.args)
+                if validators is not None and not_modified(*validators):
+                    return with_validators(Response(status=304), validators)
+
+                entry = self.backend.get(key)
+                # an entry from before a write made by another worker has an
+                # older etag, and is rebuilt
+                if entry is not None and (validators is None or entry[1] == validators[0]):
+                    body, etag, mimetype = entry
+                    if request.if_none_match.contains(etag):
+                        response = Response(status=304)
+                    else:
+                        response = Response(body, mimetype=mimetype)
+                    if validators is not None:
+                        with_validators(response, validators)
+                    else:
+                        response.set_etag(etag)
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if response.is_streamed:
+                    return with_validators(response, validators) if validators else response
+                body = response.get_data()
+                if validators is not None:
+                    etag = validators[0]
+                    with_validators(response, validators)
+                else:
+                    etag = hashlib.md5(body).hexdigest()
+                    response.set_etag(etag)
+                self.backend.set(key, (body, etag, response.mimetype), self.ttl)
+
+                response.headers['X-Cache'] = 'MISS'
+                return response.make_conditional(request)
+
+            return wrapper
+        return cached_decorator
+
+
+'''
+settled(updated_at)
+    updated_at (UTC) to the second, as HTTP dates go, once that second is
+    over, else None: a write later within the same second would have the
+    same Last-Modified, and a client polling with If-Modified-Since would
+    miss it
+'''
+def settled(updated_at):
+    second = updated_at.replace(microsecond=0)
+    if datetime.utcnow() < second + timedelta(seconds=1):
+        return None
+    return second
+
+
+def not_modified(etag, last_modified):
+    # If-None-Match takes precedence over If-Modified-Since (RFC 7232)
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def with_validators(response, validators):
+    etag, last_modified = validators
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+'''
+ObjectCache
+    a read-through cache of single formatted records, keyed by table and
+    id. a miss loads the record and keeps it; a change to the row (through
+    commit_change) drops it. a load that raced with a change is not kept,
+    so a stale record cannot be put back after its invalidation
+'''
+class ObjectCache:
+    def __init__(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        # changes seen, to spot loads that overlapped one
+        self.changes = 0
+        self.lock = threading.Lock()
+        self.counts = {
+            'hits': 0,
+            'misses': 0
+        }
+
+    def key(self, table_name, id):
+        return 'object:%s:%s' % (table_name, id)
+
+    '''
+    get(table_name, id, load)
+        the cached record of row id, or else load() (None when there is no
+        such row, which is not cached)
+    '''
+    def get(self, table_name, id, load):
+        key = self.key(table_name, id)
+        record = self.backend.get(key)
+        if record is not None:
+            self.count('hits')
+            return record
+
+        self.count('misses')
+        changes = self.changes
+        record = load()
+        if record is not None and changes == self.changes:
+            self.backend.set(key, record, self.ttl)
+        return record
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    # change listener for models.commit_change
+    def on_change(self, table_name, action, row_ids):
+        with self.lock:
+            self.changes += 1
+        if row_ids is None:
+            # too many rows to list; new rows are not cached yet anyway
+            if action != 'insert':
+                self.backend.clear()
+            return
+        if action != 'insert':
+            for id in row_ids:
+                self.backend.delete(self.key(table_name, id))
+
+    @property
+    def stats(self):
+        lookups = self.counts['hits'] + self.counts['misses']
+        stats = dict(self.counts, hit_ratio=round(self.counts['hits'] / lookups, 4) if lookups else None)
+        backend_stats = getattr(self.backend, 'stats', None)
+        if backend_stats is not None:
+            stats['evictions'] = backend_stats['evictions']
+        return stats
+
+
+if RESPONSE_CACHE_BACKEND:
+    response_cache = ResponseCache(load_backend(RESPONSE_CACHE_BACKEND), RESPONSE_CACHE_TTL)
+else:
+    response_cache = ResponseCache(LRUBackend(RESPONSE_CACHE_SIZE), RESPONSE_CACHE_TTL)
+
+if OBJECT_CACHE_BACKEND:
+    object_cache = ObjectCache(load_backend(OBJECT_CACHE_BACKEND), OBJECT_CACHE_TTL)
+else:
+    object_cache = ObjectCache(LRUBackend(OBJECT_CACHE_SIZE), OBJECT_CACHE_TTL)
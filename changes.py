@@ -0,0 +1,193 @@
+import time
+import queue
+import logging
+import threading
+from flask import current_app
+from werkzeug.local import LocalProxy
+from models import db, Change, add_change_listener
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Subscriber
+    one client of the feed: the events published since it subscribed, up
+    to a bounded queue. a subscriber that falls that far behind is dropped
+    (it gets None) and reconnects from its last event id
+'''
+class Subscriber:
+    def __init__(self, maxsize):
+        self.events = queue.Queue(maxsize)
+        self.dropped = False
+        self.start = None
+
+    def put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.dropped = True
+
+    def get(self, timeout):
+        if self.dropped:
+            return None
+        return self.events.get(timeout=timeout)
+
+
+'''
+ChangeFeed
+    follows the change log for every client of a process: a single thread
+    polls it for entries past the last one seen, with one short query per
+    poll_interval however many clients there are, and publishes them to
+    each subscriber. it runs while there are subscribers, and a commit made
+    in this process wakes it at once. on Postgres a seq can become visible
+    after a later one (transactions commit out of order), so seqs skipped
+    over are looked for again for gap_timeout seconds
+'''
+class ChangeFeed:
+    def __init__(self, app=None, poll_interval=1.0, queue_size=1000, batch_size=500, gap_timeout=10):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.gap_timeout = gap_timeout
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.last_seq = None
+        # seq -> time it was first missed
+        self.gaps = {}
+        self.stats = {
+            'polls': 0,
+            'published': 0,
+            'dropped': 0
+        }
+
+    '''
+    subscribe()
+        a new Subscriber, receiving the entries after its start seq. starts
+        the polling thread if it is not running
+    '''
+    def subscribe(self):
+        subscriber = Subscriber(self.queue_size)
+        with self.lock:
+            if self.thread is None:
+                self.last_seq = latest_seq()
+                self.gaps = {}
+            # the entries up to here are the subscriber's to read from the log
+            subscriber.start = self.last_seq
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='change-feed', daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            if subscriber.dropped:
+                self.stats['dropped'] += 1
+        self.wake.set()
+
+    # change listener for models.commit_change
+    def on_change(self, table_name, action, row_ids):
+        self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    return
+            try:
+                with self.app.app_context():
+                    self.poll()
+            except Exception:
+                logger.exception('polling the change log failed')
+
+    def poll(self):
+        self.stats['polls'] += 1
+        query = Change.query.filter(Change.seq > self.last_seq)
+        if self.gaps:
+            query = Change.query.filter((Change.seq > self.last_seq) | Change.seq.in_(list(self.gaps)))
+        entries = [entry.format() for entry in query.order_by(Change.seq).limit(self.batch_size)]
+        db.session.remove()
+
+        now = time.monotonic()
+        for entry in entries:
+            seq = entry['seq']
+            if seq > self.last_seq:
+                for missing in range(self.last_seq + 1, seq):
+                    self.gaps[missing] = now
+                self.last_seq = seq
+            else:
+                self.gaps.pop(seq, None)
+            self.publish(entry)
+        for seq, missed_at in list(self.gaps.items()):
+            if now - missed_at > self.gap_timeout:
+                del self.gaps[seq]
+        # a full batch means there are more
+        if len(entries) == self.batch_size:
+            self.wake.set()
+
+    def publish(self, entry):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(entry)
+        self.stats['published'] += 1
+
+
+def latest_seq():
+    return db.session.query(db.func.max(Change.seq)).scalar() or 0
+
+
+'''
+changes_since(seq, limit, until=None)
+    the change log entries after seq (up to until), oldest first
+'''
+def changes_since(seq, limit, until=None):
+    query = Change.query.filter(Change.seq > seq)
+    if until is not None:
+        query = query.filter(Change.seq <= until)
+    return [entry.format() for entry in query.order_by(Change.seq).limit(limit)]
+
+
+'''
+streams_allowed(setting)
+    whether this worker may serve change streams, given CHANGE_STREAMS:
+    'true', 'false', or 'auto' for only when gevent patched the sockets.
+    a sync worker serves one request at a time, so each stream would hold
+    the whole worker until gunicorn's timeout kills it
+'''
+def streams_allowed(setting):
+    if setting != 'auto':
+        return setting == 'true'
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def format_event(entry):
+    return b'id: %d\nevent: %s\ndata: %s\n\n' % (entry['seq'], entry['action'].encode('ascii'), dumps(entry))
+
+
+# the change feed of the current app, see init_app
+change_feed = LocalProxy(lambda: current_app.extensions['change_feed'])
+
+
+'''
+init_app(app)
+    gives app a change feed of its own (app.extensions['change_feed'])
+    with the CHANGE_* settings of app.config, woken by the commits made
+    in this process
+'''
+def init_app(app):
+    feed = app.extensions['change_feed'] = ChangeFeed(app, poll_interval=app.config['CHANGE_POLL_INTERVAL'],
+                                                      queue_size=app.config['CHANGE_QUEUE_SIZE'])
+    add_change_listener(feed.on_change)
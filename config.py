@@ -0,0 +1,95 @@
+import os
+
+
+'''
+Config
+    the settings of the app, read from environ (os.environ by default) when
+    it is created, not when the modules are imported. create_app(config)
+    loads them into app.config, so they are looked up there at request time.
+    settings can also be passed as keyword arguments, e.g. in tests
+'''
+class Config:
+    # settings without a sensible default, checked by validate
+    REQUIRED = ('DATABASE_URL', 'AUTH0_DOMAIN', 'ALGORITHMS', 'API_AUDIENCE')
+
+    def __init__(self, environ=None, **overrides):
+        if environ is None:
+            environ = os.environ
+        self.DATABASE_URL = environ.get('DATABASE_URL')
+        self.AUTH0_DOMAIN = environ.get('AUTH0_DOMAIN')
+        self.ALGORITHMS = environ.get('ALGORITHMS')
+        self.API_AUDIENCE = environ.get('API_AUDIENCE')
+        self.EXCITED = environ.get('EXCITED', 'false') == 'true'
+
+        # optional read replicas (comma separated URLs) serving the reads of GET requests
+        self.REPLICA_URLS = [url.strip() for url in environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+        # seconds between two health checks of a replica
+        self.REPLICA_CHECK_INTERVAL = int(environ.get('REPLICA_CHECK_INTERVAL', 10))
+        # replicas further behind the primary (seconds) are not read from, 0 allows any lag
+        self.REPLICA_MAX_LAG = float(environ.get('REPLICA_MAX_LAG', 5))
+        # seconds a client that wrote keeps reading from the primary
+        self.READ_YOUR_WRITES_SECONDS = int(environ.get('READ_YOUR_WRITES_SECONDS', 5))
+
+        # where the signing keys are published, either a URL or a local file path
+        self.JWKS_SOURCE = environ.get('JWKS_SOURCE')
+        if self.JWKS_SOURCE is None and self.AUTH0_DOMAIN:
+            self.JWKS_SOURCE = 'https://' + self.AUTH0_DOMAIN + '/.well-known/jwks.json'
+        # seconds a fetched key set is used before it is refreshed
+        self.JWKS_TTL = int(environ.get('JWKS_TTL', 3600))
+        # minimum seconds between two fetches, whatever triggered them
+        self.JWKS_MIN_REFRESH_INTERVAL = int(environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+        # refetch an expired key set in the background while requests keep
+        # using the old one, instead of making the request that noticed wait
+        self.JWKS_BACKGROUND_REFRESH = environ.get('JWKS_BACKGROUND_REFRESH', 'true') == 'true'
+
+        # page size of the list endpoints when no limit is given, and its upper bound
+        self.PAGE_SIZE = int(environ.get('PAGE_SIZE', 100))
+        self.MAX_PAGE_SIZE = int(environ.get('MAX_PAGE_SIZE', 1000))
+        # rows fetched per round-trip from the server-side cursor when streaming
+        self.STREAM_BATCH_SIZE = int(environ.get('STREAM_BATCH_SIZE', 500))
+        # most items accepted by one bulk request
+        self.MAX_BULK_SIZE = int(environ.get('MAX_BULK_SIZE', 10000))
+
+        # seconds between two reads of the change log by the change feed
+        # (a write in the same worker is published at once)
+        self.CHANGE_POLL_INTERVAL = float(environ.get('CHANGE_POLL_INTERVAL', 1))
+        # events a change feed client may fall behind by before it is dropped
+        self.CHANGE_QUEUE_SIZE = int(environ.get('CHANGE_QUEUE_SIZE', 1000))
+        # seconds between two keepalive comments on an idle change stream
+        self.CHANGE_KEEPALIVE = float(environ.get('CHANGE_KEEPALIVE', 15))
+        # change streams a worker serves at once, 0 for no cap
+        self.CHANGE_MAX_SUBSCRIBERS = int(environ.get('CHANGE_MAX_SUBSCRIBERS', 1000))
+        # serve change streams: 'auto' only under gevent workers, or 'true'/'false'
+        self.CHANGE_STREAMS = environ.get('CHANGE_STREAMS', 'auto')
+
+        # threads running background jobs in each web worker; 0 leaves the
+        # jobs to dedicated `manage.py run_jobs` processes
+        self.JOB_WORKERS = int(environ.get('JOB_WORKERS', 2))
+        # seconds between two looks for queued jobs (a job submitted in the
+        # same process is taken at once)
+        self.JOB_POLL_INTERVAL = float(environ.get('JOB_POLL_INTERVAL', 1))
+        # running jobs whose process has not been heard from for this many seconds are failed
+        self.JOB_STALE_SECONDS = int(environ.get('JOB_STALE_SECONDS', 60))
+        # least seconds between two progress updates of a job
+        self.JOB_PROGRESS_INTERVAL = float(environ.get('JOB_PROGRESS_INTERVAL', 1))
+
+        # requests each token subject may make with a permission, as
+        # 'requests/seconds'; 0 requests turns the limit off
+        self.RATE_LIMIT_DEFAULT = environ.get('RATE_LIMIT_DEFAULT', '600/60')
+        # per-permission overrides, e.g. 'get:movies=300/60,post:movies=30/60'
+        self.RATE_LIMITS = environ.get('RATE_LIMITS', '')
+        # optional 'module.Class' of a shared ratelimit.RateLimitBackend
+        self.RATE_LIMIT_BACKEND = environ.get('RATE_LIMIT_BACKEND')
+        # list requests (and bulk writes) a worker serves at once, so heavy
+        # readers leave connections for writers; 0 turns the cap off
+        self.LIST_CONCURRENCY = int(environ.get('LIST_CONCURRENCY', 8))
+        self.BULK_CONCURRENCY = int(environ.get('BULK_CONCURRENCY', 2))
+
+        for name, value in overrides.items():
+            setattr(self, name, value)
+
+    def validate(self):
+        missing = [name for name in self.REQUIRED if not getattr(self, name)]
+        if missing:
+            raise RuntimeError('missing configuration: %s (set them in the environment)' % ', '.join(missing))
+        return self
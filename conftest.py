@@ -0,0 +1,238 @@
+'''
+Test harness for test_app.py: every test process gets its own database
+and signing key, the app is built once per process, and each test runs in
+a transaction rolled back when it ends. Nothing leaves the machine and
+nothing is left behind, so the suite runs in parallel with pytest-xdist:
+
+    python -m pytest -n auto
+
+The database is a SQLite file per process, or a schema per process of
+TEST_DATABASE_URL (e.g. postgresql:///movie_test) when it is set.
+'''
+import os
+import shutil
+import tempfile
+import time
+from datetime import date
+
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine.url import make_url
+
+from local_issuer import LocalIssuer, ROLE_PERMISSIONS
+
+# set by pytest-xdist in each of its workers
+WORKER = os.environ.get('PYTEST_XDIST_WORKER', 'main')
+
+# rows of each table the tests start from
+SEED_ROWS = 10
+
+timings = {}
+
+
+'''
+worker_database_url(base, directory)
+    the database of this process: a SQLite file in directory, or for a
+    server base URL the same database with the schema test_<worker> first
+    on the search path
+'''
+def worker_database_url(base, directory):
+    if base is None:
+        return 'sqlite:///' + os.path.join(directory, 'movies-%s.db' % WORKER)
+    url = make_url(base)
+    url.query = dict(url.query, options='-csearch_path=test_' + WORKER)
+    return str(url)
+
+
+def reset_schema(base, drop_only=False):
+    if base is None:
+        return
+    engine = create_engine(base)
+    with engine.connect() as connection:
+        connection.execute(text('DROP SCHEMA IF EXISTS test_%s CASCADE' % WORKER))
+        if not drop_only:
+            connection.execute(text('CREATE SCHEMA test_%s' % WORKER))
+    engine.dispose()
+
+
+'''
+pytest_configure(config)
+    points the app at this process's database and a local signing key
+    before test_app.py is imported: Auth0 and the DATABASE_URL of the
+    environment are never used. the role tokens are put in the environment
+    where the tests read them
+'''
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'commits: runs without the rollback transaction, for tests '
+                                       'whose writes other connections or threads must see')
+    config.tmpdir_path = tempfile.mkdtemp(prefix='movie-tests-')
+    os.environ['DATABASE_URL'] = worker_database_url(os.environ.get('TEST_DATABASE_URL'), config.tmpdir_path)
+    os.environ.setdefault('AUTH0_DOMAIN', 'tests.local')
+    os.environ.setdefault('API_AUDIENCE', 'movie_project')
+    os.environ['ALGORITHMS'] = 'RS256'
+    # a statement repeated per row within a request fails the request, in every test
+    os.environ['QUERY_CHECKS'] = 'strict'
+    # a smaller key than production's, generated in a fraction of the time
+    issuer = LocalIssuer(bits=1024)
+    os.environ['JWKS_SOURCE'] = issuer.write_jwks(os.path.join(config.tmpdir_path, 'jwks.json'))
+    for role in ROLE_PERMISSIONS:
+        os.environ[role] = issuer.issue_role(role, expires_in=24 * 3600)
+    timings['started'] = time.perf_counter()
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(config.tmpdir_path, ignore_errors=True)
+
+
+def seed(db):
+    from models import Movie, Actor, Movie_cast
+
+    movies = [Movie(title='Movie %d' % i, release_date=date(2000 + i, 1, 1)) for i in range(1, SEED_ROWS + 1)]
+    actors = [Actor(name='Actor %d' % i, age=20 + i, gender='female' if i % 2 else 'male')
+              for i in range(1, SEED_ROWS + 1)]
+    db.session.add_all(movies + actors)
+    db.session.flush()
+    db.session.add_all([Movie_cast(movie_id=movies[-1].id, actor_id=actor.id, role='Lead') for actor in actors[-2:]])
+    db.session.commit()
+
+
+'''
+reseed(db)
+    empties every table and seeds it again, with the ids starting over,
+    undoing what a test committed
+'''
+def reseed(db):
+    tables = db.metadata.sorted_tables
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('TRUNCATE %s RESTART IDENTITY CASCADE' % ', '.join(table.name for table in tables)))
+    else:
+        for table in reversed(tables):
+            db.session.execute(table.delete())
+    db.session.commit()
+    seed(db)
+    db.session.remove()
+
+
+'''
+app()
+    the app every test of the process uses, with a freshly created and
+    seeded database
+'''
+@pytest.fixture(scope='session')
+def app():
+    started = time.perf_counter()
+    from app import create_app
+    from models import db, dispose_engines
+
+    reset_schema(os.environ.get('TEST_DATABASE_URL'))
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed(db)
+        db.session.remove()
+    timings['app'] = time.perf_counter() - started
+    yield app
+
+    db.session.remove()
+    dispose_engines()
+    reset_schema(os.environ.get('TEST_DATABASE_URL'), drop_only=True)
+
+
+'''
+bind_app(request, app)
+    sets the session app as the app of a unittest class, with
+    @pytest.mark.usefixtures('bind_app')
+'''
+@pytest.fixture(scope='class')
+def bind_app(request, app):
+    request.cls.app = app
+
+
+def clear_caches(app):
+    import ratelimit
+    from cache import response_cache, object_cache
+
+    # entries of the rolled back writes of the last test
+    response_cache.backend.clear()
+    object_cache.backend.clear()
+    ratelimit.init_app(app)
+
+
+# lets the job runner and change feed threads of a test finish (those of
+# the apps it built included), so they never use the sessions of the next one
+def join_threads():
+    from models import apps
+
+    for app in apps:
+        for runner in (app.extensions['job_runner'], app.extensions['change_feed']):
+            thread = runner.thread
+            if thread is not None:
+                runner.wake.set()
+                thread.join(10)
+
+
+# the sessions of a test begin in a SAVEPOINT, begun again after every
+# commit or rollback of the app, which so never ends the test transaction
+def begin_savepoint(session, transaction, connection):
+    if transaction.parent is None:
+        session.begin_nested()
+
+
+def restart_savepoint(session, transaction):
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+'''
+database(request, app)
+    runs each test in a transaction rolled back when it ends, with the
+    sessions of db bound to its connection, and empty caches. tests marked
+    commits run without it, and the database is seeded again after them
+'''
+@pytest.fixture(autouse=True)
+def database(request, app):
+    from models import db
+
+    # tests building an app of their own rebind db to it
+    db.app = app
+    clear_caches(app)
+    if request.node.get_closest_marker('commits'):
+        yield
+        join_threads()
+        db.session.remove()
+        db.app = app
+        with app.app_context():
+            reseed(db)
+        return
+
+    session = db.session
+    connection = db.get_engine(app).connect()
+    sqlite = connection.dialect.name == 'sqlite'
+    if sqlite:
+        # pysqlite begins transactions itself, and not before a SAVEPOINT
+        connection.connection.connection.isolation_level = None
+    connection.begin()
+    if sqlite:
+        connection.execute(text('BEGIN'))
+    db.session = db.create_scoped_session({'bind': connection, 'binds': {}})
+    event.listen(db.session, 'after_begin', begin_savepoint)
+    event.listen(db.session, 'after_transaction_end', restart_savepoint)
+    try:
+        yield
+    finally:
+        db.session.remove()
+        db.session = session
+        # rolls back the test transaction
+        connection.close()
+
+
+def pytest_terminal_summary(terminalreporter):
+    wall_clock = time.perf_counter() - timings['started']
+    durations = sum(report.duration for reports in terminalreporter.stats.values()
+                    for report in reports if hasattr(report, 'duration'))
+    terminalreporter.write_sep('-', 'timing')
+    terminalreporter.write_line('suite wall-clock %.2f s, %.2f s in tests (%.1fx)%s' % (
+        wall_clock, durations, durations / wall_clock if wall_clock else 0,
+        ', app and database built in %.2f s' % timings['app'] if 'app' in timings else ''))
@@ -0,0 +1,32 @@
+import os
+import sys
+
+# gunicorn settings, read by `gunicorn -c gunicorn.conf.py app:APP`.
+# the worker count comes from WEB_CONCURRENCY, which gunicorn reads itself
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+# import the app once in the master and fork it, for faster worker boots
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'false') == 'true'
+# 'sync' serves one request per worker at a time. 'gevent' serves up to
+# worker_connections per worker, switching between them whenever one waits
+# on the database or the network
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+
+def post_fork(server, worker):
+    # psycopg2 talks to postgres in C, so gevent cannot switch away while a
+    # query waits unless psycopg2 is told to call back into it
+    if worker_class == 'gevent':
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            pass  # no psycopg2, e.g. running against a local SQLite file
+        else:
+            patch_psycopg()
+
+    # with preload_app the master may already hold pooled connections; the
+    # worker drops them so it never shares a socket with another process
+    models = sys.modules.get('models')
+    if models is not None:
+        models.dispose_engines()
@@ -0,0 +1,179 @@
+import os
+import time
+import random
+import cProfile
+import tempfile
+import threading
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# fraction of requests (0 to 1) profiled with cProfile, 0 turns it off
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+# where the sampled profiles are written, one .prof file per request
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'movie-api-profiles'))
+
+# upper bounds (seconds) of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+'''
+instrumentation
+    per-route timings of each request, split into phases: jwks (fetching
+    signing keys), jwt_verify (checking the token signature and claims),
+    sql (time in the database driver), serialize (encoding the JSON body)
+    and other (everything else, mostly ORM hydration and view code). query
+    counts are kept per route too, and all of it is rendered in the
+    Prometheus text format by Metrics.render
+'''
+
+
+'''
+span(phase)
+    context manager adding the time spent inside it to phase of the current
+    request. does nothing outside a request
+'''
+@contextmanager
+def span(phase):
+    if not has_request_context() or 'phases' not in g:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.phases[phase] = g.phases.get(phase, 0) + time.perf_counter() - start
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is None or not has_request_context() or 'phases' not in g:
+        return
+    g.phases['sql'] = g.phases.get('sql', 0) + time.perf_counter() - context.query_started
+    g.queries += 1
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(**values):
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in values.items())
+
+
+'''
+Metrics
+    thread-safe totals of the requests seen by this process: counts by
+    route, method and status, a duration histogram, the seconds spent in
+    each phase and the number of SQL queries, per route
+'''
+class Metrics:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.phases = {}
+        self.queries = {}
+
+    def observe(self, route, method, status, duration, phases, queries):
+        with self.lock:
+            key = (route, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            histogram = self.durations.setdefault((route, method), [0] * len(self.buckets) + [0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += duration
+
+            for phase, seconds in phases.items():
+                summary = self.phases.setdefault((route, phase), [0, 0.0])
+                summary[0] += 1
+                summary[1] += seconds
+            self.queries[route] = self.queries.get(route, 0) + queries
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.append('# HELP http_requests_total Requests handled, by route, method and status.')
+            lines.append('# TYPE http_requests_total counter')
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append('http_requests_total%s %d' % (labels(route=route, method=method, status=status), count))
+
+            lines.append('# HELP http_request_duration_seconds Time to build the response.')
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            for (route, method), histogram in sorted(self.durations.items()):
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append('http_request_duration_seconds_bucket%s %d' % (
+                        labels(route=route, method=method, le=bound), count))
+                lines.append('http_request_duration_seconds_bucket%s %d' % (
+                    labels(route=route, method=method, le='+Inf'), histogram[-2]))
+                lines.append('http_request_duration_seconds_sum%s %.6f' % (labels(route=route, method=method), histogram[-1]))
+                lines.append('http_request_duration_seconds_count%s %d' % (labels(route=route, method=method), histogram[-2]))
+
+            lines.append('# HELP http_request_phase_seconds Time spent in each phase of the request.')
+            lines.append('# TYPE http_request_phase_seconds summary')
+            for (route, phase), (count, seconds) in sorted(self.phases.items()):
+                lines.append('http_request_phase_seconds_sum%s %.6f' % (labels(route=route, phase=phase), seconds))
+                lines.append('http_request_phase_seconds_count%s %d' % (labels(route=route, phase=phase), count))
+
+            lines.append('# HELP db_queries_total SQL statements executed, by route.')
+            lines.append('# TYPE db_queries_total counter')
+            for route, count in sorted(self.queries.items()):
+                lines.append('db_queries_total%s %d' % (labels(route=route), count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def start_request():
+    g.request_started = time.perf_counter()
+    g.phases = {}
+    g.queries = 0
+    g.profile = None
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is already running in this process
+            return
+        g.profile = profile
+
+
+def finish_request(response):
+    if 'request_started' not in g:
+        return response
+    duration = time.perf_counter() - g.request_started
+    phases = g.phases
+    phases['other'] = max(0.0, duration - sum(phases.values()))
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe(route, request.method, response.status_code, duration, phases, g.queries)
+
+    if g.profile is not None:
+        g.profile.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        g.profile.dump_stats(os.path.join(PROFILE_DIR, '%s-%d-%d.prof' % (
+            request.endpoint or 'unmatched', time.time() * 1000, os.getpid())))
+    return response
+
+
+'''
+init_app(app)
+    hooks the instrumentation into app. call it first in create_app, so the
+    timing starts before and ends after the other request hooks
+'''
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
@@ -0,0 +1,234 @@
+import os
+import time
+import socket
+import signal
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import exc
+from werkzeug.local import LocalProxy
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+# job types by name, as (function, permission)
+JOB_TYPES = {}
+
+
+'''
+job_type(name, permission=None)
+    registers the decorated function(job, **args) as the job type name,
+    where job is a JobContext and args the arguments it was submitted with.
+    permission is what reading the job takes (None when it is submitted
+    from manage.py only). the function returns the result of the job, a
+    JSON value
+'''
+def job_type(name, permission=None):
+    def register(f):
+        JOB_TYPES[name] = (f, permission)
+        return f
+    return register
+
+
+'''
+JobContext
+    what a running job sees of itself: progress(done, total=None) records
+    how far it got, at most every progress_interval seconds. progress is
+    written on its own connection, outside the transaction of the job
+'''
+class JobContext:
+    def __init__(self, id, progress_interval=1.0):
+        self.id = id
+        self.progress_interval = progress_interval
+        self.done = 0
+        self.total = None
+        self.reported_at = time.monotonic()
+
+    def progress(self, done, total=None):
+        self.done = done
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        if now - self.reported_at < self.progress_interval:
+            return
+        self.reported_at = now
+        jobs = Job.__table__
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(jobs.update().where(jobs.c.id == self.id).values(
+                    progress=self.done, total=self.total, heartbeat_at=datetime.utcnow()))
+        except exc.DBAPIError as e:
+            # e.g. SQLite, locked by the job's own transaction
+            logger.warning('could not record the progress of job %d: %s', self.id, e.orig)
+
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+'''
+JobRunner
+    runs the queued jobs of the jobs table on a pool of worker threads. a
+    dispatcher thread claims jobs while a thread is free, polling the table
+    every poll_interval seconds (a job submitted in this process is claimed
+    at once). it keeps the heartbeat of its running jobs, and fails those
+    of any process not heard from for stale_after seconds. in the web
+    process it stops when there is nothing left to run; manage.py run_jobs
+    runs it for good
+'''
+class JobRunner:
+    def __init__(self, app=None, workers=2, poll_interval=1.0, stale_after=60, progress_interval=1.0):
+        self.app = app
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.progress_interval = progress_interval
+        self.executor = None
+        self.thread = None
+        self.stopping = False
+        # ids of the jobs running in this process
+        self.running = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stats = {
+            'done': 0,
+            'failed': 0
+        }
+
+    '''
+    submit(name, args=None, start=True, file=None)
+        queues a job of the registered type, returning its Job. file is a
+        binary stream stored with the job (see JobFile). with start, the
+        runner of this process is started to take it, unless it has no
+        workers (JOB_WORKERS=0) and leaves the jobs to manage.py run_jobs
+    '''
+    def submit(self, name, args=None, start=True, file=None):
+        function, permission = JOB_TYPES[name]
+        job = Job.submit(name, args or {}, permission, file)
+        if start:
+            self.start()
+        return job
+
+    def start(self):
+        if self.workers <= 0:
+            return
+        with self.lock:
+            self.wake.set()
+            if self.thread is None:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='job')
+                self.thread = threading.Thread(target=self.run, name='job-runner', daemon=True)
+                self.thread.start()
+
+    def run(self, forever=False):
+        while not self.stopping:
+            claimed = 0
+            try:
+                with self.app.app_context():
+                    claimed = self.dispatch()
+            except Exception:
+                logger.exception('dispatching jobs failed')
+            with self.lock:
+                # a job submitted meanwhile sets wake
+                if not forever and not self.running and not claimed and not self.wake.is_set():
+                    self.thread = None
+                    return
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
+
+    def dispatch(self):
+        try:
+            with self.lock:
+                running = list(self.running)
+            Job.heartbeat(running)
+            Job.fail_stale(datetime.utcnow() - timedelta(seconds=self.stale_after))
+            claimed = 0
+            while len(self.running) < self.workers and not self.stopping:
+                job = Job.claim(worker_name())
+                if job is None:
+                    break
+                with self.lock:
+                    self.running.add(job.id)
+                self.executor.submit(self.execute, job.id, job.type, job.args)
+                claimed += 1
+            return claimed
+        finally:
+            db.session.remove()
+
+    def execute(self, job_id, name, args):
+        outcome = 'failed'
+        try:
+            with self.app.app_context():
+                outcome = self.call(job_id, name, args)
+        except Exception:
+            logger.exception('recording the end of job %d failed', job_id)
+        finally:
+            with self.lock:
+                self.running.discard(job_id)
+                self.stats[outcome] += 1
+            self.wake.set()
+
+    def call(self, job_id, name, args):
+        job = JobContext(job_id, self.progress_interval)
+        try:
+            if name not in JOB_TYPES:
+                raise ValueError('unknown job type %r' % name)
+            function, permission = JOB_TYPES[name]
+            result = function(job, **args)
+        except Exception as e:
+            db.session.rollback()
+            logger.exception('job %d (%s) failed', job_id, name)
+            Job.finish(job_id, 'failed', error=str(e) or type(e).__name__, progress=job.done, total=job.total)
+            return 'failed'
+        else:
+            Job.finish(job_id, 'done', result=result, progress=job.done, total=job.total)
+            return 'done'
+        finally:
+            db.session.remove()
+
+    '''
+    serve(workers)
+        runs jobs with workers threads until SIGTERM or Ctrl-C, then lets
+        the running jobs finish
+    '''
+    def serve(self, workers):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='job')
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        logger.info('running jobs with %d threads as %s', workers, worker_name())
+        # a thread of its own, outside the request context manage.py commands run in
+        self.thread = threading.Thread(target=self.run, args=(True,), name='job-runner')
+        self.thread.start()
+        try:
+            while self.thread.is_alive():
+                self.thread.join(1)
+        except KeyboardInterrupt:
+            self.stop()
+            self.thread.join()
+        logger.info('waiting for %d running jobs', len(self.running))
+        self.executor.shutdown(wait=True)
+
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+
+    def state(self):
+        return dict(self.stats, running=len(self.running), workers=self.workers)
+
+
+# the job runner of the current app, see init_app
+job_runner = LocalProxy(lambda: current_app.extensions['job_runner'])
+
+
+'''
+init_app(app)
+    gives app a job runner of its own (app.extensions['job_runner']) with
+    the JOB_* settings of app.config
+'''
+def init_app(app):
+    app.extensions['job_runner'] = JobRunner(app, workers=app.config['JOB_WORKERS'],
+                                             poll_interval=app.config['JOB_POLL_INTERVAL'],
+                                             stale_after=app.config['JOB_STALE_SECONDS'],
+                                             progress_interval=app.config['JOB_PROGRESS_INTERVAL'])
@@ -0,0 +1,76 @@
+import base64
+import json
+import os
+import time
+import rsa
+from jose import jwt
+
+
+'''
+local_issuer
+    a stand-in for Auth0 when working offline (tests, benchmarks).
+    it generates an RSA key, publishes it as a JWKS file and signs tokens
+    the API accepts once JWKS_SOURCE points at that file
+'''
+
+ROLE_PERMISSIONS = {
+    'casting_assistant': [
+        'get:actors', 'get:movies'
+    ],
+    'casting_director': [
+        'delete:actors', 'get:actors', 'get:movies',
+        'patch:actors', 'patch:movies', 'post:actors'
+    ],
+    'executive_producer': [
+        'delete:actors', 'delete:movies', 'get:actors', 'get:movies',
+        'patch:actors', 'patch:movies', 'post:actors', 'post:movies'
+    ]
+}
+
+
+def b64_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class LocalIssuer:
+    def __init__(self, domain=None, audience=None, kid='local-key', bits=2048):
+        self.domain = domain or os.environ['AUTH0_DOMAIN']
+        self.audience = audience or os.environ['API_AUDIENCE']
+        self.kid = kid
+        self.public_key, self.private_key = rsa.newkeys(bits)
+        self.private_pem = self.private_key.save_pkcs1().decode('ascii')
+
+    def jwks(self):
+        return {
+            'keys': [{
+                'kty': 'RSA',
+                'kid': self.kid,
+                'use': 'sig',
+                'alg': 'RS256',
+                'n': b64_uint(self.public_key.n),
+                'e': b64_uint(self.public_key.e)
+            }]
+        }
+
+    def write_jwks(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.jwks(), f)
+        return path
+
+    def issue(self, permissions, sub='local|tester', expires_in=3600):
+        now = int(time.time())
+        claims = {
+            'iss': 'https://' + self.domain + '/',
+            'sub': sub,
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def issue_role(self, role, **kwargs):
+        kwargs.setdefault('sub', 'local|' + role)
+        return self.issue(ROLE_PERMISSIONS[role], **kwargs)
@@ -1,14 +1,122 @@
+import os
+import sys
+import logging
+from datetime import datetime, timedelta
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import APP
-from models import db
+from app import APP, MOVIE_EXPORT_FIELDS, ACTOR_EXPORT_FIELDS, validate_movie, validate_actor
+from models import db, Movie, Actor, Change, COUNTED_TABLES
+import transfer
+import jobs
+from jobs import job_runner
+from transfer import FORMATS, TransferError
 
 migrate = Migrate(APP, db)
 manager = Manager(APP)
 
 manager.add_command('db', MigrateCommand)
 
+# the row counts and rates of imports and exports, on stderr
+logging.basicConfig(format='%(message)s')
+transfer.logger.setLevel(logging.INFO)
+jobs.logger.setLevel(logging.INFO)
+
+# the tables import_data and export_data work on
+TABLES = {
+    'movies': (Movie, MOVIE_EXPORT_FIELDS, validate_movie),
+    'actors': (Actor, ACTOR_EXPORT_FIELDS, validate_actor)
+}
+
+
+def file_format(path, fmt):
+    if fmt is None:
+        fmt = os.path.splitext(path)[1].lstrip('.') or 'ndjson'
+    if fmt not in FORMATS:
+        sys.exit('unknown format %r, use one of %s' % (fmt, ', '.join(sorted(FORMATS))))
+    return fmt
+
+
+'''
+import_data(table, path, fmt=None)
+    python manage.py import_data movies movies.csv
+    loads a CSV or NDJSON file (- for stdin) into table, all or nothing
+'''
+@manager.option('-f', '--format', dest='fmt', choices=sorted(FORMATS), help='defaults to the file extension')
+@manager.option('path', help='file to read, - for stdin')
+@manager.option('table', choices=sorted(TABLES))
+def import_data(table, path, fmt=None):
+    model, fields, validate = TABLES[table]
+    fmt = file_format(path, fmt)
+    file = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    try:
+        transfer.import_rows(model, file, fmt, validate)
+    except TransferError as e:
+        sys.exit('%s: %s' % (path, e))
+    finally:
+        if file is not sys.stdin.buffer:
+            file.close()
+
+
+'''
+export_data(table, path, fmt=None)
+    python manage.py export_data actors actors.ndjson
+    writes every row of table to a CSV or NDJSON file (- for stdout), with
+    COPY for CSV on postgres
+'''
+@manager.option('-f', '--format', dest='fmt', choices=sorted(FORMATS), help='defaults to the file extension')
+@manager.option('path', help='file to write, - for stdout')
+@manager.option('table', choices=sorted(TABLES))
+def export_data(table, path, fmt=None):
+    model, fields, validate = TABLES[table]
+    fmt = file_format(path, fmt)
+    file = sys.stdout.buffer if path == '-' else open(path, 'wb')
+    try:
+        if fmt == 'csv' and transfer.is_postgres():
+            transfer.copy_export(model, fields, file)
+        else:
+            for chunk in transfer.export_rows(model, fields, fmt):
+                file.write(chunk)
+    finally:
+        if file is not sys.stdout.buffer:
+            file.close()
+
+
+'''
+prune_changes(days=7)
+    python manage.py prune_changes --days 7
+    deletes the change log entries older than days; clients further behind
+    than that reload the lists instead of catching up from GET /changes
+'''
+@manager.option('-d', '--days', dest='days', type=int, default=7, help='days of changes to keep')
+def prune_changes(days=7):
+    count = Change.prune(datetime.utcnow() - timedelta(days=days))
+    print('deleted %d changes older than %d days' % (count, days))
+
+
+
+'''
+run_jobs(threads=2)
+    python manage.py run_jobs --threads 4
+    runs queued background jobs until stopped (SIGTERM lets the running
+    ones finish first). start as many as needed, next to web workers
+    with JOB_WORKERS=0
+'''
+@manager.option('-t', '--threads', dest='threads', type=int, default=2, help='jobs run at once')
+def run_jobs(threads=2):
+    job_runner.serve(threads)
+
+
+'''
+recount_tables(tables=None)
+    python manage.py recount_tables -t movies
+    queues a job reading the row counts of table_stats (of every counted
+    table by default) again from count(*)
+'''
+@manager.option('-t', '--table', dest='tables', action='append', choices=COUNTED_TABLES, help='may be repeated')
+def recount_tables(tables=None):
+    job = job_runner.submit('recount', {'tables': tables or list(COUNTED_TABLES)}, start=False)
+    print('queued job %d' % job.id)
 
 if __name__ == '__main__':
     manager.run()
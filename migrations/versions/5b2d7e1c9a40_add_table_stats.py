@@ -0,0 +1,31 @@
+"""add table_stats
+
+Revision ID: 5b2d7e1c9a40
+Revises: 09e9ad544e47
+Create Date: 2026-10-18 09:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2d7e1c9a40'
+down_revision = '09e9ad544e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('table_stats',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('row_count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    # seed the counts of the rows already there
+    op.execute("INSERT INTO table_stats (table_name, row_count) SELECT 'movies', count(*) FROM movies")
+    op.execute("INSERT INTO table_stats (table_name, row_count) SELECT 'actors', count(*) FROM actors")
+
+
+def downgrade():
+    op.drop_table('table_stats')
@@ -0,0 +1,40 @@
+"""add movie_cast
+
+Revision ID: 8c41f0d2b7e3
+Revises: 5b2d7e1c9a40
+Create Date: 2026-10-18 10:03:55.180342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c41f0d2b7e3'
+down_revision = '5b2d7e1c9a40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('movie_cast',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.Column('role', sa.String(length=120), nullable=True),
+    sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('movie_id', 'actor_id', name='uq_movie_cast_movie_id_actor_id')
+    )
+    op.create_index(op.f('ix_movie_cast_actor_id'), 'movie_cast', ['actor_id'], unique=False)
+    op.create_index(op.f('ix_movie_cast_movie_id'), 'movie_cast', ['movie_id'], unique=False)
+    # its stats row, so the first cast changes update it rather than race to insert it
+    op.execute("INSERT INTO table_stats (table_name, row_count) VALUES ('movie_cast', 0)")
+
+
+def downgrade():
+    op.execute("DELETE FROM table_stats WHERE table_name = 'movie_cast'")
+    op.drop_index(op.f('ix_movie_cast_movie_id'), table_name='movie_cast')
+    op.drop_index(op.f('ix_movie_cast_actor_id'), table_name='movie_cast')
+    op.drop_table('movie_cast')
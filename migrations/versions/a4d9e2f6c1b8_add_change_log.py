@@ -0,0 +1,33 @@
+"""add change_log
+
+Revision ID: a4d9e2f6c1b8
+Revises: f1c7d3e8a2b6
+Create Date: 2026-10-18 18:36:05.417392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d9e2f6c1b8'
+down_revision = 'f1c7d3e8a2b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('change_log',
+    sa.Column('seq', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('action', sa.String(), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('seq')
+    )
+    op.create_index(op.f('ix_change_log_created_at'), 'change_log', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_change_log_created_at'), table_name='change_log')
+    op.drop_table('change_log')
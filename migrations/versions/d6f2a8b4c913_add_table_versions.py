@@ -0,0 +1,26 @@
+"""add version and updated_at to table_stats
+
+Revision ID: d6f2a8b4c913
+Revises: b3e9a7c5d218
+Create Date: 2026-10-18 15:47:09.583214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd6f2a8b4c913'
+down_revision = 'b3e9a7c5d218'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('table_stats', sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('table_stats', sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('table_stats', 'updated_at')
+    op.drop_column('table_stats', 'version')
@@ -0,0 +1,30 @@
+"""add job files
+
+Revision ID: e2b8c4f6a1d7
+Revises: c7e1b5d9a3f2
+Create Date: 2026-10-18 23:41:07.516392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b8c4f6a1d7'
+down_revision = 'c7e1b5d9a3f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job_files',
+    sa.Column('job_id', sa.Integer(), nullable=False),
+    sa.Column('seq', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['job_id'], ['jobs.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('job_id', 'seq')
+    )
+
+
+def downgrade():
+    op.drop_table('job_files')
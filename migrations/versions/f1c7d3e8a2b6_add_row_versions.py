@@ -0,0 +1,26 @@
+"""add version to movies and actors
+
+Revision ID: f1c7d3e8a2b6
+Revises: d6f2a8b4c913
+Create Date: 2026-10-18 17:12:40.218731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c7d3e8a2b6'
+down_revision = 'd6f2a8b4c913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('movies', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('actors', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('actors', 'version')
+    op.drop_column('movies', 'version')
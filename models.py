@@ -1,39 +1,671 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import io
+import logging
+import time
+from datetime import datetime
+from sqlalchemy import Column, String, Integer, BigInteger, DateTime, Text, JSON, LargeBinary, ForeignKey, create_engine, func, event, DDL, exc, bindparam, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+import sqlite3
 import json
-from env_var import find_key
+import query_checks
+import replicas
+from replicas import RoutingSQLAlchemy
 
-database_name = os.environ['database_name']
-database_path = os.environ['database_path']
-database_url = os.environ['DATABASE_URL']
+# rows per statement in the bulk helpers
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+# bytes per row of the files stored for jobs (see JobFile)
+JOB_FILE_PART_SIZE = int(os.environ.get('JOB_FILE_PART_SIZE', 1 << 20))
 
-db = SQLAlchemy()
+# connection pool of each worker (not used for SQLite)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+# seconds to wait for a connection before giving up
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+# seconds after which a connection is replaced, below the server's idle timeout
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# test connections with a round-trip before handing them out
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true') == 'true'
+# a checkout waiting longer than this (ms) is logged with the pool stats
+DB_POOL_WAIT_LOG_MS = float(os.environ.get('DB_POOL_WAIT_LOG_MS', 100))
+
+logger = logging.getLogger(__name__)
+
+# reads of GET requests may go to a replica, see replicas.py
+db = RoutingSQLAlchemy()
+# applications bound by setup_db, whose engines dispose_engines resets
+apps = []
 
 '''
-setup_db(app)
-    binds a flask application and a SQLAlchemy service
+setup_db(app, database_path=None)
+    binds a flask application and a SQLAlchemy service, to database_path
+    or else the app's DATABASE_URL, with the app's REPLICA_URLS for reads
 '''
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+def setup_db(app, database_path=None):
+    database_path = database_path or app.config['DATABASE_URL']
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
+    replicas.init_app(app, engine_options)
+    query_checks.init_app(app)
+    if app not in apps:
+        apps.append(app)
     # uncomment the below line first run
     #db.create_all()
 
+
+def engine_options(url):
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {}
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+
+
+'''
+TimedQueuePool
+    a QueuePool that also records how long checkouts wait for a
+    connection (including opening a new one), logging the slow ones
+'''
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = {
+            'checkouts': 0,
+            'wait_total_ms': 0.0,
+            'wait_max_ms': 0.0,
+            'timeouts': 0
+        }
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.wait_stats = self.wait_stats
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.wait_stats['timeouts'] += 1
+            raise
+        finally:
+            waited = (time.perf_counter() - start) * 1000
+            self.wait_stats['checkouts'] += 1
+            self.wait_stats['wait_total_ms'] += waited
+            self.wait_stats['wait_max_ms'] = max(self.wait_stats['wait_max_ms'], waited)
+            if waited > DB_POOL_WAIT_LOG_MS:
+                logger.warning('waited %.0f ms for a database connection: %s', waited, pool_stats(self))
+
+
+def pool_stats(pool):
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': pool.overflow()
+        })
+    stats.update(getattr(pool, 'wait_stats', {}))
+    return stats
+
+
+'''
+dispose_engines()
+    drops the pooled connections of every bound application. a forked
+    worker calls it (see gunicorn.conf.py) so it never shares the sockets
+    its parent opened
+'''
+def dispose_engines():
+    for app in apps:
+        db.get_engine(app).dispose()
+        if 'replicas' in app.extensions:
+            app.extensions['replicas'].dispose()
+
+
+# remember which process opened each connection
+@event.listens_for(QueuePool, 'connect')
+def record_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+# and never hand one out in another process, should a fork have copied it
+@event.listens_for(QueuePool, 'checkout')
+def check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection record belongs to pid %s, attempting to check out in pid %s'
+            % (connection_record.info['pid'], pid))
+
+
+# the title and name search indexes use trigrams on postgres
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+
+# SQLite leaves foreign keys (and so ON DELETE CASCADE) off by default
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+# tables whose row count is kept in table_stats
+COUNTED_TABLES = ('movies', 'actors')
+
+'''
+TableStat
+    the row count of a table, kept up to date by commit_change in the same
+    transaction as the inserts and deletes, so totals never scan the table.
+    version and updated_at change with every committed write to the table,
+    giving cheap validators (ETag, Last-Modified) for responses built from it
+'''
+class TableStat(db.Model):
+    __tablename__ = 'table_stats'
+    table_name = Column(String, primary_key=True)
+    row_count = Column(Integer, nullable=False, default=0)
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+    updated_at = Column(DateTime)
+
+    '''
+    adjust(table_name, delta)
+        adds delta to the row count and bumps the version within the current
+        transaction. a table without a stats row yet is seeded from count(*),
+        after the change
+    '''
+    @classmethod
+    def adjust(cls, table_name, delta):
+        now = datetime.utcnow()
+        updated = cls.query.filter_by(table_name=table_name).update(
+            {cls.row_count: cls.row_count + delta, cls.version: cls.version + 1, cls.updated_at: now},
+            synchronize_session=False)
+        if not updated:
+            db.session.add(cls(table_name=table_name, row_count=count_rows(table_name),
+                               version=1, updated_at=now))
+
+    '''
+    recount(table_name)
+        sets the row count from count(*), in one statement so writes
+        committed meanwhile are not lost, e.g. after rows were changed
+        outside the app
+    '''
+    @classmethod
+    def recount(cls, table_name):
+        table = db.metadata.tables[table_name]
+        row_count = select([func.count()]).select_from(table).as_scalar()
+        updated = cls.query.filter_by(table_name=table_name).update(
+            {cls.row_count: row_count, cls.version: cls.version + 1, cls.updated_at: datetime.utcnow()},
+            synchronize_session=False)
+        if not updated:
+            cls.adjust(table_name, 0)
+        db.session.commit()
+
+    @classmethod
+    def count(cls, table_name):
+        stat = cls.query.get(table_name)
+        if stat is None or table_name not in COUNTED_TABLES:
+            return count_rows(table_name)
+        return stat.row_count
+
+    '''
+    versions(table_names)
+        the (version, updated_at) of each table, in order, from one query.
+        a table never written since table_stats was created is (0, None)
+    '''
+    @classmethod
+    def versions(cls, table_names):
+        rows = db.session.query(cls.table_name, cls.version, cls.updated_at).filter(
+            cls.table_name.in_(table_names)).all()
+        found = {row.table_name: (row.version, row.updated_at) for row in rows}
+        return [found.get(table_name, (0, None)) for table_name in table_names]
+
+
+'''
+Change
+    the change log: one entry per row inserted, updated or deleted, written
+    by commit_change in the same transaction as the change. seq orders the
+    entries; the change feed (changes.py) follows it. row_id is None for
+    changes too large to list (imports)
+'''
+class Change(db.Model):
+    __tablename__ = 'change_log'
+    seq = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    table_name = Column(String, nullable=False)
+    action = Column(String, nullable=False)
+    row_id = Column(Integer)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+    @classmethod
+    def record(cls, table_name, action, row_ids):
+        now = datetime.utcnow()
+        if row_ids is None:
+            row_ids = [None]
+        for chunk in chunks(list(row_ids)):
+            db.session.execute(cls.__table__.insert().execution_options(batched=True), [
+                {'table_name': table_name, 'action': action, 'row_id': row_id, 'created_at': now}
+                for row_id in chunk])
+
+    '''
+    prune(before)
+        deletes the entries older than before (a UTC datetime), returning
+        how many there were
+    '''
+    @classmethod
+    def prune(cls, before):
+        deleted = cls.query.filter(cls.created_at < before).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+    def format(self):
+        return {
+            'seq': self.seq,
+            'table': self.table_name,
+            'action': self.action,
+            'id': self.row_id,
+            'created_at': self.created_at
+        }
+
+
+'''
+Job
+    a background job (see jobs.py): its type and arguments, then the state
+    it is in ('queued', 'running', 'done' or 'failed'), how far it got
+    (progress out of total, in units of the job's choosing) and its result
+    or error. worker and heartbeat_at tell which process runs it and when
+    that process last showed it was alive
+'''
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True)
+    type = Column(String, nullable=False)
+    args = Column(JSON, nullable=False)
+    # what reading the job takes, None for jobs submitted from manage.py
+    permission = Column(String)
+    state = Column(String, nullable=False, index=True)
+    progress = Column(BigInteger, nullable=False, default=0)
+    total = Column(BigInteger)
+    result = Column(JSON)
+    error = Column(Text)
+    worker = Column(String)
+    created_at = Column(DateTime, nullable=False)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+
+    '''
+    submit(type, args, permission, file=None)
+        queues a job. the binary stream file, when given, is stored for the
+        job to read (see JobFile) in the same transaction, so no worker can
+        claim the job before all of it is there
+    '''
+    @classmethod
+    def submit(cls, type, args, permission, file=None):
+        job = cls(type=type, args=args, permission=permission, state='queued', progress=0,
+                  created_at=datetime.utcnow())
+        db.session.add(job)
+        if file is not None:
+            db.session.flush()
+            JobFile.write(job.id, file)
+        db.session.commit()
+        return job
+
+    '''
+    claim(worker)
+        takes the oldest queued job for worker, or returns None when there
+        is none. the job is only taken if it is still queued, so two
+        workers claiming at once never get the same one
+    '''
+    @classmethod
+    def claim(cls, worker):
+        while True:
+            job_id = db.session.query(cls.id).filter(cls.state == 'queued').order_by(cls.id).limit(1).scalar()
+            if job_id is None:
+                db.session.commit()
+                return None
+            now = datetime.utcnow()
+            claimed = cls.query.filter(cls.id == job_id, cls.state == 'queued').update(
+                {cls.state: 'running', cls.worker: worker, cls.started_at: now, cls.heartbeat_at: now},
+                synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return cls.query.get(job_id)
+
+    @classmethod
+    def heartbeat(cls, job_ids):
+        if job_ids:
+            cls.query.filter(cls.id.in_(job_ids), cls.state == 'running').update(
+                {cls.heartbeat_at: datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+
+    '''
+    fail_stale(before)
+        fails the running jobs whose worker has not been heard from since
+        before (a UTC datetime), e.g. because its process was killed,
+        returning how many there were
+    '''
+    @classmethod
+    def fail_stale(cls, before):
+        failed = cls.query.filter(cls.state == 'running', cls.heartbeat_at < before).update(
+            {cls.state: 'failed', cls.error: 'the worker running the job stopped', cls.finished_at: datetime.utcnow()},
+            synchronize_session=False)
+        if failed:
+            JobFile.discard_finished()
+        db.session.commit()
+        if failed:
+            logger.warning('failed %d jobs whose worker stopped', failed)
+        return failed
+
+    '''
+    finish(job_id, state, **values)
+        records the end of a running job, in state 'done' or 'failed'
+        with the other columns in values, dropping its file
+    '''
+    @classmethod
+    def finish(cls, job_id, state, **values):
+        values = {getattr(cls, name): value for name, value in values.items()}
+        values.update({cls.state: state, cls.finished_at: datetime.utcnow()})
+        cls.query.filter(cls.id == job_id, cls.state == 'running').update(values, synchronize_session=False)
+        JobFile.query.filter(JobFile.job_id == job_id).delete(synchronize_session=False)
+        db.session.commit()
+
+    def format(self):
+        return {
+            'id': self.id,
+            'type': self.type,
+            'state': self.state,
+            'progress': self.progress,
+            'total': self.total,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+
+'''
+JobFile
+    a part of the file a job reads (the upload of a background import),
+    kept in the database rather than on the disk of the web worker, so the
+    job worker of any host can read it. the parts go once the job ends
+'''
+class JobFile(db.Model):
+    __tablename__ = 'job_files'
+    job_id = Column(Integer, ForeignKey('jobs.id', ondelete='CASCADE'), primary_key=True)
+    seq = Column(Integer, primary_key=True, autoincrement=False)
+    data = Column(LargeBinary, nullable=False)
+
+    '''
+    write(job_id, file)
+        stores the binary stream file as the file of job_id, read and
+        written JOB_FILE_PART_SIZE bytes at a time
+    '''
+    @classmethod
+    def write(cls, job_id, file):
+        # one statement per part, not per row
+        insert = cls.__table__.insert().execution_options(batched=True)
+        seq = 0
+        while True:
+            data = file.read(JOB_FILE_PART_SIZE)
+            if not data:
+                return
+            db.session.execute(insert, {'job_id': job_id, 'seq': seq, 'data': data})
+            seq += 1
+
+    '''
+    open(job_id)
+        the file of job_id as a buffered binary stream, reading one part
+        from the database at a time
+    '''
+    @classmethod
+    def open(cls, job_id):
+        return io.BufferedReader(JobFileReader(job_id))
+
+    @classmethod
+    def size(cls, job_id):
+        return db.session.query(func.coalesce(func.sum(func.length(cls.data)), 0)).filter(
+            cls.job_id == job_id).scalar()
+
+    # the parts of jobs failed by fail_stale
+    @classmethod
+    def discard_finished(cls):
+        finished = db.session.query(Job.id).filter(Job.state.in_(('done', 'failed')))
+        cls.query.filter(cls.job_id.in_(finished.subquery())).delete(synchronize_session=False)
+
+
+class JobFileReader(io.RawIOBase):
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.seq = 0
+        self.part = b''
+        self.offset = 0
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset >= len(self.part):
+            part = db.session.query(JobFile.data).filter(
+                JobFile.job_id == self.job_id, JobFile.seq == self.seq).scalar()
+            if part is None:
+                return 0
+            self.part, self.offset, self.seq = bytes(part), 0, self.seq + 1
+        size = min(len(buffer), len(self.part) - self.offset)
+        buffer[:size] = self.part[self.offset:self.offset + size]
+        self.offset += size
+        self.position += size
+        return size
+
+    def tell(self):
+        return self.position
+
+
+def count_rows(table_name):
+    table = db.metadata.tables[table_name]
+    return db.session.query(func.count()).select_from(table).scalar()
+
+
+# callables(table_name, action, row_ids) run after every committed change.
+# row_ids is None when the change is too large to list (imports)
+change_listeners = []
+
+
+def add_change_listener(listener):
+    if listener not in change_listeners:
+        change_listeners.append(listener)
+
+
+'''
+commit_change(table_name, action, row_ids, count=None, cascaded=())
+    commits the pending change to rows row_ids of table_name, where action
+    is 'insert', 'update' or 'delete', keeping the table stats and the
+    change log in step, then tells the change listeners. the change must
+    already be flushed. pass None as row_ids and the number of rows as
+    count for changes too large to list. cascaded lists the (table_name,
+    action, row_ids) the database made along with it (see cascaded_deletes)
+'''
+def commit_change(table_name, action, row_ids, count=None, cascaded=()):
+    changes = [(table_name, action, row_ids)] + list(cascaded)
+    for table_name, action, row_ids in changes:
+        rows = count if row_ids is None else len(row_ids)
+        delta = 0
+        if table_name in COUNTED_TABLES:
+            if action == 'insert':
+                delta = rows
+            elif action == 'delete':
+                delta = -rows
+        TableStat.adjust(table_name, delta)
+        Change.record(table_name, action, row_ids)
+    db.session.commit()
+
+    for table_name, action, row_ids in changes:
+        for listener in change_listeners:
+            listener(table_name, action, row_ids)
+
+
+'''
+cascaded_deletes(model, ids)
+    the cast rows ON DELETE CASCADE will remove along with the rows ids of
+    model, as changes for commit_change. read before the delete, since the
+    database removes them without telling the app
+'''
+def cascaded_deletes(model, ids):
+    column = {'movies': Movie_cast.movie_id, 'actors': Movie_cast.actor_id}.get(model.__tablename__)
+    if column is None:
+        return []
+    cast_ids = []
+    for chunk in chunks(list(ids)):
+        cast_ids.extend(row.id for row in db.session.query(Movie_cast.id).filter(column.in_(chunk))
+                        .execution_options(batched=True))
+    if not cast_ids:
+        return []
+    return [(Movie_cast.__tablename__, 'delete', cast_ids)]
+
+
+# the statements run once per chunk carry execution_options(batched=True),
+# which the N+1 check of query_checks.py leaves out
+def chunks(items, size=None):
+    size = size or BULK_CHUNK_SIZE
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+'''
+bulk_insert(model, rows)
+    inserts rows (dicts of column values) in a single transaction and
+    returns their new ids in order. uses multi-row INSERT ... RETURNING
+    where the database supports it, an executemany otherwise
+'''
+def bulk_insert(model, rows):
+    table = model.__table__
+    ids = []
+    if db.session.get_bind().dialect.implicit_returning:
+        for chunk in chunks(rows):
+            result = db.session.execute(table.insert().values(chunk).returning(table.c.id)
+                                        .execution_options(batched=True))
+            ids.extend(row[0] for row in result)
+    else:
+        # an executemany reports no ids. the first row is inserted on its
+        # own for its id, and as the transaction now holds SQLite's single
+        # write lock the rows after it take the ids that follow
+        first = db.session.execute(table.insert(), rows[0]).inserted_primary_key[0]
+        if len(rows) > 1:
+            db.session.execute(table.insert(), rows[1:])
+        ids = list(range(first, first + len(rows)))
+    commit_change(table.name, 'insert', ids)
+    return ids
+
+
+def existing_ids(model, ids):
+    found = set()
+    for chunk in chunks(list(ids)):
+        query = db.session.query(model.id).filter(model.id.in_(chunk)).execution_options(batched=True)
+        found.update(row[0] for row in query)
+    return found
+
+
+'''
+bulk_update(model, rows)
+    applies rows (dicts with an id and the columns to change) in a single
+    transaction with executemany UPDATEs, skipping ids that do not exist.
+    every row updated gets a new version. returns the set of ids updated
+'''
+def bulk_update(model, rows):
+    table = model.__table__
+    found = existing_ids(model, [row['id'] for row in rows])
+    rows = [row for row in rows if row['id'] in found]
+    # one statement per set of columns changed
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(name for name in row if name != 'id'), []).append(row)
+    for columns, group in groups.items():
+        statement = table.update().where(table.c.id == bindparam('row_id')).values(
+            version=table.c.version + 1, **{name: bindparam(name) for name in columns}).execution_options(batched=True)
+        for chunk in chunks(group):
+            db.session.execute(statement, [dict({name: row[name] for name in columns}, row_id=row['id'])
+                                           for row in chunk])
+    commit_change(table.name, 'update', [row['id'] for row in rows])
+    return found
+
+
+'''
+update_row(model, id, values, versions=None)
+    sets values on row id of model's table and bumps its version in a single
+    UPDATE ... RETURNING, without reading the row first (where there is no
+    RETURNING, as on SQLite, the row is selected after the UPDATE). given
+    versions, only a row at one of them is updated. returns the updated row
+    as a dict of its columns, or None (rolling back) when no row matched
+'''
+def update_row(model, id, values, versions=None):
+    table = model.__table__
+    statement = table.update().where(table.c.id == id)
+    if versions is not None:
+        statement = statement.where(table.c.version.in_(versions))
+    statement = statement.values(version=table.c.version + 1, **values)
+    if db.session.get_bind().dialect.implicit_returning:
+        row = db.session.execute(statement.returning(*table.c)).first()
+    else:
+        row = None
+        if db.session.execute(statement).rowcount:
+            row = db.session.execute(table.select().where(table.c.id == id)).first()
+    if row is None:
+        db.session.rollback()
+        return None
+    row = dict(row)
+    commit_change(table.name, 'update', [id])
+    return row
+
+
+'''
+bulk_delete(model, ids)
+    deletes the rows with the given ids in a single transaction and returns
+    the set of ids that existed
+'''
+def bulk_delete(model, ids):
+    found = existing_ids(model, ids)
+    cascaded = cascaded_deletes(model, found)
+    for chunk in chunks(list(found)):
+        model.query.filter(model.id.in_(chunk)).execution_options(batched=True).delete(synchronize_session=False)
+    commit_change(model.__tablename__, 'delete', list(found), cascaded=cascaded)
+    return found
+
+
 '''
 Movie
 a persistent movie entity, extends the base SQLAlchemy Model
 '''
 class Movie(db.Model):
     __tablename__ = 'movies'
+    __table_args__ = (
+        # release date filters, and pages sorted by release date
+        db.Index('ix_movies_release_date', 'release_date', 'id'),
+        # title substring search (ILIKE '%...%') on postgres
+        db.Index('ix_movies_title_trgm', 'title', postgresql_using='gin',
+                 postgresql_ops={'title': 'gin_trgm_ops'}),
+    )
     # Autoincrementing, unique primary key
     id = Column(Integer, primary_key=True)
     # String Title
     title = Column(String, nullable=False)
     release_date = Column(db.Date)
-    #movie_cast = db.relationship('Movie_cast', backref="Movie", lazy=True)
+    # bumped by every update, for optimistic concurrency (see update_row)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    # cast rows go with the movie through ON DELETE CASCADE
+    movie_cast = db.relationship('Movie_cast', back_populates='movie',
+                                 cascade='all, delete-orphan', passive_deletes=True)
 
     def __int__(self, title, release_date):
         self.title = title
@@ -47,7 +679,8 @@ class Movie(db.Model):
     '''
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        commit_change(self.__tablename__, 'insert', [self.id])
 
     '''
     delete()
@@ -55,8 +688,10 @@ class Movie(db.Model):
         the model must exist in the database
     '''
     def delete(self):
+        cascaded = cascaded_deletes(type(self), [self.id])
         db.session.delete(self)
-        db.session.commit()
+        db.session.flush()
+        commit_change(self.__tablename__, 'delete', [self.id], cascaded=cascaded)
 
     '''
     update()
@@ -64,7 +699,17 @@ class Movie(db.Model):
         the model must exist in the database
     '''
     def update(self):
-        db.session.commit()
+        self.version = type(self).version + 1
+        db.session.flush()
+        commit_change(self.__tablename__, 'update', [self.id])
+
+    '''
+    count()
+        the number of movies, read from the table stats
+    '''
+    @classmethod
+    def count(cls):
+        return TableStat.count(cls.__tablename__)
 
     #def __repr__(self):
      #   return '<Movie{}>'.format(self.title)
@@ -73,18 +718,32 @@ class Movie(db.Model):
         return {
             'id': self.id,
             'title': self.title,
-            'release_date': self.release_date
+            'release_date': self.release_date,
+            'version': self.version
         }
 
+    # the movie with its cast, the cast (and actors) should be eager loaded
+    def format_with_cast(self):
+        movie = self.format()
+        movie['cast'] = [cast.format_actor() for cast in self.movie_cast]
+        return movie
+
 
 class Actor(db.Model):
     __tablename__ = 'actors'
+    __table_args__ = (
+        db.Index('ix_actors_age', 'age', 'id'),
+        db.Index('ix_actors_name_trgm', 'name', postgresql_using='gin',
+                 postgresql_ops={'name': 'gin_trgm_ops'}),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
     age = db.Column(db.Integer)
     gender = db.Column(db.String(120))
-    #movie_cast = db.relationship('Show', backref="Artist", lazy=True)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    movie_cast = db.relationship('Movie_cast', back_populates='actor',
+                                 cascade='all, delete-orphan', passive_deletes=True)
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -94,14 +753,23 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        commit_change(self.__tablename__, 'insert', [self.id])
 
     def delete(self):
+        cascaded = cascaded_deletes(type(self), [self.id])
         db.session.delete(self)
-        db.session.commit()
+        db.session.flush()
+        commit_change(self.__tablename__, 'delete', [self.id], cascaded=cascaded)
 
     def update(self):
-        db.session.commit()
+        self.version = type(self).version + 1
+        db.session.flush()
+        commit_change(self.__tablename__, 'update', [self.id])
+
+    @classmethod
+    def count(cls):
+        return TableStat.count(cls.__tablename__)
 
   #  def __repr__(self):
     #    return '<Actor {}>'.format(self.name)
@@ -111,37 +779,62 @@ class Actor(db.Model):
             'id': self.id,
             'name':self.name,
             'age': self.age,
-            'gender': self.gender
+            'gender': self.gender,
+            'version': self.version
         }
 
+    # the actor with the movies played in, which should be eager loaded
+    def format_with_movies(self):
+        actor = self.format()
+        actor['movies'] = [cast.format_movie() for cast in self.movie_cast]
+        return actor
 
-''' Save this part for future work'''
+
+'''
+Movie_cast
+    an actor cast in a movie, in a given role
 '''
 class Movie_cast(db.Model):
-  __tablename__ = 'Movie_cast'
-  id = db.Column(db.Integer, primary_key=True)
-  actor_id = db.Column(db.Integer, db.ForeignKey(
-    'Actor.id'), nullable=False)
-  movie_id = db.Column(db.Integer, db.ForeignKey('Movie.id'), nullable=False)
-  role = db.Column(db.String(120))
-  movie = db.relationship('Movie')
-  artist = db.relationship('Actor')
-
-  def insert(self):
-      db.session.add(self)
-      db.session.commit()
+    __tablename__ = 'movie_cast'
+    # an actor is cast in a movie once
+    __table_args__ = (
+        db.UniqueConstraint('movie_id', 'actor_id', name='uq_movie_cast_movie_id_actor_id'),
+    )
 
-  def delete(self):
-      db.session.delete(self)
-      db.session.commit()
+    id = db.Column(db.Integer, primary_key=True)
+    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE'),
+                         nullable=False, index=True)
+    actor_id = db.Column(db.Integer, db.ForeignKey('actors.id', ondelete='CASCADE'),
+                         nullable=False, index=True)
+    role = db.Column(db.String(120))
+    movie = db.relationship('Movie', back_populates='movie_cast')
+    actor = db.relationship('Actor', back_populates='movie_cast')
 
-  def update(self):
-      db.session.commit()
+    def insert(self):
+        db.session.add(self)
+        db.session.flush()
+        commit_change(self.__tablename__, 'insert', [self.id])
 
-  def __repr__(self):
-    return '<Movie_cast {}{}>'.format(self.actor_id, self.movie_id)
-'''
+    def delete(self):
+        db.session.delete(self)
+        db.session.flush()
+        commit_change(self.__tablename__, 'delete', [self.id])
 
+    def update(self):
+        db.session.flush()
+        commit_change(self.__tablename__, 'update', [self.id])
 
+    def __repr__(self):
+        return '<Movie_cast {} {}>'.format(self.actor_id, self.movie_id)
 
+    def format_actor(self):
+        return {
+            'actor': self.actor.format(),
+            'role': self.role
+        }
 
+    def format_movie(self):
+        return {
+            'movie': self.movie.format(),
+            'role': self.role
+        }
@@ -0,0 +1,98 @@
+import os
+import time
+import logging
+from flask import request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 'log' reports slow queries and likely N+1 patterns, 'strict' also raises
+# NPlusOneError (for tests), 'off' attaches nothing
+QUERY_CHECKS = os.environ.get('QUERY_CHECKS', 'log')
+# statements taking longer than this (ms) are logged with their parameters,
+# 0 turns the slow query log off
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+# times the same statement may run within one request before it is
+# reported as a likely N+1, 0 turns the check off
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+# requests running more statements than this are logged, 0 turns it off
+QUERY_COUNT_WARNING = int(os.environ.get('QUERY_COUNT_WARNING', 50))
+
+logger = logging.getLogger(__name__)
+
+STATEMENTS_KEY = 'query_checks.statements'
+
+
+'''
+NPlusOneError
+    raised in strict mode when a request runs the same statement
+    N_PLUS_ONE_THRESHOLD times, which usually means a lazy load per row.
+    statements run with execution_options(batched=True) are not counted
+'''
+class NPlusOneError(Exception):
+    pass
+
+
+def current_route():
+    if not has_request_context():
+        return None
+    if request.url_rule is None:
+        return '%s %s' % (request.method, request.path)
+    return '%s %s' % (request.method, request.url_rule.rule)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.check_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is None:
+        return
+    elapsed_ms = (time.perf_counter() - context.check_started) * 1000
+    route = current_route()
+    if SLOW_QUERY_MS and elapsed_ms >= SLOW_QUERY_MS:
+        logger.warning('slow query (%.1f ms) in %s: %s %r', elapsed_ms, route, statement, parameters)
+    if route is None:
+        return
+
+    # the statement text holds placeholders, not values, so the same query
+    # for another row has the same text. an executemany is already batched,
+    # and so are the statements of the bulk helpers, run once per chunk of
+    # rows (marked with the batched execution option)
+    if executemany or context.execution_options.get('batched'):
+        return
+    statements = request.environ.setdefault(STATEMENTS_KEY, {})
+    count = statements[statement] = statements.get(statement, 0) + 1
+    if N_PLUS_ONE_THRESHOLD and count == N_PLUS_ONE_THRESHOLD:
+        message = 'likely N+1 in %s: statement ran %d times: %s' % (route, count, statement)
+        logger.warning(message)
+        if QUERY_CHECKS == 'strict':
+            raise NPlusOneError(message)
+
+
+def report_query_count(exception=None):
+    statements = request.environ.get(STATEMENTS_KEY)
+    if not statements:
+        return
+    total = sum(statements.values())
+    if QUERY_COUNT_WARNING and total > QUERY_COUNT_WARNING:
+        logger.warning('%s ran %d queries', current_route(), total)
+    else:
+        logger.debug('%s ran %d queries', current_route(), total)
+
+
+'''
+init_app(app)
+    attaches the slow query log and the N+1 check to the engines (the one
+    setup_db configures included), and logs the query count of each request
+    of app, unless QUERY_CHECKS is off
+'''
+def init_app(app):
+    if QUERY_CHECKS == 'off':
+        return
+    if not event.contains(Engine, 'after_cursor_execute', after_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    if 'query_checks' not in app.extensions:
+        app.extensions['query_checks'] = True
+        app.teardown_request(report_query_count)
@@ -0,0 +1,166 @@
+import math
+import time
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import wraps
+from flask import make_response, current_app
+from werkzeug.local import LocalProxy
+from cache import load_backend
+
+
+'''
+RateLimitError
+    raised when a request is refused for now: over its rate limit (429) or
+    over a route's concurrency cap (503). retry_after is in seconds
+'''
+class RateLimitError(Exception):
+    def __init__(self, message, status_code, retry_after):
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+'''
+RateLimitBackend
+    where the token buckets live. take(key, capacity, rate) removes a token
+    from the bucket key (holding at most capacity tokens, refilled at rate
+    tokens per second) and returns (allowed, seconds until one is back).
+    implement it to share the buckets between workers
+'''
+class RateLimitBackend(ABC):
+    @abstractmethod
+    def take(self, key, capacity, rate):
+        pass
+
+
+'''
+MemoryBackend
+    the default in-process backend. keeps the maxsize most recently used
+    buckets; an evicted bucket comes back full
+'''
+class MemoryBackend(RateLimitBackend):
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+'''
+parse_limits(value)
+    'get:movies=300/60,post:movies=30/60' as {permission: (requests, seconds)}.
+    a rate without seconds is per 60 seconds, so a bare 0 is no limit
+'''
+def parse_limits(value):
+    limits = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        permission, rate = item.split('=')
+        requests, _, seconds = rate.partition('/')
+        limits[permission.strip()] = (int(requests), float(seconds or 60))
+    return limits
+
+
+'''
+RateLimiter
+    a token bucket per token subject and permission. a permission allows
+    limits[permission] (or else default) requests per period, in bursts of
+    up to the full amount. a limit of 0 requests is no limit
+'''
+class RateLimiter:
+    def __init__(self, backend=None, default=(0, 60), limits=None):
+        self.backend = backend or MemoryBackend()
+        self.default = default
+        self.limits = limits or {}
+        self.lock = threading.Lock()
+        self.stats = {
+            'allowed': 0,
+            'limited': 0
+        }
+
+    def check(self, payload, permission):
+        requests, seconds = self.limits.get(permission, self.default)
+        if requests <= 0:
+            return
+        key = '%s:%s' % (payload.get('sub', 'anonymous'), permission)
+        allowed, retry_after = self.backend.take(key, requests, requests / seconds)
+        with self.lock:
+            self.stats['allowed' if allowed else 'limited'] += 1
+        if not allowed:
+            raise RateLimitError('rate limit exceeded', 429, retry_after)
+
+
+# the rate limiter of the current app, see init_app
+rate_limiter = LocalProxy(lambda: current_app.extensions['rate_limiter'])
+
+
+'''
+init_app(app)
+    gives app a rate limiter of its own (app.extensions['rate_limiter'])
+    from the RATE_LIMIT* settings of app.config, with empty buckets when
+    they are kept in-process
+'''
+def init_app(app):
+    backend = None
+    if app.config['RATE_LIMIT_BACKEND']:
+        backend = load_backend(app.config['RATE_LIMIT_BACKEND'])
+    app.extensions['rate_limiter'] = RateLimiter(
+        backend,
+        default=parse_limits('default=' + app.config['RATE_LIMIT_DEFAULT'])['default'],
+        limits=parse_limits(app.config['RATE_LIMITS']))
+
+
+'''
+ConcurrencyLimit
+    caps how many requests of a group of routes a process serves at once,
+    so a burst of expensive reads cannot take every worker thread (or
+    greenlet) and connection. a request over the cap is refused straight
+    away with 503 rather than queued. streamed responses hold their slot
+    until the body is sent
+'''
+class ConcurrencyLimit:
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.semaphore = threading.BoundedSemaphore(limit) if limit > 0 else None
+        self.stats = {
+            'rejected': 0
+        }
+
+    def __call__(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if self.semaphore is None:
+                return f(*args, **kwargs)
+            if not self.semaphore.acquire(blocking=False):
+                self.stats['rejected'] += 1
+                raise RateLimitError('too many concurrent %s requests' % self.name, 503, 1)
+            try:
+                response = make_response(f(*args, **kwargs))
+            except BaseException:
+                self.semaphore.release()
+                raise
+            if response.is_streamed:
+                response.call_on_close(self.semaphore.release)
+            else:
+                self.semaphore.release()
+            return response
+
+        return wrapper
+
+
+def retry_after_header(seconds):
+    return str(max(1, int(math.ceil(seconds))))
@@ -0,0 +1,186 @@
+import time
+import logging
+import threading
+from flask import request, has_request_context, current_app
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm, text
+
+# cookie set on responses to writes, asking for reads from the primary
+# until the time (unix seconds) it holds
+READ_PRIMARY_COOKIE = 'read_primary_until'
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Replica
+    one read replica and what its last health check found
+'''
+class Replica:
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+        self.checked_at = None
+        self.lag = None
+
+
+'''
+ReplicaRouter
+    hands out the replicas in turn, skipping those that are down or lag
+    behind the primary by more than max_lag seconds. each replica is
+    checked when it is picked and check_interval seconds have passed since
+    its last check, and marked down as soon as one of its connections drops
+'''
+class ReplicaRouter:
+    def __init__(self, replicas, check_interval=10, max_lag=5):
+        self.replicas = replicas
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.next = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            'reads': 0,
+            'fallbacks': 0
+        }
+        for replica in replicas:
+            event.listen(replica.engine, 'handle_error', self.on_error(replica))
+
+    def on_error(self, replica):
+        def handle_error(context):
+            if context.is_disconnect:
+                logger.warning('replica %s disconnected, reading from the primary', replica.engine.url)
+                replica.healthy = False
+                replica.checked_at = time.monotonic()
+        return handle_error
+
+    '''
+    choose()
+        the engine of the next healthy replica, or None to read from the
+        primary when there is none
+    '''
+    def choose(self):
+        with self.lock:
+            start = self.next
+            self.next = (self.next + 1) % len(self.replicas)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if self.is_healthy(replica):
+                self.stats['reads'] += 1
+                return replica.engine
+        self.stats['fallbacks'] += 1
+        return None
+
+    def is_healthy(self, replica):
+        now = time.monotonic()
+        if replica.checked_at is None or now - replica.checked_at >= self.check_interval:
+            replica.checked_at = now
+            replica.healthy = self.check(replica)
+        return replica.healthy
+
+    def check(self, replica):
+        try:
+            with replica.engine.connect() as connection:
+                if replica.engine.dialect.name == 'postgresql':
+                    # seconds since the last replayed transaction; NULL on a primary
+                    replica.lag = connection.execute(text(
+                        'SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())')).scalar()
+                else:
+                    connection.execute(text('SELECT 1'))
+        except Exception as e:
+            logger.warning('replica %s failed its health check: %s', replica.engine.url, e)
+            return False
+        if self.max_lag and replica.lag is not None and replica.lag > self.max_lag:
+            logger.warning('replica %s lags %.1f s behind, reading from the primary', replica.engine.url, replica.lag)
+            return False
+        return True
+
+    def state(self):
+        return dict(self.stats, replicas=[{
+            'url': repr(replica.engine.url),
+            'healthy': replica.healthy,
+            'lag': replica.lag
+        } for replica in self.replicas])
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+
+'''
+wrote_recently()
+    whether the client of the current request wrote within the last
+    READ_YOUR_WRITES_SECONDS (see READ_PRIMARY_COOKIE), so it must read
+    from the primary, not from a replica or a copy cached before its write
+'''
+def wrote_recently():
+    if not has_request_context():
+        return False
+    try:
+        return float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) >= time.time()
+    except ValueError:
+        return False
+
+
+'''
+reads_from_replica()
+    whether the current request may read from a replica: it is a GET (or
+    HEAD), and the client has not written recently
+'''
+def reads_from_replica():
+    if not has_request_context() or request.method not in ('GET', 'HEAD'):
+        return False
+    return not wrote_recently()
+
+
+'''
+RoutingSession
+    the session of db. while a request may read from a replica (and
+    nothing is being flushed), every statement of the session goes to one
+    replica chosen when the session first needs one, so a request reads a
+    single consistent copy. everything else goes to the primary
+'''
+class RoutingSession(SignallingSession):
+    replica = None
+
+    # sends the rest of the request to the primary, for reads that must not lag
+    def use_primary(self):
+        self.replica = False
+
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get('replicas')
+        if router is not None and not self._flushing and reads_from_replica():
+            if self.replica is None:
+                self.replica = router.choose() or False
+            if self.replica:
+                return self.replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def stick_to_primary(response):
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+        window = current_app.config['READ_YOUR_WRITES_SECONDS']
+        response.set_cookie(READ_PRIMARY_COOKIE, str(int(time.time()) + window), max_age=window, httponly=True)
+    return response
+
+
+'''
+init_app(app, engine_options)
+    routes the reads of GET requests of app to the REPLICA_URLS of its
+    config, with engines created with engine_options(url). a client that
+    wrote is sent a cookie keeping its reads on the primary for
+    READ_YOUR_WRITES_SECONDS, so it sees its own writes despite the
+    replication lag
+'''
+def init_app(app, engine_options):
+    urls = app.config.get('REPLICA_URLS')
+    if not urls or 'replicas' in app.extensions:
+        return
+    replicas = [Replica(create_engine(url, **engine_options(url))) for url in urls]
+    app.extensions['replicas'] = ReplicaRouter(
+        replicas, app.config['REPLICA_CHECK_INTERVAL'], app.config['REPLICA_MAX_LAG'])
+    app.after_request(stick_to_primary)
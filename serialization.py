@@ -0,0 +1,92 @@
+import os
+import json
+import importlib
+from datetime import date
+from decimal import Decimal
+from flask import current_app
+from flask.json import JSONEncoder as FlaskJSONEncoder
+from instrumentation import span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 'auto' encodes with orjson when it is installed and the standard library
+# otherwise, 'orjson' or 'json' pick one, anything else is the 'module.function'
+# path of a dumps(obj) -> bytes to use instead
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+
+
+'''
+JSONEncoder
+    the standard library encoder, writing dates as ISO 8601 strings
+    (2020-06-01) instead of Flask's HTTP dates. also set as app.json_encoder
+    so flask.json agrees with the response bodies
+'''
+class JSONEncoder(FlaskJSONEncoder):
+    def default(self, o):
+        if isinstance(o, date):
+            return o.isoformat()
+        if isinstance(o, Decimal):
+            return float(o)
+        return super().default(o)
+
+
+def json_dumps(obj):
+    return json.dumps(obj, cls=JSONEncoder, separators=(',', ':')).encode('utf-8')
+
+
+def orjson_default(o):
+    if isinstance(o, Decimal):
+        return float(o)
+    raise TypeError('%r is not JSON serializable' % (o,))
+
+
+# orjson is implemented in C and writes dates as ISO 8601 itself
+def orjson_dumps(obj):
+    return orjson.dumps(obj, default=orjson_default)
+
+
+def load_backend(name):
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError('JSON_BACKEND is orjson but orjson is not installed')
+        return orjson_dumps
+    if name == 'json':
+        return json_dumps
+    module_name, function_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+dumps = load_backend(JSON_BACKEND)
+
+
+'''
+jsonify(*args, **kwargs)
+    flask.jsonify through the configured backend. output is compact unless
+    JSONIFY_PRETTYPRINT_REGULAR is set or the app runs in debug mode
+'''
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    data = args[0] if len(args) == 1 else args or kwargs
+
+    with span('serialize'):
+        if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug:
+            body = json.dumps(data, cls=JSONEncoder, indent=2).encode('utf-8')
+        else:
+            body = dumps(data)
+    return current_app.response_class(body + b'\n', mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+'''
+encode_rows(keys, rows)
+    yields each result tuple as the JSON object {key: value, ...}, straight
+    from the database row without loading ORM objects
+'''
+def encode_rows(keys, rows):
+    for row in rows:
+        yield dumps(dict(zip(keys, row)))
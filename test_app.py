@@ -1,28 +1,45 @@
 import os
+import sys
 import requests
 import unittest
 import json
+import tempfile
+import time
+import gzip
+import shutil
+import sqlite3
+import pytest
 from flask_sqlalchemy import SQLAlchemy
 from env_var import find_key
 from flask_cors import CORS
 from flask import Flask, request, jsonify, abort
-from sqlalchemy import exc
+from sqlalchemy import exc, event, create_engine
+from sqlalchemy.engine.url import make_url
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import http_date
 
+import app as app_module
 from app import create_app
-from datetime import datetime
-from models import setup_db, Movie, Actor
-from auth import AuthError, requires_auth
-
+from config import Config
+from datetime import datetime, date, timedelta
+from models import db, Movie, Actor, Movie_cast, Change, TableStat, JobFile, engine_options, pool_stats, TimedQueuePool, DB_POOL_SIZE
+from auth import AuthError, requires_auth, JWKSKeyStore, TokenCache, token_cache
+from cache import ResponseCache, ObjectCache, LRUBackend, object_cache
+import cache
+import compression
+import instrumentation
+import query_checks
+import models
+from query_checks import NPlusOneError
+from ratelimit import MemoryBackend, RateLimiter, RateLimitError, parse_limits
+
+@pytest.mark.usefixtures('bind_app')
 class MovieTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
+        """Define test variables; the app and its database come from conftest.py"""
         self.client = self.app.test_client
-        self.database_name = 'movie_test'
-        self.database_path = os.environ['HEROKU_POSTGRESQL_BROWN_URL']
-        setup_db(self.app)
 
         # new variable
         self.new_movie = {'title': 'A new movie', 'release_date': datetime.now().strftime('%Y-%m-%d')}
@@ -37,23 +54,61 @@ class MovieTestCase(unittest.TestCase):
         self.casting_director = os.environ['casting_director']
         self.executive_producer = os.environ['executive_producer']
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            # uncomment it at the first run
-            #self.db.create_all()
-
-    def tearDown(self):
-        """Executed after reach test"""
-        pass
-
     # test functions for each route
     # one test for success behavior of each endpoint
     # one test for error behavior of each endpoint
 
     # test for 'gets' method
+    def test_get_stats(self):
+        res = self.client().get('/stats')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('pool', data['pool'])
+        self.assertIn('hits', data['jwks'])
+
+    def test_metrics_record_route_phases(self):
+        token_cache.clear()
+        self.client().get('/movies/{}/cast'.format(Movie.query.first().id),
+                          headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        res = self.client().get('/metrics')
+        text = res.data.decode('utf-8')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        for phase in ('jwt_verify', 'sql', 'serialize', 'other'):
+            self.assertIn('http_request_phase_seconds_sum{route="/movies/<int:movie_id>/cast",phase="%s"}' % phase, text)
+        self.assertIn('http_requests_total{route="/movies/<int:movie_id>/cast",method="GET",status="200"}', text)
+        self.assertIn('db_queries_total{route="/movies/<int:movie_id>/cast"}', text)
+
+    def test_repeated_statement_flagged_as_n_plus_one(self):
+        ids = [movie.id for movie in Movie.query.limit(query_checks.N_PLUS_ONE_THRESHOLD).all()]
+        with self.app.test_request_context('/movies'):
+            with self.assertLogs('query_checks', 'WARNING'), self.assertRaises(NPlusOneError):
+                for movie_id in ids:
+                    Movie.query.filter_by(id=movie_id).first()
+
+    def test_slow_query_logged_with_parameters(self):
+        slow_query_ms, query_checks.SLOW_QUERY_MS = query_checks.SLOW_QUERY_MS, 0.000001
+        try:
+            with self.assertLogs('query_checks', 'WARNING') as logs:
+                Movie.query.filter_by(title='slow movie').first()
+        finally:
+            query_checks.SLOW_QUERY_MS = slow_query_ms
+
+        self.assertIn('slow movie', logs.output[0])
+
+    def test_sampled_requests_profiled(self):
+        rate, directory = instrumentation.PROFILE_SAMPLE_RATE, instrumentation.PROFILE_DIR
+        with tempfile.TemporaryDirectory() as tmpdir:
+            instrumentation.PROFILE_SAMPLE_RATE, instrumentation.PROFILE_DIR = 1, tmpdir
+            try:
+                self.client().get('/')
+            finally:
+                instrumentation.PROFILE_SAMPLE_RATE, instrumentation.PROFILE_DIR = rate, directory
+
+            self.assertEqual([name.startswith('get_greeting-') for name in os.listdir(tmpdir)], [True])
+
     def test_get_movies(self):
         res = self.client().get('/movies',headers={"Authorization": "Bearer {}".format(self.executive_producer)})
         data = json.loads(res.data.decode("utf-8"))
@@ -62,6 +117,54 @@ class MovieTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['movies']))
 
+    def test_get_movies_paginated(self):
+        res = self.client().get('/movies?limit=2',headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 2)
+        self.assertEqual(data['next_cursor'], data['movies'][-1]['id'])
+
+        res = self.client().get('/movies?limit=2&cursor={}'.format(data['next_cursor']),
+                                headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        next_page = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(next_page['movies'][0]['id'], data['next_cursor'])
+
+    def test_get_movies_streamed(self):
+        res = self.client().get('/movies?stream=true',headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['movies']), Movie.query.count())
+
+    def test_release_dates_serialized_as_iso(self):
+        movie = Movie(title='Iso date movie', release_date=date(2020, 6, 1))
+        movie.insert()
+        movie_id = movie.id
+        for url in ('/movies?title=iso+date', '/movies?title=iso+date&stream=true'):
+            res = self.client().get(url, headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['movies'], [{'id': movie_id, 'title': 'Iso date movie', 'release_date': '2020-06-01'}])
+        Movie.query.get(movie_id).delete()
+
+    def test_responses_are_compact(self):
+        res = self.client().get('/movies?limit=1', headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+
+        self.assertNotIn(b'\n ', res.data)
+        self.assertTrue(res.data.startswith(b'{"'))
+
+    def test_400_sent_for_invalid_limit(self):
+        res = self.client().get('/movies?limit=abc',headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_404_sent_requesting_beyond_valid_movie(self):
         res = self.client().get('/movies/a',headers={"Authorization": "Bearer {}".format(self.executive_producer)})
         data = json.loads(res.data)
@@ -78,6 +181,120 @@ class MovieTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['actors']))
 
+    def test_get_movies_not_modified(self):
+        res = self.client().get('/movies',headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        etag = res.headers['ETag']
+
+        res = self.client().get('/movies',headers={"Authorization": "Bearer {}".format(self.executive_producer),
+                                                   "If-None-Match": etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_not_modified_answered_from_table_versions(self):
+        res = self.client().get('/movies?limit=3',headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        etag = res.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        res, statements = self.capture_queries_with_headers('/movies?limit=3', {"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertTrue(all('table_stats' in query for query, parameters in statements))
+
+        self.client().post('/movies', headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                           json=self.new_movie)
+        res = self.client().get('/movies?limit=3',headers={"Authorization": "Bearer {}".format(self.executive_producer),
+                                                            "If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_actors_not_modified_since(self):
+        self.client().post('/actors', headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                           json=self.new_actor)
+        # as if the write was a few seconds ago, its Last-Modified settled
+        stat = TableStat.query.get('actors')
+        stat.updated_at -= timedelta(seconds=2)
+        db.session.commit()
+        res = self.client().get('/actors',headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        last_modified = res.headers['Last-Modified']
+
+        res = self.client().get('/actors',headers={"Authorization": "Bearer {}".format(self.executive_producer),
+                                                   "If-Modified-Since": last_modified})
+        self.assertEqual(res.status_code, 304)
+
+    def test_last_modified_not_sent_within_the_second_of_a_write(self):
+        headers = {"Authorization": "Bearer {}".format(self.executive_producer)}
+        self.client().post('/actors', headers=headers, json=self.new_actor)
+        written = TableStat.query.get('actors').updated_at
+        now = written
+
+        # the clock cache.py reads, so the requests land where the test says
+        class Clock(datetime):
+            @classmethod
+            def utcnow(cls):
+                return now
+
+        clock, cache.datetime = cache.datetime, Clock
+        try:
+            # another write may still come within this second
+            res = self.client().get('/actors', headers=headers)
+            self.assertNotIn('Last-Modified', res.headers)
+            res = self.client().get('/actors', headers=dict(headers, **{"If-Modified-Since": http_date(written)}))
+            self.assertEqual(res.status_code, 200)
+
+            now = written + timedelta(seconds=1)
+            res = self.client().get('/actors', headers=headers)
+            self.assertEqual(res.headers['Last-Modified'], http_date(written.replace(microsecond=0)))
+        finally:
+            cache.datetime = clock
+
+    def test_get_movies_gzip(self):
+        min_size, compression.COMPRESS_MIN_SIZE = compression.COMPRESS_MIN_SIZE, 0
+        try:
+            res = self.client().get('/movies',headers={"Authorization": "Bearer {}".format(self.executive_producer),
+                                                       "Accept-Encoding": "gzip"})
+        finally:
+            compression.COMPRESS_MIN_SIZE = min_size
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(res.data))['success'], True)
+
+    def test_get_movies_streamed_gzip(self):
+        res = self.client().get('/movies?stream=true',headers={"Authorization": "Bearer {}".format(self.executive_producer),
+                                                               "Accept-Encoding": "gzip"})
+        data = json.loads(gzip.decompress(res.data))
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(data['movies']), Movie.query.count())
+
+    def test_small_responses_not_compressed(self):
+        res = self.client().get('/', headers={"Accept-Encoding": "gzip"})
+
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_get_actors_cache_invalidated_by_insert(self):
+        url = '/actors?limit=1000'
+        self.client().get(url,headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        res = self.client().get(url,headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        total_actors_before = len(json.loads(res.data)['actors'])
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+        self.client().post('/actors',
+                           headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                           json=self.new_actor)
+        res = self.client().get(url,headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(json.loads(res.data)['actors']), total_actors_before + 1)
+
+    def test_get_actors_last_page(self):
+        res = self.client().get('/actors?limit={}'.format(Actor.query.count()),
+                                headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(data['next_cursor'])
+
     def test_404_sent_requesting_beyond_valid_actor(self):
         res = self.client().get('/actors/a',headers={"Authorization": "Bearer {}".format(self.executive_producer)})
         data = json.loads(res.data)
@@ -123,6 +340,15 @@ class MovieTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(total_actors_after, total_actors_before + 1)
 
+    def test_create_new_actor_reports_total(self):
+        res = self.client().post('/actors',
+                                 headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                                 json=self.new_actor)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_actors'], Actor.query.count())
+
     def test_422_if_actor_creation_fails(self):
         new_actor = {'age': 99}
         res = self.client().post('/actors',
@@ -168,6 +394,7 @@ class MovieTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(data['deleted'], 1)
+        self.assertEqual(data['total_questions'], Actor.query.count())
         self.assertEqual(actor, None)
 
     def test_422_if_deleting_actor_does_not_exist(self):
@@ -228,6 +455,606 @@ class MovieTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_edit_movie_if_match(self):
+        headers = {"Authorization": "Bearer {}".format(self.executive_producer)}
+        res = self.client().patch('/movies/3', headers=headers, json={'title': 'First edit'})
+        etag = res.headers['ETag']
+        version = json.loads(res.data)['movie']['version']
+
+        res = self.client().patch('/movies/3', headers=dict(headers, **{'If-Match': etag}), json={'title': 'Second edit'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['movie']['version'], version + 1)
+        self.assertEqual(res.headers['ETag'], '"%d"' % (version + 1))
+
+        # the first ETag is stale now
+        res = self.client().patch('/movies/3', headers=dict(headers, **{'If-Match': etag}), json={'title': 'Lost edit'})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['version'], version + 1)
+        self.assertEqual(Movie.query.get(3).title, 'Second edit')
+
+    def test_edit_actor_stale_version(self):
+        headers = {"Authorization": "Bearer {}".format(self.executive_producer)}
+        version = json.loads(self.client().patch('/actors/3', headers=headers, json={'age': 50}).data)['actor']['version']
+
+        res = self.client().patch('/actors/3', headers=headers, json={'age': 51, 'version': version - 1})
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(Actor.query.get(3).age, 50)
+
+        res = self.client().patch('/actors/3', headers=headers, json={'age': 51, 'version': version})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['actor']['age'], 51)
+
+    def test_edit_movie_does_not_read_before_writing(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().patch('/movies/3', json={'title': 'One statement', 'version': 1},
+                                      headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertIn(res.status_code, (200, 409))
+        movie_statements = [statement for statement in statements if 'movies' in statement and 'table_stats' not in statement]
+        self.assertTrue(movie_statements[0].startswith('UPDATE movies'))
+        self.assertIn('version', movie_statements[0].split('WHERE')[1])
+
+    def test_get_movie(self):
+        movie = Movie.query.get(3).format()
+        res = self.client().get('/movies/3', headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie'], dict(movie, release_date=movie['release_date'].isoformat()))
+        self.assertEqual(res.headers['ETag'], '"%d"' % movie['version'])
+
+        res = self.client().get('/movies/3', headers={"Authorization": "Bearer {}".format(self.casting_assistant),
+                                                      "If-None-Match": res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_get_actor_not_found(self):
+        res = self.client().get('/actors/5000', headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(json.loads(res.data)['success'], False)
+
+    def test_get_actor_cached_until_changed(self):
+        object_cache.backend.clear()
+        self.capture_queries('/actors/4')
+        res, statements = self.capture_queries('/actors/4')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(statements, [])
+        self.assertGreaterEqual(json.loads(self.client().get('/stats').data)['objects']['hits'], 1)
+
+        self.client().patch('/actors/4', headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                            json={'name': 'Changed name'})
+        res, statements = self.capture_queries('/actors/4')
+        self.assertEqual(json.loads(res.data)['actor']['name'], 'Changed name')
+        self.assertEqual(len(statements), 1)
+
+    def latest_change(self):
+        return db.session.query(db.func.max(Change.seq)).scalar() or 0
+
+    def test_get_changes_since(self):
+        since = self.latest_change()
+        self.client().patch('/movies/3', headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                            json={'title': 'Changed title'})
+        res = self.client().get('/changes?since={}'.format(since),
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(change['table'], change['action'], change['id']) for change in data['changes']],
+                         [('movies', 'update', 3)])
+        self.assertEqual(data['next'], data['changes'][-1]['seq'])
+
+        res = self.client().get('/changes?since={}'.format(data['next']),
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        self.assertEqual(json.loads(res.data)['changes'], [])
+
+    def test_deleted_cast_rows_logged(self):
+        headers = {"Authorization": "Bearer {}".format(self.executive_producer)}
+        casts = {cast.actor_id: cast.id for cast in Movie_cast.query.filter_by(movie_id=10)}
+        self.assertEqual(sorted(casts), [9, 10])
+
+        since = self.latest_change()
+        res = self.client().delete('/actors/bulk', headers=headers, json={'ids': [9]})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().delete('/movies/10', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+        logged = [(change.table_name, change.action, change.row_id)
+                  for change in Change.query.filter(Change.seq > since).order_by(Change.seq)]
+        self.assertEqual(logged, [('actors', 'delete', 9), ('movie_cast', 'delete', casts[9]),
+                                  ('movies', 'delete', 10), ('movie_cast', 'delete', casts[10])])
+
+    def test_apps_keep_their_own_state(self):
+        other = create_app(Config(JOB_WORKERS=0))
+        for name in ('jwks', 'rate_limiter', 'change_feed', 'job_runner'):
+            self.assertIsNot(other.extensions[name], self.app.extensions[name])
+        self.assertIs(self.app.extensions['job_runner'].app, self.app)
+        self.assertIs(self.app.extensions['change_feed'].app, self.app)
+        self.assertEqual(other.extensions['job_runner'].workers, 0)
+
+    def test_change_stream_refused_under_sync_workers(self):
+        res = self.client().get('/changes', headers={"Authorization": "Bearer {}".format(self.casting_assistant),
+                                                     "Accept": "text/event-stream"})
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(json.loads(res.data)['error'], 503)
+
+    @pytest.mark.commits
+    def test_change_stream_catches_up_then_follows(self):
+        app = create_app(Config(CHANGE_KEEPALIVE=0.2, CHANGE_STREAMS='true'))
+        client = app.test_client()
+        headers = {"Authorization": "Bearer {}".format(self.executive_producer)}
+        since = self.latest_change()
+        client.patch('/actors/3', headers=headers, json={'name': 'Before the stream'})
+
+        res = client.get('/changes?since={}'.format(since), headers=dict(headers, Accept='text/event-stream'),
+                         buffered=False)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        events = iter(res.response)
+        received = b''
+        while b'event: update' not in received:
+            received += next(events)
+        self.assertIn(b'"table":"actors"', received)
+
+        client.patch('/actors/3', headers=headers, json={'name': 'During the stream'})
+        seq = self.latest_change()
+        deadline = time.monotonic() + 10
+        while 'id: {}\n'.format(seq).encode('ascii') not in received and time.monotonic() < deadline:
+            received += next(events)
+        res.close()
+
+        self.assertIn('id: {}\n'.format(seq).encode('ascii'), received)
+        self.assertEqual(received.count(b'event: update'), 2)
+
+    # test for cast
+    def capture_queries(self, url):
+        return self.capture_queries_with_headers(url, {})
+
+    def capture_queries_with_headers(self, url, headers):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            # leaving out the savepoints of the test transaction (see conftest.py)
+            if not statement.startswith(('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')):
+                statements.append((statement, parameters))
+
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            headers = dict(headers, Authorization="Bearer {}".format(self.executive_producer))
+            res = self.client().get(url, headers=headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        return res, statements
+
+    # queries reading the listed rows, leaving out the table_stats version lookup
+    def count_queries(self, url):
+        res, statements = self.capture_queries(url)
+        return res, len([query for query, parameters in statements if 'table_stats' not in query])
+
+    # the query plan of the first statement of the request on table
+    def explain_plan(self, url, table):
+        res, statements = self.capture_queries(url)
+        self.assertEqual(res.status_code, 200)
+        statement, parameters = [query for query in statements if 'FROM {}'.format(table) in query[0]][0]
+
+        engine = db.get_engine(self.app)
+        with engine.connect() as connection:
+            if engine.dialect.name == 'postgresql':
+                # the seed tables are small enough for a scan to win otherwise
+                connection.execute('SET enable_seqscan = off')
+                plan = connection.execute('EXPLAIN ' + statement, parameters).fetchall()
+            else:
+                plan = connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+        return ' '.join(str(row) for row in plan)
+
+    def test_create_and_get_movie_cast(self):
+        res = self.client().post('/movies/2/cast',
+                                 headers={"Authorization": "Bearer {}".format(self.casting_director)},
+                                 json={'actor_id': 2, 'role': 'Lead'})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/movies/2/cast',
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn({'actor_id': 2, 'role': 'Lead'},
+                      [{'actor_id': cast['actor']['id'], 'role': cast['role']} for cast in data['cast']])
+
+        res = self.client().get('/actors/2/movies',
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(2, [cast['movie']['id'] for cast in data['movies']])
+
+    def test_409_actor_cast_twice_then_removed(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_director)}
+        res = self.client().post('/movies/2/cast', headers=headers, json={'actor_id': 3, 'role': 'Lead'})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().post('/movies/2/cast', headers=headers, json={'actor_id': 3, 'role': 'Extra'})
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(Movie_cast.query.filter_by(movie_id=2, actor_id=3).count(), 1)
+
+        since = self.latest_change()
+        res = self.client().delete('/movies/2/cast/3', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Movie_cast.query.filter_by(movie_id=2, actor_id=3).count(), 0)
+        self.assertEqual([(change.table_name, change.action) for change in Change.query.filter(Change.seq > since)],
+                         [('movie_cast', 'delete')])
+
+    def test_404_cast_of_missing_movie(self):
+        res = self.client().get('/movies/999999/cast',
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_list_movies_with_cast_in_constant_queries(self):
+        with self.app.app_context():
+            movie_ids = []
+            for i in range(5):
+                movie = Movie(title='Cast movie {}'.format(i), release_date=datetime.now().date())
+                movie.insert()
+                movie_ids.append(movie.id)
+                for actor in Actor.query.limit(3).all():
+                    Movie_cast(movie_id=movie.id, actor_id=actor.id, role='Extra').insert()
+
+        cursor = movie_ids[0] - 1
+        res, one_movie = self.count_queries('/movies?include=cast&limit=1&cursor={}'.format(cursor))
+        self.assertEqual(res.status_code, 200)
+        res, five_movies = self.count_queries('/movies?include=cast&limit=5&cursor={}'.format(cursor))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 5)
+        self.assertEqual(len(data['movies'][4]['cast']), 3)
+        self.assertEqual(five_movies, one_movie)
+        self.assertLessEqual(five_movies, 2)
+
+    # test for filters and sorting
+    def test_filter_and_sort_movies(self):
+        marker = 'Filter {}'.format(datetime.now().timestamp())
+        movies = [{'title': '{} {}'.format(marker, year), 'release_date': '{}-06-01'.format(year)}
+                  for year in (1990, 1995, 2000, 2005)]
+        self.client().post('/movies/bulk',
+                           headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                           json={'movies': movies})
+
+        url = '/movies?title={}&release_date_from=1992-01-01&sort=-release_date&limit=2'.format(marker.lower())
+        res = self.client().get(url, headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['title'][-4:] for movie in data['movies']], ['2005', '2000'])
+
+        res = self.client().get(url + '&cursor={}'.format(data['next_cursor']),
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        data = json.loads(res.data)
+        self.assertEqual([movie['title'][-4:] for movie in data['movies']], ['1995'])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_filter_actors_by_age_and_gender(self):
+        res = self.client().get('/actors?age_min=20&age_max=40&gender=FEMALE&sort=age',
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        ages = [actor['age'] for actor in data['actors']]
+        self.assertEqual(ages, sorted(ages))
+        self.assertTrue(all(20 <= age <= 40 for age in ages))
+        self.assertTrue(all(actor['gender'].lower() == 'female' for actor in data['actors']))
+
+    # tests for sparse fieldsets
+    def test_get_actors_sparse_fields(self):
+        res = self.client().get('/actors?fields=name&sort=-age&limit=2',
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['actors'][0]), {'name'})
+        # the cursor still comes from the unlisted id and sort columns
+        res = self.client().get('/actors?fields=name&sort=-age&limit=2&cursor={}'.format(data['next_cursor']),
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        self.assertEqual(res.status_code, 200)
+
+    def test_get_movies_sparse_fields_with_cast(self):
+        res = self.client().get('/movies?fields=title&include=cast&limit=1',
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['movies'][0]), {'title', 'cast'})
+
+    def test_list_reads_only_selected_columns(self):
+        res, statements = self.capture_queries('/movies?fields=title&limit=5')
+
+        self.assertEqual(res.status_code, 200)
+        statement = [query for query, parameters in statements if 'FROM movies' in query][0]
+        self.assertNotIn('release_date', statement.split('FROM')[0])
+
+    def test_400_sent_for_unknown_field(self):
+        res = self.client().get('/movies?fields=title,budget',
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_400_sent_for_unknown_sort(self):
+        res = self.client().get('/movies?sort=budget',
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_release_date_filter_uses_index(self):
+        plan = self.explain_plan('/movies?release_date_from=1900-01-01&sort=release_date', 'movies')
+
+        self.assertIn('ix_movies_release_date', plan)
+
+    def test_age_filter_uses_index(self):
+        plan = self.explain_plan('/actors?age_min=1&sort=age', 'actors')
+
+        self.assertIn('ix_actors_age', plan)
+
+    def test_title_search_uses_trigram_index(self):
+        if db.get_engine(self.app).dialect.name != 'postgresql':
+            self.skipTest('trigram indexes need postgres')
+        plan = self.explain_plan('/movies?title=movie', 'movies')
+
+        self.assertIn('ix_movies_title_trgm', plan)
+
+    # test for bulk methods
+    def test_bulk_create_actors(self):
+        total_actors_before = Actor.query.count()
+        actors = [self.new_actor, {'name': 'Sam', 'age': 41, 'gender': 'male'}]
+        res = self.client().post('/actors/bulk',
+                                 headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                                 json={'actors': actors})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual(data['total_actors'], total_actors_before + 2)
+        self.assertEqual(Actor.query.get(data['results'][1]['id']).name, 'Sam')
+
+    def test_bulk_create_inserts_in_one_executemany(self):
+        inserts = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT INTO actors'):
+                inserts.append(executemany)
+
+        actors = [{'name': 'Bulk %d' % i, 'age': 30 + i, 'gender': 'female'} for i in range(6)]
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().post('/actors/bulk',
+                                     headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                                     json={'actors': actors})
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        ids = [result['id'] for result in json.loads(res.data)['results']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(inserts), 2)
+        self.assertEqual([Actor.query.get(id).name for id in ids], [actor['name'] for actor in actors])
+
+    def test_bulk_chunks_not_flagged_as_n_plus_one(self):
+        headers = {"Authorization": "Bearer {}".format(self.executive_producer)}
+        actors = [dict(self.new_actor, age=i) for i in range(query_checks.N_PLUS_ONE_THRESHOLD + 1)]
+        # a statement per row, as in a batch of many chunks
+        chunk_size, models.BULK_CHUNK_SIZE = models.BULK_CHUNK_SIZE, 1
+        try:
+            res = self.client().post('/actors/bulk', headers=headers, json={'actors': actors})
+            self.assertEqual(res.status_code, 200)
+            ids = [result['id'] for result in json.loads(res.data)['results']]
+
+            res = self.client().patch('/actors/bulk', headers=headers,
+                                      json={'actors': [{'id': id, 'age': 50} for id in ids]})
+            self.assertEqual(res.status_code, 200)
+            res = self.client().delete('/actors/bulk', headers=headers, json={'ids': ids})
+            self.assertEqual(res.status_code, 200)
+        finally:
+            models.BULK_CHUNK_SIZE = chunk_size
+
+        self.assertEqual(Actor.query.filter(Actor.id.in_(ids)).count(), 0)
+
+    def test_422_bulk_create_rejects_whole_batch(self):
+        total_movies_before = Movie.query.count()
+        movies = [self.new_movie, {'title': 'No date'}]
+        res = self.client().post('/movies/bulk',
+                                 headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                                 json={'movies': movies})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['results'][0]['index'], 1)
+        self.assertEqual(Movie.query.count(), total_movies_before)
+
+    def test_bulk_update_and_delete_movies(self):
+        res = self.client().post('/movies/bulk',
+                                 headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                                 json={'movies': [self.new_movie, self.new_movie]})
+        ids = [result['id'] for result in json.loads(res.data)['results']]
+
+        res = self.client().patch('/movies/bulk',
+                                  headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                                  json={'movies': [{'id': ids[0], 'title': 'Bulk title'}]})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Movie.query.get(ids[0]).title, 'Bulk title')
+
+        res = self.client().delete('/movies/bulk',
+                                   headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                                   json={'ids': ids + [999999]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['success'] for result in data['results']], [True, True, False])
+        self.assertEqual(Movie.query.filter(Movie.id.in_(ids)).count(), 0)
+
+    def test_bulk_update_sets_only_given_columns(self):
+        updates = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE actors'):
+                updates.append(statement)
+
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().patch('/actors/bulk',
+                                      headers={"Authorization": "Bearer {}".format(self.executive_producer)},
+                                      json={'actors': [{'id': 1, 'age': 50}, {'id': 2, 'age': 51}]})
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('id=', updates[0].split('WHERE')[0].replace(' ', ''))
+        self.assertEqual(Actor.query.get(2).age, 51)
+
+    def test_bulk_delete_casting_director(self):
+        res = self.client().delete('/movies/bulk',
+                                   headers={"Authorization": "Bearer {}".format(self.casting_director)},
+                                   json={'ids': [2]})
+
+        self.assertEqual(res.status_code, 401)
+
+    def test_export_movies_csv(self):
+        res = self.client().get('/movies/export?format=csv',
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        lines = res.data.decode('utf-8').splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertEqual(lines[0], 'id,title,release_date,version')
+        self.assertEqual(len(lines) - 1, Movie.query.count())
+
+    def test_export_loads_back_as_it_was(self):
+        headers = {"Authorization": "Bearer {}".format(self.executive_producer)}
+        res = self.client().patch('/actors/bulk', headers=headers, json={'actors': [{'id': 1, 'age': None, 'gender': None}]})
+        self.assertEqual(res.status_code, 200)
+        before = [actor.format() for actor in Actor.query.order_by(Actor.id)]
+
+        for fmt in ('csv', 'ndjson'):
+            exported = self.client().get('/actors/export?format=' + fmt, headers=headers).data
+            db.session.execute(Actor.__table__.delete())
+            res = self.client().post('/actors/import?format=' + fmt, data=exported, headers=headers)
+            self.assertEqual(res.status_code, 200)
+            db.session.expire_all()
+            self.assertEqual([actor.format() for actor in Actor.query.order_by(Actor.id)], before)
+
+    def test_import_actors_ndjson(self):
+        total_actors_before = Actor.query.count()
+        body = '{"name": "Imported", "age": 40, "gender": "female"}\n\n{"name": "Imported", "age": 41, "gender": "male"}\n'
+        res = self.client().post('/actors/import', data=body,
+                                 headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual(Actor.query.count(), total_actors_before + 2)
+        self.assertEqual(Actor.count(), total_actors_before + 2)
+
+    def test_import_is_all_or_nothing(self):
+        total_movies_before = Movie.query.count()
+        body = 'title,release_date\nImported,2020-01-01\nImported,someday\n'
+        res = self.client().post('/movies/import', data=body, content_type='text/csv',
+                                 headers={"Authorization": "Bearer {}".format(self.executive_producer)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['line'], 3)
+        self.assertEqual(Movie.query.count(), total_movies_before)
+
+    def test_import_casting_assistant(self):
+        res = self.client().post('/movies/import', data='{"title": "Imported", "release_date": "2020-01-01"}\n',
+                                 headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+
+        self.assertEqual(res.status_code, 401)
+
+    def wait_for_job(self, url, token):
+        deadline = time.monotonic() + 10
+        while True:
+            res = self.client().get(url, headers={"Authorization": "Bearer {}".format(token)})
+            job = json.loads(res.data)['job']
+            if job['state'] not in ('queued', 'running') or time.monotonic() > deadline:
+                return job
+            time.sleep(0.05)
+
+    @pytest.mark.commits
+    def test_import_in_background(self):
+        total_actors_before = Actor.query.count()
+        body = '{"name": "Imported", "age": 40, "gender": "female"}\n{"name": "Imported", "age": 41, "gender": "male"}\n'
+        res = self.client().post('/actors/import', data=body,
+                                 headers={"Authorization": "Bearer {}".format(self.executive_producer),
+                                          "Prefer": "respond-async"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 202)
+        # the runner of this process may have taken it already
+        self.assertIn(data['job']['state'], ('queued', 'running'))
+        self.assertEqual(res.headers['Location'], 'http://localhost/jobs/{}'.format(data['job']['id']))
+
+        job = self.wait_for_job(res.headers['Location'], self.executive_producer)
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(job['result']['imported'], 2)
+        self.assertEqual(job['progress'], len(body))
+        self.assertEqual(job['total'], len(body))
+        self.assertEqual(Actor.query.count(), total_actors_before + 2)
+
+    @pytest.mark.commits
+    def test_background_import_stored_for_any_worker(self):
+        body = '{"name": "Imported", "age": 40, "gender": "female"}\n{"name": "Imported", "age": 41, "gender": "male"}\n'
+        # as with JOB_WORKERS=0, where another process runs the job
+        job_runner = self.app.extensions['job_runner']
+        workers, job_runner.workers = job_runner.workers, 0
+        part_size, models.JOB_FILE_PART_SIZE = models.JOB_FILE_PART_SIZE, 16
+        try:
+            res = self.client().post('/actors/import', data=body,
+                                     headers={"Authorization": "Bearer {}".format(self.executive_producer),
+                                              "Prefer": "respond-async"})
+        finally:
+            job_runner.workers, models.JOB_FILE_PART_SIZE = workers, part_size
+        job_id = json.loads(res.data)['job']['id']
+        self.assertEqual(JobFile.query.filter_by(job_id=job_id).count(), (len(body) + 15) // 16)
+        self.assertEqual(JobFile.size(job_id), len(body))
+
+        job_runner.start()
+        job = self.wait_for_job(res.headers['Location'], self.executive_producer)
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(job['result']['imported'], 2)
+        self.assertEqual(JobFile.query.filter_by(job_id=job_id).count(), 0)
+
+    @pytest.mark.commits
+    def test_failed_background_import(self):
+        total_movies_before = Movie.query.count()
+        res = self.client().post('/movies/import', data='title,release_date\nImported,2020-01-01\nImported,someday\n',
+                                 content_type='text/csv',
+                                 headers={"Authorization": "Bearer {}".format(self.executive_producer),
+                                          "Prefer": "respond-async"})
+        job = self.wait_for_job(res.headers['Location'], self.executive_producer)
+
+        self.assertEqual(job['state'], 'failed')
+        self.assertIn('line 3', job['error'])
+        self.assertEqual(Movie.query.count(), total_movies_before)
+
+    @pytest.mark.commits
+    def test_get_job_needs_its_permission(self):
+        res = self.client().post('/movies/import', data='{"title": "Imported", "release_date": "2020-01-01"}\n',
+                                 headers={"Authorization": "Bearer {}".format(self.executive_producer),
+                                          "Prefer": "respond-async"})
+        self.wait_for_job(res.headers['Location'], self.executive_producer)
+
+        res = self.client().get(res.headers['Location'],
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        self.assertEqual(res.status_code, 401)
+        res = self.client().get('/jobs/1000000',
+                                headers={"Authorization": "Bearer {}".format(self.casting_assistant)})
+        self.assertEqual(res.status_code, 404)
+
     # tests of RBAC for each role
     # casting assistant
     # test for 'get' an actor
@@ -299,6 +1126,380 @@ class MovieTestCase(unittest.TestCase):
 
 
 
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class tests the JWKS key cache against a local key file"""
+
+    def setUp(self):
+        fd, self.jwks_path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.write_keys('key-1')
+
+    def tearDown(self):
+        if os.path.exists(self.jwks_path):
+            os.remove(self.jwks_path)
+
+    def write_keys(self, *kids):
+        keys = [{'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n-' + kid, 'e': 'AQAB'} for kid in kids]
+        with open(self.jwks_path, 'w') as f:
+            json.dump({'keys': keys}, f)
+
+    def test_keys_fetched_once_within_ttl(self):
+        store = JWKSKeyStore(self.jwks_path, ttl=3600)
+        for _ in range(10):
+            key = store.get_key('key-1')
+
+        self.assertEqual(key['n'], 'n-key-1')
+        self.assertEqual(store.stats['refreshes'], 1)
+        self.assertEqual(store.stats['misses'], 1)
+        self.assertEqual(store.stats['hits'], 9)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        store = JWKSKeyStore('file://' + self.jwks_path, ttl=3600, min_refresh_interval=60)
+        for _ in range(5):
+            self.assertIsNone(store.get_key('key-2'))
+        self.assertEqual(store.stats['refreshes'], 1)
+
+        # once the interval has passed a rotated key is picked up
+        self.write_keys('key-1', 'key-2')
+        store.last_attempt -= 60
+        self.assertEqual(store.get_key('key-2')['n'], 'n-key-2')
+        self.assertEqual(store.stats['refreshes'], 2)
+
+    def test_stale_keys_served_when_refresh_fails(self):
+        store = JWKSKeyStore(self.jwks_path, ttl=0, min_refresh_interval=0)
+        store.get_key('key-1')
+        os.remove(self.jwks_path)
+
+        self.assertEqual(store.get_key('key-1')['n'], 'n-key-1')
+        self.assertEqual(store.stats['refresh_failures'], 1)
+
+    def test_expired_keys_refreshed_in_background(self):
+        store = JWKSKeyStore(self.jwks_path, ttl=0, min_refresh_interval=0, background=True)
+        store.get_key('key-1')
+        self.write_keys('key-1', 'key-2')
+
+        # the expired set is still served while the refetch runs
+        self.assertEqual(store.get_key('key-1')['n'], 'n-key-1')
+        store.refreshing.join()
+        self.assertEqual(store.stats['refreshes'], 2)
+        self.assertIn('key-2', store.keys)
+
+    def test_failed_background_refresh_not_retried_per_request(self):
+        store = JWKSKeyStore(self.jwks_path, ttl=0, min_refresh_interval=60, background=True)
+        store.get_key('key-1')
+        os.remove(self.jwks_path)
+        store.last_attempt -= 60
+        store.get_key('key-1')
+        store.refreshing.join()
+        failed = store.refreshing
+
+        for _ in range(5):
+            self.assertEqual(store.get_key('key-1')['n'], 'n-key-1')
+        self.assertIs(store.refreshing, failed)
+        self.assertEqual(store.stats['refresh_failures'], 1)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class tests the verified token cache"""
+
+    def payload(self, expires_in=3600):
+        return {'sub': 'tester', 'exp': time.time() + expires_in, 'permissions': ['get:movies']}
+
+    def test_cached_token_returns_payload_and_permissions(self):
+        cache = TokenCache(maxsize=10)
+        cache.put('token', self.payload())
+        payload, permissions = cache.get('token')
+
+        self.assertEqual(payload['sub'], 'tester')
+        self.assertIn('get:movies', permissions)
+        self.assertEqual(cache.stats['hits'], 1)
+
+    def test_entry_expires_with_token(self):
+        cache = TokenCache(maxsize=10)
+        cache.put('token', self.payload(expires_in=-1))
+
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats['misses'], 1)
+
+    def test_least_recently_used_token_evicted(self):
+        cache = TokenCache(maxsize=2)
+        cache.put('a', self.payload())
+        cache.put('b', self.payload())
+        cache.get('a')
+        cache.put('c', self.payload())
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.stats['evictions'], 1)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class tests the response cache keys and invalidation"""
+
+    def test_invalidation_only_affects_its_table(self):
+        cache = ResponseCache(LRUBackend(16))
+        movies_key = cache.key(('movies',), 'get_movies', MultiDict())
+        actors_key = cache.key(('actors',), 'get_actors', MultiDict())
+        cache.on_change('movies', 'insert', [1])
+
+        self.assertNotEqual(cache.key(('movies',), 'get_movies', MultiDict()), movies_key)
+        self.assertEqual(cache.key(('actors',), 'get_actors', MultiDict()), actors_key)
+
+    def test_evicted_generation_does_not_revive_entries(self):
+        backend = LRUBackend(16)
+        cache = ResponseCache(backend)
+        old_key = cache.key(('movies',), 'get_movies', MultiDict())
+        backend.set(old_key, 'stale')
+        backend.delete('generation:movies')
+
+        self.assertNotEqual(cache.key(('movies',), 'get_movies', MultiDict()), old_key)
+
+
+    def test_validators_follow_table_versions(self):
+        versions = {'movies': (1, datetime(2020, 1, 1)), 'movie_cast': (4, datetime(2020, 1, 3))}
+        cache = ResponseCache(LRUBackend(16), versions=lambda names: [versions[name] for name in names])
+        etag, last_modified = cache.validators(('movies', 'movie_cast'), 'get_movies', MultiDict({'include': 'cast'}))
+        self.assertEqual(last_modified, datetime(2020, 1, 3))
+
+        versions['movie_cast'] = (5, datetime(2020, 1, 4))
+        self.assertNotEqual(cache.validators(('movies', 'movie_cast'), 'get_movies', MultiDict({'include': 'cast'}))[0], etag)
+        self.assertNotEqual(cache.validators(('movies', 'movie_cast'), 'get_movies', MultiDict())[0], etag)
+
+        # no Last-Modified while another write could still land in its second
+        versions['movie_cast'] = (6, datetime.utcnow())
+        self.assertIsNone(cache.validators(('movies', 'movie_cast'), 'get_movies', MultiDict())[1])
+
+
+class ObjectCacheTestCase(unittest.TestCase):
+    """This class tests the single-record cache"""
+
+    def setUp(self):
+        self.cache = ObjectCache(LRUBackend(2))
+
+    def test_records_loaded_once_and_dropped_on_change(self):
+        loads = []
+        def load():
+            loads.append(1)
+            return {'id': 1}
+
+        self.cache.get('movies', 1, load)
+        self.cache.get('movies', 1, load)
+        self.assertEqual(len(loads), 1)
+
+        self.cache.on_change('movies', 'update', [1])
+        self.cache.get('movies', 1, load)
+        self.assertEqual(len(loads), 2)
+        self.assertEqual(self.cache.stats['hit_ratio'], round(1 / 3, 4))
+
+    def test_missing_and_racing_loads_not_kept(self):
+        self.assertIsNone(self.cache.get('movies', 1, lambda: None))
+
+        # the row changed while it was being read
+        def load():
+            self.cache.on_change('movies', 'update', [1])
+            return {'id': 1, 'title': 'stale'}
+        self.cache.get('movies', 1, load)
+
+        self.assertEqual(self.cache.get('movies', 1, lambda: {'id': 1, 'title': 'fresh'})['title'], 'fresh')
+
+    def test_evictions_counted(self):
+        for id in range(3):
+            self.cache.get('actors', id, lambda: {'id': id})
+
+        self.assertEqual(self.cache.stats['evictions'], 1)
+
+
+# the apps of these tests use databases of their own
+@pytest.mark.commits
+class ReplicaTestCase(unittest.TestCase):
+    """This class tests read routing, with two SQLite files as primary and replica"""
+
+    def setUp(self):
+        url = make_url(os.environ['DATABASE_URL'])
+        if url.get_backend_name() != 'sqlite':
+            self.skipTest('copies the SQLite test database')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.primary = os.path.join(self.tmpdir.name, 'primary.db')
+        self.replica = os.path.join(self.tmpdir.name, 'replica.db')
+        shutil.copy(url.database, self.primary)
+        shutil.copy(url.database, self.replica)
+        # as if the replica had not caught up with a write yet
+        with sqlite3.connect(self.replica) as connection:
+            connection.execute("UPDATE movies SET title = 'Replica title' WHERE id = 3")
+        self.headers = {"Authorization": "Bearer {}".format(os.environ['executive_producer'])}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def create_app(self, replica_url):
+        return create_app(Config(DATABASE_URL='sqlite:///' + self.primary, REPLICA_URLS=[replica_url]))
+
+    def title(self, client):
+        return json.loads(client.get('/movies/3/cast', headers=self.headers).data)['movie']['title']
+
+    def test_reads_from_replica_until_client_writes(self):
+        app = self.create_app('sqlite:///' + self.replica)
+        client = app.test_client()
+        self.assertEqual(self.title(client), 'Replica title')
+
+        res = client.patch('/movies/3', headers=self.headers, json={'title': 'Primary title'})
+        self.assertIn('read_primary_until', res.headers['Set-Cookie'])
+        self.assertEqual(self.title(client), 'Primary title')
+        # other clients still read from the replica
+        self.assertEqual(self.title(app.test_client()), 'Replica title')
+
+    def test_writer_never_served_a_replica_read_from_the_object_cache(self):
+        app = self.create_app('sqlite:///' + self.replica)
+        writer = app.test_client()
+        writer.patch('/movies/3', headers=self.headers, json={'title': 'Primary title'})
+        # another client's read fills the cache
+        app.test_client().get('/movies/3', headers=self.headers)
+
+        res = writer.get('/movies/3', headers=self.headers)
+        self.assertEqual(json.loads(res.data)['movie']['title'], 'Primary title')
+        res = writer.patch('/movies/3', headers=dict(self.headers, **{'If-Match': res.headers['ETag']}),
+                           json={'title': 'Next title'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(app.test_client().get('/movies/3', headers=self.headers).data)['movie']['title'],
+                         'Next title')
+
+    def test_unhealthy_replica_skipped(self):
+        app = self.create_app('sqlite:///' + os.path.join(self.tmpdir.name, 'missing', 'replica.db'))
+        client = app.test_client()
+        self.assertNotEqual(self.title(client), 'Replica title')
+
+        replicas = json.loads(client.get('/stats').data)['replicas']
+        self.assertEqual(replicas['fallbacks'], 1)
+        self.assertFalse(replicas['replicas'][0]['healthy'])
+
+
+class ConfigTestCase(unittest.TestCase):
+    """This class tests the app configuration"""
+
+    def test_missing_settings_reported_when_app_created(self):
+        with self.assertRaises(RuntimeError) as error:
+            create_app(Config(environ={'DATABASE_URL': os.environ['DATABASE_URL']}))
+
+        self.assertIn('AUTH0_DOMAIN', str(error.exception))
+        self.assertNotIn('DATABASE_URL', str(error.exception))
+
+    def test_settings_passed_to_create_app(self):
+        app = create_app(Config(PAGE_SIZE=2))
+        res = app.test_client().get('/movies', headers={"Authorization": "Bearer {}".format(os.environ['casting_assistant'])})
+
+        self.assertEqual(len(json.loads(res.data)['movies']), 2)
+
+    def test_import_does_not_build_the_app(self):
+        self.assertNotIn('APP', vars(app_module))
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    """This class tests the connection pool settings and stats"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.tmpdir.name, 'pool.db'),
+                                    poolclass=TimedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.1)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def test_pool_options_only_for_servers(self):
+        self.assertEqual(engine_options('sqlite:///movies.db'), {})
+        self.assertEqual(engine_options('postgresql://user@localhost/movie_actor')['pool_size'], DB_POOL_SIZE)
+
+    def test_pool_stats_track_checkouts_and_timeouts(self):
+        connection = self.engine.connect()
+        self.assertEqual(pool_stats(self.engine.pool)['checked_out'], 1)
+
+        with self.assertRaises(exc.TimeoutError):
+            self.engine.connect()
+        connection.close()
+
+        stats = pool_stats(self.engine.pool)
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+
+    def test_connection_from_another_process_not_reused(self):
+        connection = self.engine.connect()
+        dbapi_connection = connection.connection.connection
+        # as if the pool had been copied into a forked worker
+        connection.connection._connection_record.info['pid'] = -1
+        connection.close()
+
+        connection = self.engine.connect()
+        self.assertIsNot(connection.connection.connection, dbapi_connection)
+        connection.close()
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """This class tests the per-subject rate limits and concurrency caps"""
+
+    def setUp(self):
+        self.headers = {"Authorization": "Bearer {}".format(os.environ['casting_assistant'])}
+
+    def test_bucket_refuses_once_empty_then_refills(self):
+        backend = MemoryBackend()
+        self.assertEqual(backend.take('a', 2, 10), (True, 0))
+        self.assertEqual(backend.take('a', 2, 10), (True, 0))
+        allowed, retry_after = backend.take('a', 2, 10)
+        self.assertFalse(allowed)
+        self.assertGreater(retry_after, 0)
+        self.assertLessEqual(retry_after, 0.1)
+        # other keys have their own bucket
+        self.assertTrue(backend.take('b', 2, 10)[0])
+
+        time.sleep(retry_after)
+        self.assertTrue(backend.take('a', 2, 10)[0])
+
+    def test_limits_per_subject_and_permission(self):
+        self.assertEqual(parse_limits('get:movies=300/60, post:movies=30/1'),
+                         {'get:movies': (300, 60.0), 'post:movies': (30, 1.0)})
+        self.assertEqual(parse_limits('default=0'), {'default': (0, 60.0)})
+        limiter = RateLimiter(default=(0, 60), limits={'get:movies': (1, 60)})
+        limiter.check({'sub': 'a'}, 'get:movies')
+        limiter.check({'sub': 'b'}, 'get:movies')
+        # no limit for the permission
+        limiter.check({'sub': 'a'}, 'get:actors')
+        limiter.check({'sub': 'a'}, 'get:actors')
+
+        with self.assertRaises(RateLimitError) as error:
+            limiter.check({'sub': 'a'}, 'get:movies')
+        self.assertEqual(error.exception.status_code, 429)
+        self.assertEqual(limiter.stats, {'allowed': 2, 'limited': 1})
+
+    def test_over_the_limit_answers_429_with_retry_after(self):
+        app = create_app(Config(RATE_LIMITS='get:movies=2/60'))
+        client = app.test_client()
+        for _ in range(2):
+            self.assertEqual(client.get('/movies?stream=true', headers=self.headers).status_code, 200)
+
+        res = client.get('/movies?stream=true', headers=self.headers)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '30')
+        self.assertEqual(json.loads(res.data)['error'], 429)
+        self.assertEqual(client.get('/actors', headers=self.headers).status_code, 200)
+
+    def test_concurrency_cap_answers_503_and_frees_slots(self):
+        app = create_app(Config(LIST_CONCURRENCY=1))
+        client = app.test_client()
+        # streamed responses give their slot back once sent
+        for _ in range(3):
+            res = client.get('/movies?stream=true', headers=self.headers)
+            self.assertEqual(res.status_code, 200)
+            res.close()
+
+        held = client.get('/actors?stream=true', headers=self.headers, buffered=False)
+        res = client.get('/movies?stream=true', headers=self.headers)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        held.close()
+        self.assertEqual(client.get('/movies?stream=true', headers=self.headers).status_code, 200)
+        self.assertEqual(json.loads(client.get('/stats').data)['concurrency']['list']['rejected'], 1)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
-    unittest.main()
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
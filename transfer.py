@@ -0,0 +1,227 @@
+import os
+import io
+import csv
+import json
+import time
+import logging
+from itertools import islice
+from sqlalchemy import Integer, exc, text
+from models import db, commit_change
+from serialization import dumps
+
+# columns an exported record carries besides those validate checks
+EXPORTED_COLUMNS = ('id', 'version')
+
+# rows validated and written per statement (or COPY) when importing
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 5000))
+# rows fetched per round-trip from the server-side cursor when exporting
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 5000))
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson'
+}
+
+logger = logging.getLogger(__name__)
+
+
+'''
+TransferError
+    an import that stopped at a row which cannot be written, line being its
+    line in the file (None when the database refused the batch). nothing of
+    the import is kept
+'''
+class TransferError(Exception):
+    def __init__(self, line, message):
+        self.line = line
+        self.message = message
+
+    def __str__(self):
+        if self.line is None:
+            return self.message
+        return 'line %d: %s' % (self.line, self.message)
+
+
+def is_postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def batched(rows, size):
+    rows = iter(rows)
+    batch = list(islice(rows, size))
+    while batch:
+        yield batch
+        batch = list(islice(rows, size))
+
+
+'''
+export_rows(model, fields, fmt)
+    yields the fields of every row of model, ordered by id, as chunks of
+    CSV (with a header line) or NDJSON. rows come from a server-side cursor
+    a batch at a time, so memory stays flat however large the table is
+'''
+def export_rows(model, fields, fmt):
+    started = time.perf_counter()
+    query = db.session.query(*[getattr(model, name) for name in fields]).order_by(model.id)
+    count = 0
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+        for batch in batched(query.yield_per(EXPORT_BATCH_SIZE), EXPORT_BATCH_SIZE):
+            writer.writerows(batch)
+            count += len(batch)
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+        if not count:
+            yield buffer.getvalue().encode('utf-8')
+    else:
+        for batch in batched(query.yield_per(EXPORT_BATCH_SIZE), EXPORT_BATCH_SIZE):
+            yield b''.join(dumps(dict(zip(fields, row))) + b'\n' for row in batch)
+            count += len(batch)
+    log_rate('exported', model.__tablename__, count, time.perf_counter() - started)
+
+
+'''
+copy_export(model, fields, file)
+    writes model's rows as CSV to the binary file with a single COPY ... TO
+    STDOUT, the fastest export postgres offers. returns the row count
+'''
+def copy_export(model, fields, file):
+    started = time.perf_counter()
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert('COPY (SELECT %s FROM %s ORDER BY id) TO STDOUT WITH (FORMAT csv, HEADER true)'
+                       % (', '.join(fields), model.__tablename__), file)
+    log_rate('exported', model.__tablename__, cursor.rowcount, time.perf_counter() - started)
+    return cursor.rowcount
+
+
+'''
+read_items(lines, fmt, integer_fields)
+    yields (line number, item) for each record of lines, an iterable of
+    bytes lines (an open binary file or request.stream). CSV values are all
+    strings, so empty ones are read as null (as COPY does) and integer_fields
+    are converted
+'''
+def read_items(lines, fmt, integer_fields):
+    if fmt == 'csv':
+        reader = csv.DictReader(line.decode('utf-8') for line in lines)
+        for record in reader:
+            item = {}
+            for name, value in record.items():
+                if name is None:
+                    continue
+                if value in ('', None):
+                    value = None
+                elif name in integer_fields:
+                    try:
+                        value = int(value)
+                    except ValueError:
+                        raise TransferError(reader.line_num, '%s must be an integer' % name)
+                item[name] = value
+            yield reader.line_num, item
+    else:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                raise TransferError(number, 'invalid JSON')
+            if not isinstance(item, dict):
+                raise TransferError(number, 'item must be an object')
+            yield number, item
+
+
+# the rows of a batch grouped by the columns they set, as one statement
+# (or COPY) takes the same columns for every row
+def by_columns(rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row), []).append(row)
+    return groups.items()
+
+
+def insert_batch(table, rows):
+    for columns, group in by_columns(rows):
+        db.session.execute(table.insert().execution_options(batched=True), group)
+
+
+def copy_batch(table, rows):
+    cursor = db.session.connection().connection.cursor()
+    for columns, group in by_columns(rows):
+        buffer = io.StringIO()
+        # strings quoted, so an empty one is not read back as NULL
+        csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(
+            [row[column] for column in columns] for row in group)
+        buffer.seek(0)
+        cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (table.name, ', '.join(columns)), buffer)
+
+
+'''
+import_rows(model, lines, fmt, validate, progress=None)
+    inserts every record of lines (see read_items) into model's table in a
+    single transaction, IMPORT_BATCH_SIZE rows at a time: with COPY on
+    postgres and executemany INSERTs otherwise. each record is checked with
+    validate (as for the bulk endpoints) and may carry its id and version,
+    e.g. when reloading an export. raises TransferError, keeping nothing, if any
+    record is invalid. returns the row count and the seconds taken.
+    progress(count) is called with the rows written after each batch
+'''
+def import_rows(model, lines, fmt, validate, progress=None):
+    started = time.perf_counter()
+    table = model.__table__
+    integer_fields = {column.name for column in table.columns if isinstance(column.type, Integer)}
+    write = copy_batch if is_postgres() else insert_batch
+    count = 0
+    with_ids = False
+    try:
+        batch = []
+        for line, item in read_items(lines, fmt, integer_fields):
+            try:
+                row = validate(item)
+                for name in EXPORTED_COLUMNS:
+                    if item.get(name) is None or name not in table.c:
+                        continue
+                    if not isinstance(item[name], int) or isinstance(item[name], bool):
+                        raise ValueError('%s must be an integer' % name)
+                    row[name] = item[name]
+                with_ids = with_ids or 'id' in row
+            except ValueError as e:
+                raise TransferError(line, str(e))
+            batch.append(row)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                write(table, batch)
+                count += len(batch)
+                batch = []
+                if progress is not None:
+                    progress(count)
+        if batch:
+            write(table, batch)
+            count += len(batch)
+        if with_ids and is_postgres():
+            # rows given their ids leave the sequence behind
+            db.session.execute(text("SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                                    "(SELECT COALESCE(MAX(id), 0) + 1 FROM {0}), false)".format(table.name)))
+    except TransferError:
+        db.session.rollback()
+        raise
+    except (exc.DBAPIError, db.session.get_bind().dialect.dbapi.Error) as e:
+        db.session.rollback()
+        raise TransferError(None, str(getattr(e, 'orig', e)).strip().splitlines()[0])
+
+    if count:
+        commit_change(table.name, 'insert', None, count)
+    elapsed = time.perf_counter() - started
+    log_rate('imported', table.name, count, elapsed)
+    return count, elapsed
+
+
+def rows_per_second(count, elapsed):
+    return count / elapsed if elapsed > 0 else 0.0
+
+
+def log_rate(action, table_name, count, elapsed):
+    logger.info('%s %d %s in %.2f s (%.0f rows/s)', action, count, table_name, elapsed,
+                rows_per_second(count, elapsed))